@@ -3,8 +3,10 @@ import time
 from qrz_utils import *
 
 import utils_supersdr 
+from utils_supersdr import audio_recording
 
 from kiwi import wsclient
+from kiwi.client import ImaAdpcmDecoder
 import mod_pywebsocket.common
 from mod_pywebsocket.stream import Stream
 from mod_pywebsocket.stream import StreamOptions
@@ -18,6 +20,8 @@ HELP_MESSAGE_LIST = ["SuperSDR %s HELP" % VERSION,
         "- LEFT/RIGHT: move KIWI RX freq +/- 1kHz (+SHIFT: x10)",
         "- UP/DOWN: tune main frequency (+SHIFT: 1 kHz, +CTRL: 10 Hz)",
         "- PAGE UP/DOWN: move WF freq +/- SPAN/4",
+        "- SHIFT+PAGE UP/DOWN: scroll WF archive (+CTRL: 10 min), HOME: live",
+        "- [/]: WF time scale 1x, 2x, 4x... (slower/faster scrolling)",
         "- UP/DOWN: zoom in/out by a factor 2X",
         "- U/L/C/A: switch to USB, LSB, CW, AM",
         "- J/K/O: tune RX low/high cut (SHIFT inverts, try CTRL!), O resets",
@@ -25,6 +29,7 @@ HELP_MESSAGE_LIST = ["SuperSDR %s HELP" % VERSION,
         "- G/H: inc/dec spectrum and WF averaging to improve SNR",
         "- ,/.(+SHIFT) change high(low) clip level for spectrum and WF",
         "- E: start/stop audio recording",
+        "- SHIFT+E: show/hide audio latency histograms, CTRL+E: export them",
         "- F: enter frequency with keyboard",
         "- W/R: Write/Recall quick cyclic memory (up to 10)",
         "- SHIFT+W: Save all memories to disk",
@@ -59,7 +64,7 @@ import random
 import struct
 import array
 import math
-from collections import deque, defaultdict
+from collections import deque, defaultdict, OrderedDict
 import pickle
 import threading, queue
 import socket
@@ -76,7 +81,7 @@ else:
         return str(b)
 
 import numpy as np
-from scipy.signal import resample_poly, welch
+from scipy.signal import resample_poly, welch, firwin
 
 import sounddevice as sd
 import wave
@@ -87,6 +92,18 @@ def get_auto_mode(freq):
     else:
         return "LSB"
 
+def default_passband(radio_mode, delta_low=0, delta_high=0):
+    # lc, hc of radio_mode as offsets from the carrier
+    if radio_mode == "USB":
+        return LOW_CUT_SSB+delta_low, HIGH_CUT_SSB+delta_high
+    elif radio_mode == "LSB":
+        return -HIGH_CUT_SSB-delta_high, -LOW_CUT_SSB-delta_low
+    elif radio_mode == "AM" or radio_mode == "NFM":
+        return -HIGHLOW_CUT_AM-delta_low, HIGHLOW_CUT_AM+delta_high
+    elif radio_mode == "CW":
+        return LOW_CUT_CW+delta_low, HIGH_CUT_CW+delta_high
+    return 0, 0
+
 class beacons:
     def __init__(self):
         self.freq_dict = {}
@@ -192,6 +209,530 @@ class kiwi_sdr:
         if verbose_flag:
             print(self.kiwi_status_dict)
 
+class transport_meter():
+    # Bytes received on a stream against what the same frames would have cost
+    # uncompressed, with both rates measured over the last window_s seconds.
+    def __init__(self, window_s=2.):
+        self.window_s = window_s
+        self.rx_bytes = 0
+        self.raw_bytes = 0
+        self.rx_rate = 0.
+        self.raw_rate = 0.
+        self.t0 = time.monotonic()
+        self.rx0, self.raw0 = 0, 0
+
+    def add(self, rx_bytes, raw_bytes):
+        self.rx_bytes += rx_bytes
+        self.raw_bytes += raw_bytes
+        now = time.monotonic()
+        dt = now - self.t0
+        if dt >= self.window_s:
+            self.rx_rate = (self.rx_bytes - self.rx0) / dt
+            self.raw_rate = (self.raw_bytes - self.raw0) / dt
+            self.t0, self.rx0, self.raw0 = now, self.rx_bytes, self.raw_bytes
+
+    def saved_rate(self):
+        return self.raw_rate - self.rx_rate
+
+class wf_ring_buffer():
+    # Circular waterfall history: each new line is written in place at the head
+    # index, so adding a line never moves the rest of the matrix. Readers get the
+    # newest rows (newest first) as views via slices(), or as one ordered copy.
+    def __init__(self, height, bins, dtype=np.float64):
+        self.height = height
+        self.bins = bins
+        self.data = np.zeros((height, bins), dtype=dtype)
+        self.head = 0
+        self.count = 0
+        self.total = 0 # rows ever appended, lets readers spot new ones
+
+    def append(self, row):
+        next_head = (self.head + 1) % self.height
+        self.data[next_head, :] = row
+        # publish the new head only once the row is complete
+        self.head = next_head
+        self.count = min(self.count + 1, self.height)
+        self.total += 1
+
+    def latest(self):
+        return self.data[self.head]
+
+    def slices(self, n=None):
+        n = self.height if n is None else max(0, min(n, self.height))
+        head = self.head
+        first_len = min(n, head + 1)
+        first = self.data[head + 1 - first_len:head + 1][::-1]
+        if n > first_len:
+            second = self.data[self.height - (n - first_len):][::-1]
+        else:
+            second = self.data[:0]
+        return first, second
+
+    def newest(self, n=None):
+        return np.concatenate(self.slices(n))
+
+class wf_pyramid():
+    # Time decimated copies of the waterfall history: level k holds one line per
+    # 2**k received lines, pooled (max or mean) from pairs of level k-1 lines as
+    # they arrive, so the whole pyramid costs ~2 pooling ops per line and any
+    # time scale can be drawn by reading one screen of the right level. Level 0
+    # is the base history ring; every level has the same height, so memory is
+    # bounded by (levels+1) screens.
+    def __init__(self, base, levels=8, pooling="max"):
+        self.pooling = pooling
+        self.levels = [base] + [wf_ring_buffer(base.height, base.bins, base.data.dtype)
+                                for _ in range(levels)]
+        # first line of a pair waiting for its partner, per level
+        self.pending = np.zeros((levels + 1, base.bins), dtype=base.data.dtype)
+        self.has_pending = [False] * (levels + 1)
+
+    def append(self, row):
+        self.levels[0].append(row)
+        row = self.levels[0].latest()
+        for k in range(1, len(self.levels)):
+            if not self.has_pending[k]:
+                self.pending[k] = row
+                self.has_pending[k] = True
+                return
+            self.has_pending[k] = False
+            pooled = self.pending[k]
+            if self.pooling == "max":
+                np.maximum(pooled, row, out=pooled)
+            else:
+                pooled += row
+                pooled *= 0.5
+            self.levels[k].append(pooled)
+            row = self.levels[k].latest()
+
+    def decimation(self, level):
+        return 2**level
+
+    def level_for(self, lines, rows):
+        # coarsest detail that still fits `lines` received lines in `rows` rows
+        for k in range(len(self.levels)):
+            if rows * 2**k >= lines:
+                return k
+        return len(self.levels) - 1
+
+    def view(self, level, rows=None):
+        # newest first lines of one level, as (first, second) ring views
+        return self.levels[level].slices(rows)
+
+class frame_bus():
+    # Single producer broadcast of waterfall frames. Every published frame gets a
+    # sequence number and lands in slot seq % capacity of a preallocated ring,
+    # and `published` is only advanced once the slot is complete. Consumers read
+    # through their own frame_subscriber, so each one sees every frame once, in
+    # order, unless its own backpressure limit makes it skip some.
+    def __init__(self, bins, capacity=256):
+        self.capacity = capacity
+        self.dtype = np.dtype([("seq", np.int64), ("utc", np.float64), ("start_khz", np.float64),
+                               ("zoom", np.uint8), ("averaging", np.uint16), ("cached", np.bool_),
+                               ("line", np.float32, (bins,)), ("spectrum", np.float32, (bins,))])
+        self.slots = np.zeros(capacity, dtype=self.dtype)
+        self.published = 0
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def subscribe(self, name, max_pending=None):
+        sub = frame_subscriber(self, name, max_pending)
+        with self.lock:
+            # swap the list so publish() can iterate it without locking
+            self.subscribers = self.subscribers + [sub]
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s is not sub]
+
+    def publish(self, line, spectrum, start_khz, zoom, averaging, utc=None, cached=False):
+        # cached frames replay lines remembered for a view, not fresh data
+        seq = self.published
+        slot = self.slots[seq % self.capacity]
+        slot["seq"] = seq
+        slot["utc"] = time.time() if utc is None else utc
+        slot["start_khz"] = start_khz
+        slot["zoom"] = zoom
+        slot["averaging"] = averaging
+        slot["cached"] = cached
+        slot["line"] = line
+        if spectrum is not None:
+            slot["spectrum"] = spectrum
+        self.published = seq + 1
+        for sub in self.subscribers:
+            sub.ready.set()
+        return seq
+
+class frame_subscriber():
+    # One consumer's cursor on a frame_bus. drain() returns a copy of all frames
+    # published since the last call (oldest first). If more than max_pending are
+    # waiting, only the newest max_pending are returned and the rest count as
+    # dropped, as do frames the producer overwrote before they could be read.
+    def __init__(self, bus, name, max_pending=None):
+        self.bus = bus
+        self.name = name
+        limit = bus.capacity - 1
+        self.max_pending = limit if max_pending is None else max(1, min(max_pending, limit))
+        self.next_seq = bus.published
+        self.dropped = 0
+        self.delivered = 0
+        self.ready = threading.Event()
+
+    def pending(self):
+        return self.bus.published - self.next_seq
+
+    def wait(self, timeout=None):
+        return self.ready.wait(timeout)
+
+    def drain(self, max_frames=None):
+        bus = self.bus
+        self.ready.clear()
+        end = bus.published
+        start = max(self.next_seq, end - self.max_pending)
+        if max_frames is not None:
+            end = min(end, start + max_frames)
+        frames = bus.slots[np.arange(start, end) % bus.capacity]
+        # slots the producer lapped while they were being copied may be torn,
+        # the slot of the frame being written now is that of published-capacity
+        oldest_valid = bus.published - bus.capacity + 1
+        if start < oldest_valid:
+            frames = frames[min(oldest_valid, end) - start:]
+            start = min(oldest_valid, end)
+        self.dropped += start - self.next_seq
+        self.delivered += len(frames)
+        self.next_seq = end
+        return frames
+
+class wf_rate_governor():
+    # Chooses the Kiwi wf_speed and a client side line decimation from what the
+    # waterfall consumers actually use. Consumers declare the lines per second
+    # they draw or store with demand() (0 when hidden), optionally expiring so a
+    # stalled GUI stops counting. Every drawn line averages averaging_n frames,
+    # so the Kiwi is asked for demand*averaging_n frames/s at most. If frames
+    # arrive well below the requested rate the link is the bottleneck and the
+    # speed is capped one step lower for a while.
+    SPEED_FPS = {1: 1., 2: 5., 3: 13.} # 4: the server MAX_FPS
+    MAX_SPEED = 4
+    EVAL_S = 1.
+    SLOW_LINK_RATIO = 0.7
+    SLOW_LINK_EVALS = 3
+    SPEED_CAP_S = 30.
+
+    def __init__(self, max_fps):
+        self.max_fps = max_fps
+        self.demands = {}
+        self.speed = self.MAX_SPEED
+        self.speed_cap = self.MAX_SPEED
+        self.cap_until = 0.
+        self.slow_evals = 0
+        self.decimation = 1 # keep one frame every decimation, 0 keeps none
+        self.frames = 0
+        self.t0 = time.monotonic()
+        self.rx_fps = 0.
+
+    def speed_fps(self, speed):
+        return self.SPEED_FPS.get(speed, self.max_fps)
+
+    def demand(self, name, fps, ttl_s=None):
+        # a new dict, so wanted_fps() in the W/F thread never sees one change size
+        self.demands = {**self.demands, name: (fps, None if ttl_s is None else time.monotonic() + ttl_s)}
+
+    def wanted_fps(self, now):
+        demands = self.demands
+        if not demands:
+            # nobody told us anything, keep the full rate
+            return self.max_fps
+        return max([fps for fps, expiry in demands.values() if expiry is None or expiry > now], default=0.)
+
+    def frame(self, averaging_n, now=None):
+        # count a received frame, returns True when the wf_speed has to change
+        now = time.monotonic() if now is None else now
+        self.frames += 1
+        dt = now - self.t0
+        if dt < self.EVAL_S:
+            return False
+        self.rx_fps = self.frames / dt
+        self.frames, self.t0 = 0, now
+        return self.evaluate(averaging_n, now)
+
+    def evaluate(self, averaging_n, now):
+        wanted = self.wanted_fps(now)
+        needed = min(self.max_fps, wanted * max(averaging_n, 1))
+
+        if self.rx_fps < self.SLOW_LINK_RATIO * self.speed_fps(self.speed):
+            self.slow_evals += 1
+        else:
+            self.slow_evals = 0
+        if self.slow_evals >= self.SLOW_LINK_EVALS and self.speed > 1:
+            self.speed_cap = self.speed - 1
+            self.cap_until = now + self.SPEED_CAP_S
+            self.slow_evals = 0
+        elif now > self.cap_until:
+            self.speed_cap = self.MAX_SPEED
+
+        # speed 0 would stop the frames that keep the stream (and us) alive
+        speed = 1
+        while speed < self.speed_cap and self.speed_fps(speed) < needed:
+            speed += 1
+        if wanted <= 0:
+            self.decimation = 0
+        else:
+            self.decimation = max(1, int(self.speed_fps(speed) / wanted))
+        changed = speed != self.speed
+        if changed:
+            self.speed = speed
+            self.slow_evals = 0
+        return changed
+
+class spectrum_view_cache():
+    # LRU of what the waterfall last showed for each (zoom, start counter) view:
+    # the averaged scope spectrum and the newest waterfall lines. Entries are
+    # evicted, least recently used first, once they exceed budget_bytes.
+    def __init__(self, budget_bytes=32*2**20):
+        self.budget_bytes = budget_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, key, spectrum, lines):
+        self.pop(key)
+        entry = (spectrum.copy(), lines.copy())
+        self.entries[key] = entry
+        self.nbytes += entry[0].nbytes + entry[1].nbytes
+        while self.nbytes > self.budget_bytes and len(self.entries) > 1:
+            self.pop(next(iter(self.entries)))
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[0].nbytes + entry[1].nbytes
+        return entry
+
+class bin_resampler():
+    # W/F bins to screen pixels without rebuilding index grids every frame:
+    # the layout for each (bins, width) is computed once and kept until the
+    # width changes. With more bins than pixels each pixel gets the max, the
+    # mean or the centre one of its group of bins (so "max" keeps one bin
+    # carriers), with fewer every pixel repeats its nearest bin. Works on
+    # single lines and on stacks of lines (last axis).
+    MODES = ("max", "mean", "nearest")
+
+    def __init__(self, mode="max"):
+        if mode not in self.MODES:
+            raise ValueError("bin_resampler mode must be one of %s" % ", ".join(self.MODES))
+        self.mode = mode
+        self.layouts = {}
+
+    def layout(self, bins, width):
+        key = (bins, width)
+        layout = self.layouts.get(key)
+        if layout is None:
+            if len(self.layouts) > 4:
+                self.layouts.clear() # old widths after resizes
+            if bins > width:
+                # pixel x covers bins [starts[x], starts[x+1])
+                edges = np.arange(width + 1) * bins // width
+                starts = edges[:-1]
+                counts = np.diff(edges)
+                nearest = starts + counts // 2
+                counts = counts.astype(np.uint32)
+            else:
+                starts = counts = None
+                nearest = np.minimum(np.arange(width) * bins // width, bins - 1)
+            # uint32 copy of a uint8 line and its per pixel sums, for "mean"
+            acc = (np.zeros(bins, dtype=np.uint32), np.zeros(width, dtype=np.uint32))
+            layout = (starts, counts, nearest, acc, {})
+            self.layouts[key] = layout
+        return layout
+
+    def resample(self, lines, width):
+        # returns a buffer owned by the resampler for single lines
+        bins = lines.shape[-1]
+        starts, counts, nearest, acc, outs = self.layout(bins, width)
+        if lines.ndim == 1:
+            out = outs.get(lines.dtype)
+            if out is None:
+                out = outs[lines.dtype] = np.zeros(width, dtype=lines.dtype)
+        else:
+            out = np.empty(lines.shape[:-1] + (width,), dtype=lines.dtype)
+        if starts is None or self.mode == "nearest":
+            np.take(lines, nearest, axis=-1, out=out, mode='clip')
+        elif self.mode == "max":
+            np.maximum.reduceat(lines, starts, axis=-1, out=out)
+        else:
+            if lines.ndim == 1 and lines.dtype.kind == "u" and lines.dtype.itemsize < 4:
+                wide, total = acc
+                np.copyto(wide, lines)
+                np.add.reduceat(wide, starts, out=total)
+            else:
+                total = np.add.reduceat(lines, starts, axis=-1, dtype=np.float64)
+            np.floor_divide(total, counts, out=out, casting='unsafe')
+        return out
+
+class wf_level_tracker():
+    # Streaming noise floor / peak estimator for W/F autoscaling. Every frame is
+    # binned into a 256 bucket histogram of the raw (uint8 scale) spectrum and the
+    # low/high quantiles are read from its cumulative counts, O(bins + 256) with no
+    # sort. For raw uint8 frames (averaging 1) these are the values np.percentile
+    # gives; an averaged float spectrum is truncated to whole levels first, so its
+    # quantiles can read up to one level (1 dB) low. The levels are then smoothed
+    # across frames with time constant tau_s, so they no longer jitter from frame
+    # to frame and a single lightning crash barely moves them.
+    LEVELS = 256
+
+    def __init__(self, low_q=0.4, high_q=1.0, tau_s=2.0):
+        self.low_q, self.high_q = low_q, high_q
+        self.tau_s = tau_s
+        self.cum_counts = np.zeros(self.LEVELS, dtype=np.intp)
+        self.bin_idx = np.zeros(0, dtype=np.intp)
+        self.last_t = None
+        self.low, self.high = 0., float(self.LEVELS-1)
+
+    def reset(self):
+        self.last_t = None
+
+    def update(self, spectrum, now=None):
+        now = time.monotonic() if now is None else now
+        n = len(spectrum)
+        if n == 0:
+            return self.low, self.high
+        if len(self.bin_idx) != n:
+            self.bin_idx = np.zeros(n, dtype=np.intp)
+        np.copyto(self.bin_idx, spectrum, casting="unsafe")
+        np.clip(self.bin_idx, 0, self.LEVELS-1, out=self.bin_idx)
+        np.cumsum(np.bincount(self.bin_idx, minlength=self.LEVELS), out=self.cum_counts)
+
+        low = self.quantile(self.low_q, n)
+        high = self.quantile(self.high_q, n)
+        if self.last_t is None or self.tau_s <= 0:
+            alpha = 1.
+        else:
+            alpha = 1. - math.exp(-max(now - self.last_t, 0.) / self.tau_s)
+        self.last_t = now
+        self.low += alpha * (low - self.low)
+        self.high += alpha * (high - self.high)
+        return self.low, self.high
+
+    def quantile(self, q, n):
+        # linear interpolation between order statistics, like np.percentile
+        pos = q * (n - 1)
+        k = int(pos)
+        v0 = int(np.searchsorted(self.cum_counts, k, side="right"))
+        if k + 1 >= n:
+            return float(v0)
+        v1 = int(np.searchsorted(self.cum_counts, k + 1, side="right"))
+        return v0 + (pos - k) * (v1 - v0)
+
+class spectrum_averager():
+    # Non-blocking spectrum averaging: every pushed frame updates the running state
+    # and each named depth yields one averaged line per received frame, so the
+    # output rate no longer drops with the averaging and nothing restarts from zero.
+    # Boxcar depths share one ring of past raw frames and keep an exact int64
+    # running sum (raw W/F bins are bytes), so even LINRAD style averages over
+    # hundreds of frames never drift. EMA depths keep a float64 state with
+    # alpha = 2/(n+1) and behave as a cumulative mean while warming up.
+    MIN_RING_DEPTH = 100 # frames kept anyway, so raising the depth reuses them
+
+    def __init__(self, bins, mode="boxcar"):
+        self.bins = bins
+        self.mode = mode
+        self.ring = np.zeros((self.MIN_RING_DEPTH, bins), dtype=np.uint8)
+        self.ring_head = 0
+        self.count = 0
+        self.depths = {}
+        self.states = {}
+        self.outputs = {}
+        self.pushed = {}
+        # scratch rows, mixed dtype ufuncs would allocate casting buffers
+        self.frame_tmp = np.zeros(bins, dtype=np.int64)
+        self.f64_tmp = np.zeros(bins)
+        self.reset_flag = False
+
+    def set_depth(self, name, n):
+        n = max(1, int(n))
+        self.depths[name] = n
+        self.outputs.setdefault(name, np.zeros(self.bins, dtype=np.float32))
+        if self.mode == "ema":
+            self.states.setdefault(name, np.zeros(self.bins))
+            self.pushed.setdefault(name, 0)
+            return
+        if n > len(self.ring):
+            self._grow_ring(n)
+        # rebuild the running sum from the frames already in the ring
+        state = self.states.setdefault(name, np.zeros(self.bins, dtype=np.int64))
+        state[:] = 0
+        cap = len(self.ring)
+        for i in range(min(n, self.count)):
+            state += self.ring[(self.ring_head - i) % cap]
+
+    def _grow_ring(self, n):
+        cap = len(self.ring)
+        ring = np.zeros((n, self.bins), dtype=np.uint8)
+        # keep the stored frames in push order, newest at index count-1
+        for i in range(self.count):
+            ring[self.count - 1 - i] = self.ring[(self.ring_head - i) % cap]
+        self.ring = ring
+        self.ring_head = max(self.count - 1, 0)
+
+    def reset(self):
+        # may be called from another thread, the pushing thread does the work
+        self.reset_flag = True
+
+    def _do_reset(self):
+        self.reset_flag = False
+        self.count = 0
+        for name in self.states:
+            self.states[name][:] = 0
+            self.pushed[name] = 0
+
+    def push(self, frame):
+        if self.reset_flag:
+            self._do_reset()
+        if self.mode == "ema":
+            for name, n in self.depths.items():
+                state = self.states[name]
+                self.pushed[name] += 1
+                alpha = max(2. / (n + 1), 1. / self.pushed[name])
+                np.copyto(self.f64_tmp, frame)
+                self.f64_tmp -= state
+                self.f64_tmp *= alpha
+                state += self.f64_tmp
+            return
+
+        cap = len(self.ring)
+        head = (self.ring_head + 1) % cap
+        for name, n in self.depths.items():
+            if self.count >= n:
+                # frame leaving the window was pushed n frames ago
+                np.copyto(self.frame_tmp, self.ring[(head - n) % cap])
+                self.states[name] -= self.frame_tmp
+        self.ring[head] = frame
+        self.ring_head = head
+        self.count = min(self.count + 1, cap)
+        np.copyto(self.frame_tmp, frame)
+        for name in self.depths:
+            self.states[name] += self.frame_tmp
+
+    def mean(self, name):
+        out = self.outputs[name]
+        if self.mode == "ema":
+            np.copyto(out, self.states[name], casting="same_kind")
+        else:
+            np.copyto(self.f64_tmp, self.states[name])
+            self.f64_tmp *= 1. / max(min(self.count, self.depths[name]), 1)
+            np.copyto(out, self.f64_tmp, casting="same_kind")
+        return out
+
 class kiwi_waterfall():
     MAX_FREQ = 30000
     CENTER_FREQ = int(MAX_FREQ/2)
@@ -200,13 +741,20 @@ class kiwi_waterfall():
     MAX_FPS = 23
     MIN_DYN_RANGE = 40.
     CLIP_LOWP, CLIP_HIGHP = 40., 100
+    AUTOSCALE_TAU_S = 2.
+    AVERAGING_MODE = "boxcar" # or "ema"
+    VIEW_CACHE_MB = 32
+    VIEW_CACHE_LINES = 64 # waterfall lines remembered per view
+    VIEW_SWITCH_TIMEOUT_S = 1. # give up waiting for frames of a new view
     delta_low_db, delta_high_db = 0, 0
     low_clip_db, high_clip_db = -120, -60
     wf_min_db, wf_max_db = low_clip_db, low_clip_db+MIN_DYN_RANGE
     kiwi_wf_timestamp = None
     wf_buffer_len = 3
+    WF_PYRAMID_LEVELS = 8 # up to 256x time decimation
+    WF_PYRAMID_POOLING = "max" # or "mean"
     
-    def __init__(self, host_, port_, pass_, zoom_, freq_, eibi, disp):
+    def __init__(self, host_, port_, pass_, zoom_, freq_, eibi, disp, compression_=False):
         self.eibi = eibi
         self.host = host_
         self.port = port_
@@ -215,13 +763,27 @@ class kiwi_waterfall():
         self.zoom = zoom_
         self.freq = freq_
         self.averaging_n = 1
+        self.scope_averaging_n = None # None: the scope follows averaging_n
         self.wf_auto_scaling = True
+        self.level_tracker = wf_level_tracker(self.CLIP_LOWP/100., self.CLIP_HIGHP/100., self.AUTOSCALE_TAU_S)
         self.BINS2PIXEL_RATIO = disp.DISPLAY_WIDTH / self.WF_BINS
 
         self.old_averaging_n = self.averaging_n
         self.dynamic_range = self.MIN_DYN_RANGE
         
         self.wf_white_flag = False
+        # IMA-ADPCM W/F frames (wf_comp=1), about half the bytes on the wire
+        self.compression = compression_
+        self.wf_decoder = ImaAdpcmDecoder()
+        self.transport = transport_meter()
+        self.wf_header = struct.Struct('<II') # x_bin, flags|zoom after "W/F" + 1 byte
+        # view (zoom, start counter) the received frames belong to
+        self.view_cache = spectrum_view_cache(self.VIEW_CACHE_MB*2**20)
+        self.view_key = None
+        self.view_lines = 0
+        self.view_requested = False
+        self.view_wait = None
+        self.stale_frames = 0
         self.terminate = False
         self.run_index = 0
 
@@ -287,10 +849,35 @@ class kiwi_waterfall():
                     self.MAX_FPS = int(els[2].split("=")[1])
                 
         self.bins_per_khz = self.WF_BINS / self.span_khz
-        self.wf_data = np.zeros((disp.WF_HEIGHT, self.WF_BINS))
-        self.wf_data_tmp = deque([], self.wf_buffer_len)
-
-        self.avg_spectrum_deque = deque([], self.averaging_n)
+        self.wf_history = wf_ring_buffer(disp.WF_HEIGHT, self.WF_BINS, np.float32)
+        self.wf_pyramid = wf_pyramid(self.wf_history, self.WF_PYRAMID_LEVELS, self.WF_PYRAMID_POOLING)
+        # every line that enters the history, for the GUI, recorders, detectors...
+        self.frame_bus = frame_bus(self.WF_BINS)
+        self._init_buffers()
+
+        self.averager = spectrum_averager(self.WF_BINS, self.AVERAGING_MODE)
+        self.averager.set_depth("wf", self.averaging_n)
+        self.averager.set_depth("scope", self.averaging_n)
+        self.spectrum = None
+        self.scope_spectrum = None
+        self.view_key = (self.zoom, self.counter)
+        self.governor = wf_rate_governor(self.MAX_FPS)
+        self.decim_count = 0
+
+    def _init_buffers(self):
+        # fixed W/F pipeline: every stage writes into these, so the steady state
+        # receive -> average -> scale path allocates no arrays
+        self.wf_db = np.zeros(self.WF_BINS, dtype=np.float32)
+        self.wf_color = np.zeros(self.WF_BINS, dtype=np.float32)
+        # decompressed W/F bins, when compression is on
+        self.wf_comp_buffer = np.zeros(self.WF_BINS, dtype=np.uint8)
+        # display delay line, wf_buffer_len lines deep
+        self.wf_delay = np.zeros((self.wf_buffer_len, self.WF_BINS), dtype=np.float32)
+
+    def history(self):
+        # copies the whole history, newest line first, on every call;
+        # per line consumers should use wf_history.latest()/slices() instead
+        return self.wf_history.newest()
 
     def gen_div(self):
         self.space_khz = 10
@@ -333,7 +920,7 @@ class kiwi_waterfall():
         if self.wf_stream:
             print ("Waterfall data stream active...")
         msg_list = ['SET auth t=kiwi p=%s ipl=%s'%(self.password, self.password), 'SET zoom=%d start=%d'%(self.zoom,self.counter),\
-        'SET maxdb=-10 mindb=-110', 'SET wf_speed=4', 'SET wf_comp=0', "SET interp=13"]
+        'SET maxdb=-10 mindb=-110', 'SET wf_speed=4', 'SET wf_comp=%d' % self.compression, "SET interp=13"]
         for msg in msg_list:
             self.wf_stream.send_message(msg)
         print ("Starting to retrieve waterfall data...")
@@ -373,9 +960,32 @@ class kiwi_waterfall():
         try:
             msg = self.wf_stream.receive_message()
             if msg and bytearray2str(msg[0:3]) == "W/F":
-                msg = msg[16:]
-                self.spectrum = np.ndarray(len(msg), dtype='B', buffer=msg).astype(np.float32)
+                if self.view_requested:
+                    self.switch_view()
+                if self.view_wait:
+                    # frames already in flight for the previous view are dropped
+                    x_bin, flags_zoom = self.wf_header.unpack_from(msg, 4)
+                    key, deadline = self.view_wait
+                    if (flags_zoom & 0xffff, x_bin) == key or time.monotonic() > deadline:
+                        self.view_wait = None
+                    else:
+                        self.stale_frames += 1
+                        return False
+                if self.compression:
+                    # each W/F frame is encoded from a fresh decoder state
+                    self.wf_decoder.reset()
+                    samples = self.wf_decoder.decode_block(memoryview(msg)[16:])
+                    samples = samples[:len(samples)-10] # remove decompression tail
+                    n = min(len(samples), self.WF_BINS)
+                    np.clip(samples[:n], 0, 255, out=samples[:n])
+                    np.copyto(self.wf_comp_buffer[:n], samples[:n], casting="unsafe")
+                    self.spectrum_raw = self.wf_comp_buffer
+                else:
+                    # zero copy view of the bins after the 16 byte W/F header
+                    self.spectrum_raw = np.frombuffer(msg, dtype=np.uint8, offset=16)
+                self.transport.add(len(msg), 16 + len(self.spectrum_raw))
                 self.keepalive()
+                return True
         except BadOperationException as e:
             # Handle connection closing gracefully
             print(f"KiwiSDR waterfall connection closed: {e}")
@@ -383,30 +993,51 @@ class kiwi_waterfall():
         except Exception as e:
             print(f"Error receiving spectrum: {e}")
             self.terminate = True
+        return False
+
+    def switch_view(self):
+        # runs in the waterfall thread: remember the view we leave and replay
+        # what we remember of the new one until its own frames arrive
+        self.view_requested = False
+        new_key = (self.zoom, self.counter)
+        if self.view_key and self.view_lines and self.scope_spectrum is not None:
+            lines = self.wf_history.newest(min(self.view_lines, self.VIEW_CACHE_LINES))
+            self.view_cache.put(self.view_key, self.scope_spectrum, lines)
+        self.view_key = new_key
+        self.view_lines = 0
+        self.view_wait = (new_key, time.monotonic() + self.VIEW_SWITCH_TIMEOUT_S)
+        # lines still in the display delay belong to the old view
+        self.run_index = 0
+        entry = self.view_cache.get(new_key)
+        if entry:
+            spectrum, lines = entry
+            for line in lines[::-1]:
+                self.frame_bus.publish(line, spectrum, self.start_f_khz, self.zoom, self.averaging_n, cached=True)
 
     def spectrum_db2col(self):
-        wf = self.spectrum
-        wf = -(255 - wf)
-        wf_db = wf - 13 + (3*self.zoom)
+        # raw bins are dB+255, wf_db = raw - 255 - 13 + 3*zoom
+        db_offset = -255 - 13 + (3*self.zoom)
+        wf_db = self.wf_db
+        np.add(self.spectrum, db_offset, out=wf_db)
         wf_db[0] = wf_db[1]
         
         if self.wf_auto_scaling:
-            self.low_clip_db = np.percentile(wf_db, self.CLIP_LOWP)
-            self.high_clip_db = np.percentile(wf_db, self.CLIP_HIGHP)
+            # tracker works on the raw byte scale, wf_db is just an offset of it
+            low_raw, high_raw = self.level_tracker.update(self.spectrum[1:])
+            self.low_clip_db = low_raw + db_offset
+            self.high_clip_db = high_raw + db_offset
             self.dynamic_range = max(self.high_clip_db - self.low_clip_db, self.MIN_DYN_RANGE)
 
-        wf_color_db = (wf_db - (self.low_clip_db+self.delta_low_db))
         normal_factor_db = self.dynamic_range + self.delta_high_db
-        self.wf_color = wf_color_db / (normal_factor_db-self.delta_low_db)
-
-        self.wf_color = np.clip(self.wf_color, 0.0, 1.0)
+        wf_color = self.wf_color
+        np.subtract(wf_db, self.low_clip_db+self.delta_low_db, out=wf_color)
+        wf_color *= 1. / (normal_factor_db-self.delta_low_db)
+        np.clip(wf_color, 0.0, 1.0, out=wf_color)
+        wf_color *= 254
 
         self.wf_min_db = self.low_clip_db + self.delta_low_db - (3*self.zoom)
         self.wf_max_db = self.low_clip_db + normal_factor_db - (3*self.zoom)
 
-        self.wf_color *= 254
-        self.wf_color = np.clip(self.wf_color, 0, 255)
-
     def set_freq_zoom(self, freq_, zoom_):
         self.freq = freq_
         self.zoom = zoom_
@@ -432,6 +1063,9 @@ class kiwi_waterfall():
         self.counter, actual_freq = self.start_frequency_to_counter(self.start_f_khz)
         msg = "SET zoom=%d start=%d" % (self.zoom, self.counter)
         self.wf_stream.send_message(msg)
+        self.level_tracker.reset()
+        self.averager.reset()
+        self.view_requested = True
         self.eibi.get_stations(self.start_f_khz, self.end_f_khz)
         self.bins_per_khz = self.WF_BINS / self.span_khz
         self.gen_div()
@@ -451,48 +1085,556 @@ class kiwi_waterfall():
             print ("exception: %s" % e)
 
     def change_passband(self, delta_low_, delta_high_):
-        lc_ = 0
-        hc_ = 0
-        if self.radio_mode == "USB":
-            lc_ = LOW_CUT_SSB+delta_low_
-            hc_ = HIGH_CUT_SSB+delta_high_
-        elif self.radio_mode == "LSB":
-            lc_ = -HIGH_CUT_SSB-delta_high_
-            hc_ = -LOW_CUT_SSB-delta_low_
-        elif self.radio_mode == "AM" or self.radio_mode == "NFM":
-            lc_ = -HIGHLOW_CUT_AM-delta_low_
-            hc_ = HIGHLOW_CUT_AM+delta_high_
-        elif self.radio_mode == "CW":
-            lc_ = LOW_CUT_CW+delta_low_
-            hc_ = HIGH_CUT_CW+delta_high_
+        lc_, hc_ = default_passband(self.radio_mode, delta_low_, delta_high_)
         self.lc, self.hc = lc_, hc_
         return lc_, hc_
 
+
     def set_white_flag(self):
-        self.wf_color = np.ones_like(self.wf_color)*255
-        self.wf_data[0,:] = self.wf_color
+        self.wf_history.latest()[:] = 255
 
     def run(self):
         while not self.terminate:
-            if self.averaging_n>1:
-                self.avg_spectrum_deque = deque([], self.averaging_n)
-                for avg_idx in range(self.averaging_n):
-                    self.receive_spectrum()
-                    self.avg_spectrum_deque.append(self.spectrum)
-                self.spectrum = np.mean(self.avg_spectrum_deque, axis=0)
-            else:
-                self.receive_spectrum()
+            if not self.receive_spectrum():
+                continue
+            scope_n = self.scope_averaging_n or self.averaging_n
+            if self.averaging_n != self.old_averaging_n or scope_n != self.averager.depths["scope"]:
+                self.old_averaging_n = self.averaging_n
+                self.averager.set_depth("wf", self.averaging_n)
+                self.averager.set_depth("scope", scope_n)
+            if self.governor.frame(self.averaging_n):
+                self.wf_stream.send_message("SET wf_speed=%d" % self.governor.speed)
+            # every frame feeds the averages, lines nobody uses are not scaled
+            self.averager.push(self.spectrum_raw)
+            self.decim_count += 1
+            if not self.governor.decimation or self.decim_count % self.governor.decimation:
+                continue
+            # one averaged line out for every frame in, whatever the depth
+            self.spectrum = self.averager.mean("wf")
+            self.scope_spectrum = self.averager.mean("scope")
             self.run_index += 1
 
             self.spectrum_db2col()
-            self.wf_data_tmp.appendleft(self.wf_color)
-
-            if len(self.wf_data_tmp) > 0 and self.run_index > self.wf_buffer_len:
-                self.wf_data[1:,:] = self.wf_data[0:-1,:]
-                self.wf_data[0,:] = self.wf_data_tmp.pop()
+            # lines reach the history wf_buffer_len frames late, oldest slot first
+            slot = self.run_index % self.wf_buffer_len
+            if self.run_index > self.wf_buffer_len:
+                self.wf_pyramid.append(self.wf_delay[slot])
+                self.view_lines += 1
+                self.frame_bus.publish(self.wf_delay[slot], self.scope_spectrum, self.start_f_khz, self.zoom, self.averaging_n)
+            self.wf_delay[slot] = self.wf_color
         return
 
 
+class polyphase_resampler():
+    # Streaming rational resampler from rate_in to rate_out. The anti-alias FIR
+    # is the one scipy.signal.resample_poly would design for these rates, built
+    # once and split in `up` polyphase branches; the last input samples are kept
+    # between calls, so consecutive frames join without edge transients. For
+    # each (frame length, phase) the gather indices and per output coefficients
+    # are computed once and reused. The filter is causal: half_len/down output
+    # samples of delay (1 ms at 12 kHz -> 48 kHz) instead of zero phase.
+    MAX_PLANS = 64
+
+    def __init__(self, rate_in, rate_out):
+        g = math.gcd(int(rate_in), int(rate_out))
+        self.up, self.down = int(rate_out) // g, int(rate_in) // g
+        max_rate = max(self.up, self.down)
+        self.half_len = 10 * max_rate
+        h = firwin(2 * self.half_len + 1, 1. / max_rate, window=('kaiser', 5.0)) * self.up
+        self.n_hist = -(-len(h) // self.up) # input samples under the filter
+        self.taps = np.zeros(self.n_hist * self.up, dtype=np.float32)
+        self.taps[:len(h)] = h
+        self.buffer = np.zeros(self.n_hist - 1, dtype=np.float32)
+        # upsampled time of the next output, relative to the next input frame
+        self.offset = 0
+        self.plans = {}
+
+    def delay(self):
+        # output samples between an input sample and its filtered image
+        return self.half_len / self.down
+
+    def _plan(self, n, offset):
+        plan = self.plans.get((n, offset))
+        if plan is not None:
+            return plan
+        if len(self.plans) >= self.MAX_PLANS:
+            self.plans.clear()
+        last_t = n * self.up - 1
+        n_out = max(0, (last_t - offset) // self.down + 1)
+        t = offset + self.down * np.arange(n_out)
+        k = np.arange(self.n_hist)
+        # y[j] = sum_k x[t_j//up - k] * h[t_j%up + k*up], x indexed in the buffer
+        # that starts with the n_hist-1 samples kept from the previous frame
+        idx = (t // self.up)[:, None] - k[None, :] + self.n_hist - 1
+        coefs = self.taps[(t % self.up)[:, None] + k[None, :] * self.up]
+        gathered = np.zeros(idx.shape, dtype=np.float32)
+        out = np.zeros(n_out, dtype=np.float32)
+        next_offset = offset + n_out * self.down - n * self.up
+        plan = (idx, coefs, gathered, out, next_offset)
+        self.plans[(n, offset)] = plan
+        return plan
+
+    def process(self, samples):
+        # returns a buffer owned by the resampler, valid until the next call
+        n = len(samples)
+        if len(self.buffer) != self.n_hist - 1 + n:
+            buffer = np.zeros(self.n_hist - 1 + n, dtype=np.float32)
+            buffer[:self.n_hist - 1] = self.buffer[:self.n_hist - 1]
+            self.buffer = buffer
+        self.buffer[self.n_hist - 1:] = samples
+        idx, coefs, gathered, out, next_offset = self._plan(n, self.offset)
+        # indices are always in range; mode='raise' would buffer a copy of out
+        np.take(self.buffer, idx, out=gathered, mode='clip')
+        np.einsum('jk,jk->j', gathered, coefs, out=out)
+        self.offset = next_offset
+        # keep the newest samples for the next frame
+        self.buffer[:self.n_hist - 1] = self.buffer[n:]
+        return out
+
+class audio_ring():
+    # Single producer / single consumer sample ring between kiwi_sound.run and
+    # the sound card callback. write_pos and read_pos only grow and each one is
+    # only stored by its own side, after the samples are in (or out of) the
+    # buffer, so the realtime callback never takes a lock. The callback always
+    # gets exactly `frames` samples, whatever is left of a chunk stays for the
+    # next call. It plays silence until `target` samples are buffered (again
+    # after an underrun) and skips back to the target when far more than that
+    # piles up, so the latency stays around the target.
+    def __init__(self, target, channels, dtype=np.int16, capacity=None):
+        self.capacity = int(capacity or 4 * target)
+        self.buffer = np.zeros((self.capacity, channels), dtype=dtype)
+        self.channels = channels
+        self.write_pos = 0
+        self.read_pos = 0
+        self.burst = 0 # largest single write, the producer side jitter
+        self.primed = False
+        self.underruns = 0
+        self.overruns = 0
+        self.skipped = 0 # samples thrown away to hold the latency
+        self.set_target(target)
+        # the very first start only needs start_fill samples, refills after
+        # an underrun wait for the whole target
+        self.start_fill = self.target
+        self.first_audio_t = None
+        # set by the producer once notify_fill samples are buffered
+        self.filled = threading.Event()
+        self.notify_fill = None
+        self.closed = False
+
+    def set_target(self, target):
+        self.target = min(max(1, int(target)), self.capacity // 3)
+
+    def fill(self):
+        return self.write_pos - self.read_pos
+
+    def segments(self, pos, n):
+        # the (at most two) buffer views holding samples [pos, pos + n)
+        start = pos % self.capacity
+        first = min(n, self.capacity - start)
+        if first == n:
+            return (self.buffer[start:start + n],)
+        return (self.buffer[start:], self.buffer[:n - first])
+
+    def write(self, samples):
+        # mono samples in, cast once and copied to every channel; returns how
+        # many were stored, the rest is dropped when the ring is full
+        pos = self.write_pos
+        n = len(samples)
+        self.burst = max(self.burst, n)
+        free = self.capacity - (pos - self.read_pos)
+        if n > free:
+            self.overruns += 1
+            n = free
+        done = 0
+        for seg in self.segments(pos, n):
+            m = len(seg)
+            np.copyto(seg[:, 0], samples[done:done + m], casting='unsafe')
+            for ch in range(1, self.channels):
+                seg[:, ch] = seg[:, 0]
+            done += m
+        self.write_pos = pos + n
+        if self.notify_fill is not None and self.write_pos - self.read_pos >= self.notify_fill:
+            self.filled.set()
+        return n
+
+    def wait_fill(self, n, timeout=None):
+        # block until n samples are buffered, the producer is gone or timeout
+        self.notify_fill = n
+        self.filled.clear()
+        if self.fill() < n and not self.closed:
+            self.filled.wait(timeout)
+        self.notify_fill = None
+        return self.fill() >= n
+
+    def close(self):
+        # no more writes, wakes up wait_fill
+        self.closed = True
+        self.filled.set()
+
+    def read(self, out):
+        frames = len(out)
+        fill = self.write_pos - self.read_pos
+        if not self.primed:
+            if fill < (self.target if self.underruns else min(self.start_fill, self.target)):
+                out[:] = 0
+                return 0
+            self.primed = True
+            if self.first_audio_t is None:
+                self.first_audio_t = time.monotonic()
+        if fill > self.target + max(self.target, frames + self.burst):
+            skip = fill - self.target
+            self.read_pos += skip
+            self.skipped += skip
+            self.overruns += 1
+            fill = self.target
+        n = min(frames, fill)
+        done = 0
+        for seg in self.segments(self.read_pos, n):
+            out[done:done + len(seg)] = seg
+            done += len(seg)
+        out[n:] = 0
+        self.read_pos += n
+        if n < frames:
+            self.underruns += 1
+            self.primed = False
+        return n
+
+class audio_latency():
+    # Follows SND packets from the socket to the sound card. The receive thread
+    # stamps each packet (seq, arrival time) with the ring position its first
+    # sample went to; the callback turns the stamps it plays into the network
+    # to speaker latency (arrival to DAC output time of that sample) and the
+    # queue residence (written to the ring to read by the callback), counted in
+    # BIN_MS histograms, the last bin holds everything above MAX_MS. The stamps
+    # are a preallocated single producer / single consumer ring like
+    # audio_ring, nothing is allocated in the callback.
+    BIN_MS = 5
+    MAX_MS = 2000
+    STAMPS = 256
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.pos = np.zeros(self.STAMPS, dtype=np.int64)
+        self.seq = np.zeros(self.STAMPS, dtype=np.int64)
+        self.arrival_t = np.zeros(self.STAMPS, dtype=np.float64)
+        self.queued_t = np.zeros(self.STAMPS, dtype=np.float64)
+        self.stamp_write = 0
+        self.stamp_read = 0
+        self.reset()
+
+    def reset(self):
+        n_bins = self.MAX_MS // self.BIN_MS + 1
+        self.speaker = np.zeros(n_bins, dtype=np.int64)
+        self.residence = np.zeros(n_bins, dtype=np.int64)
+        self.last_seq = None
+        self.lost = 0 # seq numbers never seen
+        self.skipped = 0 # packets dropped by the ring before being played
+        self.speaker_ms = self.residence_ms = 0.
+
+    def stamp(self, seq, arrival_t, pos):
+        i = self.stamp_write
+        if i - self.stamp_read >= self.STAMPS:
+            return # no callback running
+        k = i % self.STAMPS
+        self.pos[k] = pos
+        self.seq[k] = seq
+        self.arrival_t[k] = arrival_t
+        self.queued_t[k] = time.monotonic()
+        self.stamp_write = i + 1
+
+    def played(self, start, n, read_t, dac_t):
+        # ring samples [start, start + n) read at read_t, the first one leaves
+        # the DAC at dac_t
+        i = self.stamp_read
+        end = start + n
+        last_bin = len(self.speaker) - 1
+        while i < self.stamp_write:
+            k = i % self.STAMPS
+            pos = self.pos[k]
+            if pos >= end:
+                break
+            if pos < start:
+                self.skipped += 1
+            else:
+                self.speaker_ms = 1000. * (dac_t + (pos - start) / self.rate - self.arrival_t[k])
+                self.residence_ms = 1000. * (read_t - self.queued_t[k])
+                self.speaker[min(max(int(self.speaker_ms) // self.BIN_MS, 0), last_bin)] += 1
+                self.residence[min(max(int(self.residence_ms) // self.BIN_MS, 0), last_bin)] += 1
+            seq = int(self.seq[k])
+            if self.last_seq is not None and seq > self.last_seq + 1:
+                self.lost += seq - self.last_seq - 1
+            self.last_seq = seq
+            i += 1
+        self.stamp_read = i
+
+    def percentile(self, hist, q):
+        # upper edge of the bin holding the q-th percentile, ms
+        total = hist.sum()
+        if not total:
+            return None
+        return (int(np.searchsorted(np.cumsum(hist), q / 100. * total)) + 1) * self.BIN_MS
+
+    def export(self, path):
+        with open(path, "w") as f:
+            f.write("bin_ms,network_to_speaker,queue_residence\n")
+            for i, (a, b) in enumerate(zip(self.speaker, self.residence)):
+                f.write("%d,%d,%d\n" % (i * self.BIN_MS, a, b))
+        return path
+
+class fractional_resampler():
+    # Streaming 4 point cubic (Catmull-Rom) interpolation by a ratio close to 1
+    # that may change on every call, for clock drift and latency corrections of
+    # a few per mille. The last 3 input samples and the fractional read position
+    # carry over, so frames join without clicks; output lags by 2 samples.
+    HISTORY = 3
+
+    def __init__(self, size=4096):
+        self.hist = np.zeros(self.HISTORY, dtype=np.float32)
+        self.phase = 0. # position of the next output, in input samples past hist[0]
+        self._alloc(size)
+
+    def _alloc(self, size):
+        self.x = np.zeros(size + self.HISTORY, dtype=np.float32)
+        # ratios are clamped to 0.5..2, at 2 (upsampling) two outputs per input
+        n_out = 2 * size + 2
+        self.ramp = np.arange(n_out, dtype=np.float64)
+        self.pos = np.zeros(n_out, dtype=np.float64)
+        self.floor = np.zeros(n_out, dtype=np.float64)
+        self.idx = np.zeros(n_out, dtype=np.intp)
+        self.frac = np.zeros(n_out, dtype=np.float32)
+        self.taps = np.zeros((5, n_out), dtype=np.float32)
+        self.out = np.zeros(n_out, dtype=np.float32)
+
+    def process(self, samples, ratio):
+        # returns a buffer owned by the resampler, valid until the next call
+        n = len(samples)
+        if n + self.HISTORY > len(self.x):
+            self._alloc(n)
+        x = self.x[:n + self.HISTORY]
+        x[:self.HISTORY] = self.hist
+        x[self.HISTORY:] = samples
+        step = 1. / min(max(ratio, 0.5), 2.)
+        n_out = max(0, int(math.ceil((n - self.phase) / step)))
+        pos = self.pos[:n_out]
+        np.multiply(self.ramp[:n_out], step, out=pos)
+        pos += self.phase
+        idx, f, fl = self.idx[:n_out], self.frac[:n_out], self.floor[:n_out]
+        # float only ufuncs, mixed int/float ones allocate casting buffers
+        np.floor(pos, out=fl)
+        np.copyto(idx, fl, casting='unsafe')
+        np.subtract(pos, fl, out=pos)
+        np.copyto(f, pos, casting='same_kind')
+        x0, x1, x2, x3, c = self.taps[:, :n_out]
+        for k, tap in enumerate((x0, x1, x2, x3)):
+            np.take(x[k:], idx, out=tap, mode='clip')
+
+        # y = ((c3*f + c2)*f + c1)*f + x1, in place
+        y = self.out[:n_out]
+        np.subtract(x3, x0, out=y)
+        y *= 0.5
+        np.subtract(x1, x2, out=c)
+        c *= 1.5
+        y += c # c3
+        y *= f
+        np.multiply(x1, -2.5, out=c)
+        c += x0
+        c += x2
+        c += x2
+        x3 *= 0.5
+        c -= x3 # c2
+        y += c
+        y *= f
+        np.subtract(x2, x0, out=c)
+        c *= 0.5 # c1
+        y += c
+        y *= f
+        y += x1
+
+        self.phase += n_out * step - n
+        self.hist[:] = x[-self.HISTORY:]
+        return y
+
+class jitter_buffer():
+    # Playout control of an audio_ring. Every packet arrival updates the RFC 3550
+    # interarrival jitter and a slowly decaying peak of the late gaps, and with
+    # `adaptive` the target latency follows them: enough for the peak gap, the
+    # jitter, one packet and one device block, within [min_s, max_s]. It grows
+    # at once (and on every underrun) but shrinks only as fast as the playout
+    # correction can drain the ring, so lowering it never skips audio.
+    # The buffered time is held at the target by the ratio for a
+    # fractional_resampler: the Kiwi clock offset (KIWI_RATE_TRUE) as feed
+    # forward, times a proportional correction on the smoothed fill error,
+    # limited to MAX_CORRECTION (5 per mille, below audible pitch change).
+    JITTER_GAIN = 1/16.
+    PEAK_TAU_S = 300.
+    FILL_TAU_S = 2.
+    HORIZON_S = 10. # time to correct a fill error at the proportional rate
+    MAX_CORRECTION = 0.005
+    PEAK_MARGIN, JITTER_MARGIN = 1., 3.
+
+    def __init__(self, ring, rate, drift=1., block_s=0., min_s=0.1, max_s=2., adaptive=True):
+        self.ring = ring
+        self.rate = rate
+        self.drift = drift # output/input ratio making up for the Kiwi clock
+        self.block_s = block_s
+        self.min_s, self.max_s = min_s, max_s
+        self.adaptive = adaptive
+        self.target_s = ring.target / rate
+        self.jitter_s = 0.
+        self.peak_s = 0.
+        self.fill_s = None
+        self.ratio = drift
+        self.last_arrival = None
+        self.underruns = ring.underruns
+
+    def arrival(self, now, frame_s):
+        # call on every packet before writing it, returns the ratio to play it at
+        if self.last_arrival is not None:
+            dt = now - self.last_arrival
+            d = dt - frame_s
+            self.jitter_s += (abs(d) - self.jitter_s) * self.JITTER_GAIN
+            self.peak_s = max(self.peak_s * math.exp(-dt / self.PEAK_TAU_S), d)
+            fill_s = self.ring.fill() / self.rate
+            if self.fill_s is None:
+                self.fill_s = fill_s
+            else:
+                self.fill_s += (fill_s - self.fill_s) * (1 - math.exp(-dt / self.FILL_TAU_S))
+            if self.adaptive:
+                self._adapt(dt, frame_s)
+            correction = (self.target_s - self.fill_s) / self.HORIZON_S
+            correction = min(max(correction, -self.MAX_CORRECTION), self.MAX_CORRECTION)
+            self.ratio = self.drift * (1 + correction)
+        self.last_arrival = now
+        return self.ratio
+
+    def _adapt(self, dt, frame_s):
+        if self.ring.underruns != self.underruns:
+            # the link is worse than it looked, go past the current target
+            self.underruns = self.ring.underruns
+            self.peak_s = max(self.peak_s, self.target_s)
+        want = self.PEAK_MARGIN*self.peak_s + self.JITTER_MARGIN*self.jitter_s + frame_s + self.block_s
+        want = min(max(want, self.min_s), self.max_s)
+        if want >= self.target_s:
+            self.target_s = want
+        else:
+            self.target_s = max(want, self.target_s - 0.5*self.MAX_CORRECTION*dt)
+        self.ring.set_target(self.target_s * self.rate)
+        self.target_s = self.ring.target / self.rate
+
+class iq_channelizer():
+    # Frequency shift, filter and decimate channelizer for a Kiwi IQ stream,
+    # all channels at once as rows of one matrix. Each channel is mixed down
+    # by its own phase continuous oscillator row, band limited by its own
+    # complex FIR with the lc..hc passband around its carrier (as the Kiwi
+    # filters it), by overlap-save FFT convolution of the whole matrix, then
+    # every `decim`-th sample is kept and demodulated: USB/LSB/CW take the real
+    # part, AM the envelope minus its DC and NFM the phase difference. A per
+    # channel AGC (fast attack, DECAY_S release) levels them for the mixer;
+    # levels below AGC_FLOOR, about the int16 noise of an empty channel, are
+    # not raised further, so the gain stops at AGC_TARGET/AGC_FLOOR.
+    N_TAPS = 129
+    MODES = ("USB", "LSB", "CW", "AM", "NFM")
+    AGC_TARGET = 8000.
+    AGC_FLOOR = 300.
+    AGC_DECAY_S = 1.
+    NFM_SCALE = 32767. / math.pi # phase step of +-pi per sample to int16 full scale
+
+    def __init__(self, rate, decim=1):
+        self.rate = rate
+        self.decim = decim
+        self.set_channels([])
+
+    @property
+    def channels(self):
+        return self.bank.channels
+
+    def set_channels(self, channels, tags=None):
+        # channels: (offset_hz, mode, lc, hc) per output row, restarts the
+        # state; tags (e.g. the receivers the rows play to) travel with it
+        for offset, mode, lc, hc in channels:
+            if mode not in self.MODES:
+                raise ValueError("no local %s demodulator" % mode)
+        # built whole, then published with one assignment: the SND thread
+        # keeps processing the previous bank until its next frame
+        self.bank = iq_channel_bank(channels, self.rate, self.N_TAPS, self.AGC_FLOOR, tags)
+
+    def process(self, iq, bank=None):
+        # iq: interleaved I/Q samples, returns (channels, samples) float32
+        # audio; bank: the one read by the caller, by default the current one
+        bank = self.bank if bank is None else bank
+        n = len(iq) // 2
+        n_ch = len(bank.channels)
+        n, nfft, osc, step, h_f, mixed, x = bank.get_plan(n, self.rate, self.N_TAPS)
+        x.real = iq[0:2*n:2]
+        x.imag = iq[1:2*n:2]
+        head = self.N_TAPS - 1
+        mixed[:, :head] = bank.hist
+        body = mixed[:, head:]
+        np.multiply(osc, x[None, :], out=body)
+        body *= bank.phase.astype(np.complex64)[:, None]
+        bank.phase *= step
+        bank.phase /= np.abs(bank.phase)
+        bank.hist[:] = mixed[:, -head:]
+
+        # overlap-save: the first N_TAPS-1 outputs wrap around, the rest are exact
+        y = np.fft.ifft(np.fft.fft(mixed, nfft, axis=1) * h_f, axis=1)[:, head:head + n]
+        y = y[:, bank.dec_phase::self.decim]
+        bank.dec_phase = (bank.dec_phase - n) % self.decim
+
+        audio = y.real.astype(np.float32)
+        rows = bank.rows["AM"]
+        if len(rows):
+            env = np.abs(y[rows]).astype(np.float32)
+            bank.dc[rows] += 0.1 * (env.mean(axis=1) - bank.dc[rows])
+            audio[rows] = env - bank.dc[rows, None]
+        rows = bank.rows["NFM"]
+        if len(rows):
+            z = y[rows].astype(np.complex64)
+            prev = np.concatenate((bank.last[rows, None], z[:, :-1]), axis=1)
+            bank.last[rows] = z[:, -1]
+            audio[rows] = np.angle(z * np.conj(prev)) * self.NFM_SCALE
+
+        if n_ch and audio.shape[1]:
+            peak = np.abs(audio).max(axis=1)
+            decay = math.exp(-audio.shape[1] / (self.rate / self.decim) / self.AGC_DECAY_S)
+            bank.agc_level = np.maximum(peak, np.maximum(bank.agc_level * decay, self.AGC_FLOOR))
+            audio *= (self.AGC_TARGET / bank.agc_level)[:, None]
+        return audio
+
+class iq_channel_bank():
+    # Taps, oscillators and filter/demodulator/AGC state of one iq_channelizer
+    # channel list. Only the thread calling process() changes it once built.
+    def __init__(self, channels, rate, n_taps, agc_floor, tags=None):
+        self.channels = list(channels)
+        self.tags = list(tags) if tags is not None else []
+        n_ch = len(channels)
+        t = np.arange(n_taps) - (n_taps - 1) / 2.
+        self.taps = np.zeros((n_ch, n_taps), dtype=np.complex64)
+        for i, (offset, mode, lc, hc) in enumerate(channels):
+            half = max((hc - lc) / 2., 50.)
+            self.taps[i] = firwin(n_taps, half, fs=rate) * np.exp(2j*np.pi*(lc + hc)/2.*t/rate)
+        self.offsets = np.array([c[0] for c in channels], dtype=np.float64)
+        self.phase = np.ones(n_ch, dtype=np.complex128)
+        self.hist = np.zeros((n_ch, n_taps - 1), dtype=np.complex64)
+        self.rows = {mode: np.array([i for i, c in enumerate(channels) if c[1] == mode], dtype=np.intp)
+                     for mode in iq_channelizer.MODES}
+        self.dc = np.zeros(n_ch, dtype=np.float32)
+        self.last = np.ones(n_ch, dtype=np.complex64)
+        self.agc_level = np.full(n_ch, agc_floor, dtype=np.float32)
+        self.dec_phase = 0
+        self.plan = None
+
+    def get_plan(self, n, rate, n_taps):
+        if self.plan is None or self.plan[0] != n:
+            nfft = 1 << (n + n_taps - 2).bit_length()
+            k = np.arange(n)
+            osc = np.exp(-2j*np.pi*self.offsets[:, None]*k[None, :]/rate).astype(np.complex64)
+            step = np.exp(-2j*np.pi*self.offsets*n/rate)
+            h_f = np.fft.fft(self.taps, nfft, axis=1)
+            mixed = np.zeros((len(self.channels), n_taps - 1 + n), dtype=np.complex64)
+            self.plan = (n, nfft, osc, step, h_f, mixed, np.zeros(n, dtype=np.complex64))
+        return self.plan
+
 class kiwi_sound():
     FORMAT = np.int16
     CHANNELS = 2
@@ -501,16 +1643,28 @@ class kiwi_sound():
     SAMPLE_RATIO = int(AUDIO_RATE/KIWI_RATE)
     CHUNKS = 1
     KIWI_SAMPLES_PER_FRAME = 512
-
-    def __init__(self, freq_, mode_, lc_, hc_, password_, kiwi_wf, buffer_len, volume_=100, host_=None, port_=None, subrx_=False):
+    # adaptive playout latency range, unless a fixed latency is given
+    MIN_LATENCY_S, MAX_LATENCY_S = 0.1, 2.
+    # audio starts as soon as this much is buffered, then builds up to the latency
+    PREFILL_S = 0.1
+    PREFILL_TIMEOUT_S = 10.
+    # IQ mode passband, the local channels must fit inside it
+    IQ_HALF_BW = 5000
+
+    def __init__(self, freq_, mode_, lc_, hc_, password_, kiwi_wf, buffer_len, volume_=100, host_=None, port_=None, subrx_=False, compression_=None, latency_s_=None, iq_=False):
+        self.created_t = time.monotonic() # time to first audio counts from here
         self.subrx = subrx_
         self.kiwi_wf = kiwi_wf
         self.host = host_ if host_ else kiwi_wf.host
         self.port = port_ if port_ else kiwi_wf.port
         self.FULL_BUFF_LEN = max(1, buffer_len)
-        self.audio_buffer = queue.Queue(maxsize = self.FULL_BUFF_LEN)
+        # playback latency target, buffer_len Kiwi frames unless given; only
+        # a given one stays fixed, otherwise it adapts to the link
+        self.latency_s = latency_s_ if latency_s_ else self.FULL_BUFF_LEN*self.KIWI_SAMPLES_PER_FRAME*self.CHUNKS/self.KIWI_RATE
+        self.adaptive_latency = not latency_s_
         self.terminate = False
         self.volume = volume_
+        self.mute = False # silenced in the mix, keeps volume
         self.max_rssi_before_mute = -20
         self.mute_counter = 0
         self.muting_delay = 15
@@ -536,6 +1690,19 @@ class kiwi_sound():
         self.decay = self.decay_other
         self.audio_balance = 0.0
         self.freq_offset = 0
+        # IMA-ADPCM audio, follows the waterfall setting unless given
+        self.compression = kiwi_wf.compression if compression_ is None else compression_
+        # IQ mode: one IQ stream, this receiver and any iq_channel demodulated
+        # locally by the channelizer (the Kiwi never compresses IQ)
+        self.iq_mode = iq_
+        self.iq_channels = []
+        if self.iq_mode:
+            self.compression = False
+        self.decoder = ImaAdpcmDecoder()
+        self.transport = transport_meter()
+        self.snd_header = struct.Struct('<BI') # flags, seq after "SND"
+        self.snd_smeter = struct.Struct('>H')
+        self.snd_f32 = np.zeros(self.KIWI_SAMPLES_PER_FRAME, dtype=np.float32)
 
         kiwi_sdr_status = kiwi_sdr(self.host, self.port)
         if kiwi_sdr_status.users == kiwi_sdr_status.users_max:
@@ -564,8 +1731,8 @@ class kiwi_sound():
             self.stream = Stream(request_snd, stream_option_snd)
             print ("Audio data stream active...")
             msg_list = ["SET auth t=kiwi p=%s ipl=%s" % (password_, password_),
-                        "SET mod=%s low_cut=%d high_cut=%d freq=%.3f" % (self.radio_mode.lower(), self.lc, self.hc, self.freq),
-                        "SET compression=0", "SET ident_user=SuperSDR","SET OVERRIDE inactivity_timeout=1000",
+                        self.mod_message(),
+                        "SET compression=%d" % self.compression, "SET ident_user=SuperSDR","SET OVERRIDE inactivity_timeout=1000",
                         "SET agc=%d hang=%d thresh=%d slope=%d decay=%d manGain=%d" % (self.on, self.hang, self.thresh, self.slope, self.decay, self.gain),
                         "SET AR OK in=%d out=%d" % (self.KIWI_RATE, self.AUDIO_RATE)]
             for msg in msg_list:
@@ -599,13 +1766,17 @@ class kiwi_sound():
         self.n_tap = self.kiwi_filter.n_tap
         self.lowpass = self.kiwi_filter.lowpass
         self.old_buffer = np.zeros((self.n_tap-1))
+        self.set_output_rate(self.AUDIO_RATE)
+        self.recorders = [] # (wav_writer, channel) this receiver records to
         self.audio_rec = audio_recording(self)
-        self.frames = []
+        self.channelizer = iq_channelizer(self.KIWI_RATE) if self.iq_mode else None
+        self.update_channels()
 
     def run(self):
         while not self.terminate:
             try:
                 msg = self.stream.receive_message()
+                now = time.monotonic()
             except BadOperationException as e:
                 print(f"KiwiSDR audio connection closed: {e}")
                 break
@@ -613,10 +1784,9 @@ class kiwi_sound():
                 print(f"Error receiving audio: {e}")
                 break
             
-            if msg and bytearray2str(msg[0:3]) == "SND":
-                flags,seq, = struct.unpack('<BI', buffer(msg[3:8]))
-                smeter,    = struct.unpack('>H',  buffer(msg[8:10]))
-                data       = msg[10:]
+            if msg and msg.startswith(b"SND"):
+                flags, seq = self.snd_header.unpack_from(msg, 3)
+                smeter, = self.snd_smeter.unpack_from(msg, 8)
                 self.rssi = 0.1*smeter - 127
                 
                 # Send keepalive every 100 messages (roughly every 2-3 seconds)
@@ -628,61 +1798,134 @@ class kiwi_sound():
                     except Exception as e:
                         print(f"Failed to send keepalive: {e}")
                 
-                count = len(data) // 2
-                samples = np.ndarray(count, dtype='>h', buffer=data).astype(np.float32)
-                
-                if self.KIWI_RATE != self.AUDIO_RATE:
-                    samples = resample_poly(samples, self.AUDIO_RATE, self.KIWI_RATE)
+                if self.iq_mode:
+                    # 10 bytes of GPS timestamp, then interleaved I/Q
+                    iq = np.frombuffer(msg, dtype='>i2', offset=20, count=(len(msg) - 20) // 2)
+                    self.transport.add(len(msg), len(msg))
+                    try:
+                        self.play_iq(iq, now, seq)
+                    except Exception as e:
+                        print(f"Error demodulating IQ audio: {e}")
+                    continue
+                if self.compression:
+                    # unlike W/F, the SND decoder state runs across frames
+                    pcm = self.decoder.decode_block(memoryview(msg)[10:])
+                else:
+                    pcm = np.frombuffer(msg, dtype='>i2', offset=10, count=(len(msg) - 10) // 2)
+                self.transport.add(len(msg), 10 + 2*len(pcm))
                 
-                self.frames.append(samples)
-                if len(self.frames) >= self.CHUNKS:
-                    chunk = np.concatenate(self.frames)
-                    self.frames = []
-                    
-                    if self.audio_rec.recording_flag:
-                        self.audio_rec.audio_buffer.append(chunk.astype(np.int16).tobytes())
-
-                    if self.CHANNELS == 2:
-                        chunk_stereo = np.column_stack((chunk, chunk))
-                        try:
-                            self.audio_buffer.put(chunk_stereo.astype(np.int16).tobytes(), block=False)
-                        except queue.Full:
-                            try:
-                                self.audio_buffer.get_nowait()
-                                self.audio_buffer.put(chunk_stereo.astype(np.int16).tobytes(), block=False)
-                            except:
-                                pass
-                    else:
-                        try:
-                            self.audio_buffer.put(chunk.astype(np.int16).tobytes(), block=False)
-                        except queue.Full:
-                             try:
-                                self.audio_buffer.get_nowait()
-                                self.audio_buffer.put(chunk.astype(np.int16).tobytes(), block=False)
-                             except:
-                                pass
-
-    def play_buffer(self, outdata, frames, time, status):
-        try:
-            data = self.audio_buffer.get_nowait()
-            audio_data = np.frombuffer(data, dtype=self.FORMAT)
-            
-            if self.CHANNELS == 2:
-                audio_data = audio_data.reshape(-1, 2)
-            
-            if len(audio_data) <= len(outdata):
-                outdata[:len(audio_data)] = audio_data
-                outdata[len(audio_data):] = 0
-            else:
-                outdata[:] = audio_data[:len(outdata)]
-        except queue.Empty:
-            outdata[:] = 0
-
-    def set_mode_freq_pb(self):
+                if len(self.snd_f32) < len(pcm):
+                    self.snd_f32 = np.zeros(len(pcm), dtype=np.float32)
+                samples = self.snd_f32[:len(pcm)]
+                np.copyto(samples, pcm)
+                if self.resampler:
+                    samples = self.resampler.process(samples)
+                ratio = self.jitter.arrival(now, len(pcm) / (self.KIWI_RATE + self.delta_t))
+                samples = self.drift_resampler.process(samples, ratio)
+                self.latency.stamp(seq, now, self.audio_ring.write_pos)
+                self.queue_samples(samples)
+        # wake up a start_audio_stream still waiting for the prefill
+        self.audio_ring.close()
+
+    def play_iq(self, iq, now, seq):
+        # the bank and its receivers are read once, set_channels may replace them
+        bank = self.channelizer.bank
+        audio = self.channelizer.process(iq, bank)
+        ratio = self.jitter.arrival(now, audio.shape[1] / (self.KIWI_RATE + self.delta_t))
+        samples = audio[0]
+        if self.resampler:
+            samples = self.resampler.process(samples)
+        self.latency.stamp(seq, now, self.audio_ring.write_pos)
+        self.queue_samples(self.drift_resampler.process(samples, ratio))
+        for channel, samples in zip(bank.tags[1:], audio[1:]):
+            channel.play(samples, ratio)
+
+    def update_channels(self):
+        # channelizer rows: this receiver at the IQ center, then iq_channels
+        if not self.iq_mode:
+            return
+        rows = [(0., self.radio_mode, self.lc, self.hc)]
+        channels = self.iq_channels
+        rows += [(1000*(ch.freq - self.freq), ch.radio_mode, ch.lc, ch.hc) for ch in channels]
+        self.channelizer.set_channels(rows, [self] + channels)
+
+    def add_channel(self, freq, mode, lc, hc, volume=100):
+        # another receiver inside the IQ passband, demodulated locally
+        offset = 1000*(freq - self.freq)
+        lc, hc = max(lc, -self.IQ_HALF_BW - offset), min(hc, self.IQ_HALF_BW - offset)
+        if hc <= lc:
+            print("%.3f kHz %s is outside the IQ passband" % (freq, mode))
+            return None
+        channel = iq_channel(self, freq, mode, lc, hc, volume)
+        self.iq_channels = self.iq_channels + [channel]
+        self.update_channels()
+        if audio_output is not None and audio_output.stream is not None:
+            audio_output.add(channel)
+        return channel
+
+    def remove_channel(self, channel):
+        self.iq_channels = [ch for ch in self.iq_channels if ch is not channel]
+        self.update_channels()
+        if audio_output is not None:
+            audio_output.remove(channel)
+
+    def queue_samples(self, samples):
+        # samples is scratch (ours or the resampler's), clipped in place and
+        # converted to int16 once, straight into the playback ring; recording
+        # wav_writers copy from the same ring segments
+        np.maximum(samples, -32768, out=samples)
+        np.minimum(samples, 32767, out=samples)
+        pos = self.audio_ring.write_pos
+        n = self.audio_ring.write(samples)
+        for writer, channel in self.recorders:
+            for seg in self.audio_ring.segments(pos, n):
+                writer.write(seg[:, 0], channel)
+
+    def set_output_rate(self, rate):
+        # call before run(): the sound card rate, no resampling if it is native
+        self.AUDIO_RATE = int(rate)
+        self.SAMPLE_RATIO = self.AUDIO_RATE/self.KIWI_RATE
+        if self.AUDIO_RATE == self.KIWI_RATE:
+            self.resampler = None
+        else:
+            self.resampler = polyphase_resampler(self.KIWI_RATE, self.AUDIO_RATE)
+        target = int(self.latency_s * self.AUDIO_RATE)
+        frame_len = int(math.ceil(self.KIWI_SAMPLES_PER_FRAME * self.CHUNKS * self.SAMPLE_RATIO)) + 1
+        max_target = max(target, int(self.MAX_LATENCY_S * self.AUDIO_RATE))
+        # mono, audio_mixer spreads it over the output channels
+        self.audio_ring = audio_ring(target, 1, self.FORMAT, 4 * (max_target + frame_len))
+        # delta_t: how far the Kiwi sample clock (KIWI_RATE_TRUE) is off KIWI_RATE
+        self.jitter = jitter_buffer(self.audio_ring, self.AUDIO_RATE, self.KIWI_RATE / (self.KIWI_RATE + self.delta_t),
+                                    frame_len / self.AUDIO_RATE, self.MIN_LATENCY_S, self.MAX_LATENCY_S, self.adaptive_latency)
+        self.drift_resampler = fractional_resampler(frame_len)
+        self.latency = audio_latency(self.AUDIO_RATE)
+
+    def time_to_first_audio(self):
+        # seconds from connecting to the first samples handed to the sound card
+        if self.audio_ring.first_audio_t is None:
+            return None
+        return self.audio_ring.first_audio_t - self.created_t
+
+    def set_latency(self, latency_s):
+        # a fixed latency, None goes back to adapting it to the link
+        self.adaptive_latency = not latency_s
+        self.jitter.adaptive = self.adaptive_latency
+        if latency_s:
+            self.latency_s = latency_s
+            self.audio_ring.set_target(latency_s * self.AUDIO_RATE)
+            self.jitter.target_s = self.audio_ring.target / self.AUDIO_RATE
+
+    def mod_message(self):
+        if self.iq_mode:
+            return "SET mod=iq low_cut=%d high_cut=%d freq=%.3f" % (-self.IQ_HALF_BW, self.IQ_HALF_BW, self.freq)
         mode_str = self.radio_mode.lower()
         if mode_str == "nfm":
             mode_str = "nbfm"
-        self.stream.send_message("SET mod=%s low_cut=%d high_cut=%d freq=%.3f" % (mode_str, self.lc, self.hc, self.freq))
+        return "SET mod=%s low_cut=%d high_cut=%d freq=%.3f" % (mode_str, self.lc, self.hc, self.freq)
+
+    def set_mode_freq_pb(self):
+        self.stream.send_message(self.mod_message())
+        self.update_channels()
 
     def set_agc(self, on, hang, thresh, slope, decay, gain):
         self.on, self.hang, self.thresh, self.slope, self.decay, self.gain = on, hang, thresh, slope, decay, gain
@@ -699,36 +1942,6 @@ class kiwi_sound():
         self.hc = min(HIGH_CUT_SSB, self.hc + delta_high)
         return self.lc, self.hc
 
-class audio_recording:
-    CHANNELS = 1
-    def __init__(self, kiwi_snd):
-        self.filename = ""
-        self.audio_buffer = []
-        self.kiwi_snd = kiwi_snd
-        self.frames = []
-        self.recording_flag = False
-
-    def start(self):
-        self.filename = "supersdr_%sUTC.wav" % datetime.utcnow().isoformat().split(".")[0].replace(":", "_")
-        print("start recording")
-        self.audio_buffer = []
-        self.recording_flag = True
-
-    def stop(self):
-        print("stop recording")
-        self.recording_flag = False
-        self.save()
-
-    def save(self):
-        self.wave = wave.open(self.filename, "wb")
-        self.wave.setnchannels(self.CHANNELS)
-        self.wave.setsampwidth(2)  # two bytes per sample (int16)
-        self.wave.setframerate(self.kiwi_snd.AUDIO_RATE)
-        # process audio data here
-        self.wave.writeframes(b"".join(self.audio_buffer))
-        self.wave.close()
-        self.recording = False
-
 class filtering:
     def __init__(self, cutoff, fs):
         self.n_tap = int(10 * fs / 1000)
@@ -874,7 +2087,148 @@ class cat:
         except Exception as e:
             print(f"Error disconnecting CAT radio: {e}")
 
+class iq_channel():
+    # A receiver demodulated locally from a kiwi_sound IQ stream: it plays
+    # through audio_mixer like a kiwi_sound (own ring, volume, mute and
+    # audio_balance, recordable) but takes no Kiwi slot and no socket. It
+    # follows the IQ receiver's playout ratio and latency target.
+    def __init__(self, iq_snd, freq, mode, lc, hc, volume=100):
+        self.iq_snd = iq_snd
+        self.freq, self.radio_mode, self.lc, self.hc = freq, mode, lc, hc
+        self.volume = volume
+        self.mute = False
+        self.audio_balance = 0.
+        ring = iq_snd.audio_ring
+        self.audio_ring = audio_ring(ring.target, 1, iq_snd.FORMAT, ring.capacity)
+        self.audio_ring.start_fill = ring.start_fill
+        self.resampler = polyphase_resampler(iq_snd.KIWI_RATE, iq_snd.AUDIO_RATE) if iq_snd.resampler else None
+        self.drift_resampler = fractional_resampler()
+        self.recorders = []
+        self.latency = None # stamped by the IQ receiver only
+
+    # same int16 conversion and recording hook as a kiwi_sound
+    queue_samples = kiwi_sound.queue_samples
+
+    def play(self, samples, ratio):
+        self.audio_ring.set_target(self.iq_snd.audio_ring.target)
+        if self.resampler:
+            samples = self.resampler.process(samples)
+        self.queue_samples(self.drift_resampler.process(samples, ratio))
+
+    def set_mode_freq_pb(self):
+        self.iq_snd.update_channels()
+
+def output_delay(time_info, stream=None):
+    # seconds from the callback to the DAC playing its first sample; some
+    # PortAudio host APIs leave the callback times at 0, then the stream latency
+    if time_info is not None and time_info.currentTime:
+        return max(time_info.outputBufferDacTime - time_info.currentTime, 0.)
+    if stream is not None:
+        return stream.latency
+    return 0.
+
+class audio_mixer():
+    # One sound card stream for all receivers. Each kiwi_sound writes mono into
+    # its own audio_ring; the callback reads one block per ring into a row of
+    # a float32 matrix and mixes them with a single (channels x receivers) gain
+    # matrix product: volume/100, mute and the audio_balance pan (-1 left only,
+    # 0 both at full level, 1 right only). Another receiver is another row.
+    # The matrices are grown by add(), never in the callback, which mixes
+    # blocks longer than them in pieces.
+    FRAMES = 4096
+
+    def __init__(self, rate, channels=2, blocksize=0, device=None, dtype=np.int16):
+        self.rate = rate
+        self.channels = channels
+        self.blocksize = blocksize
+        self.device = device
+        self.dtype = dtype
+        self.sources = [] # replaced, never mutated, the callback holds a snapshot
+        self.stream = None
+        self.buffers = None
+        self.reserve(4)
+
+    def reserve(self, n_rx):
+        # buffers for n_rx receivers, published at once before the sources
+        # that need them, the callback reads sources first, then buffers
+        if self.buffers is not None and self.buffers[0].shape[0] >= n_rx:
+            return
+        frames = max(self.blocksize, self.FRAMES)
+        self.buffers = (np.zeros((n_rx, frames), dtype=self.dtype), np.zeros((n_rx, frames), dtype=np.float32),
+                        np.zeros((self.channels, n_rx), dtype=np.float32),
+                        np.zeros((self.channels, frames), dtype=np.float32))
+
+    def add(self, snd):
+        if snd not in self.sources:
+            self.reserve(len(self.sources) + 1)
+            self.sources = self.sources + [snd]
+        if self.stream is None:
+            self.stream = sd.OutputStream(blocksize=self.blocksize, device=self.device, dtype=self.dtype, latency="low",
+                                          samplerate=self.rate, channels=self.channels, callback=self.callback)
+            self.stream.start()
+
+    def remove(self, snd):
+        self.sources = [s for s in self.sources if s is not snd]
+        if not self.sources and self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+    def set_gains(self, sources, gains):
+        gains = gains[:, :len(sources)]
+        for i, snd in enumerate(sources):
+            g = 0. if snd.mute else snd.volume / 100.
+            if self.channels == 2:
+                balance = min(max(snd.audio_balance, -1.), 1.)
+                gains[0, i] = g * min(1., 1. - balance)
+                gains[1, i] = g * min(1., 1. + balance)
+            else:
+                gains[:, i] = g
+        return gains
+
+    def callback(self, outdata, frames, time_info, status):
+        sources = self.sources
+        rx_i16, rx, gains, mix = self.buffers
+        n = len(sources)
+        gains = self.set_gains(sources, gains)
+        now = time.monotonic()
+        dac_t = now + output_delay(time_info, self.stream)
+        width = rx.shape[1]
+        for start in range(0, frames, width):
+            m = min(width, frames - start)
+            block_i16, block, block_mix = rx_i16[:n, :m], rx[:n, :m], mix[:, :m]
+            for i, snd in enumerate(sources):
+                ring = snd.audio_ring
+                played = ring.read(block_i16[i, :, None])
+                if played and snd.latency is not None:
+                    snd.latency.played(ring.read_pos - played, played, now, dac_t + start / self.rate)
+            np.copyto(block, block_i16, casting='unsafe')
+            np.matmul(gains, block, out=block_mix)
+            np.maximum(block_mix, -32768, out=block_mix)
+            np.minimum(block_mix, 32767, out=block_mix)
+            np.copyto(outdata[start:start + m], block_mix.T, casting='unsafe')
+
+class mixer_input():
+    # what start_audio_stream returns in place of a per receiver stream:
+    # stopping it takes the receiver out of the mix
+    def __init__(self, mixer, snd):
+        self.mixer = mixer
+        self.snd = snd
+
+    def start(self):
+        self.mixer.add(self.snd)
+
+    def stop(self):
+        self.mixer.remove(self.snd)
+
+    def close(self):
+        self.mixer.remove(self.snd)
+
+# the audio_mixer all receivers play through, created by the first one
+audio_output = None
+
 def start_audio_stream(kiwi_snd):
+    global audio_output
     def _get_std_input_dev():
         std_dev_id = None
         devices = sd.query_devices()
@@ -883,21 +2237,38 @@ def start_audio_stream(kiwi_snd):
                 std_dev_id = dev_id
         return std_dev_id
 
+    if audio_output is not None and audio_output.stream is not None:
+        # join the running mix at its rate
+        kiwi_snd.set_output_rate(audio_output.rate)
+    else:
+        std_dev_id = _get_std_input_dev()
+        try:
+            # play at the Kiwi rate when the card takes it, no resampling at all
+            sd.check_output_settings(device=std_dev_id, samplerate=kiwi_snd.KIWI_RATE, channels=kiwi_snd.CHANNELS, dtype=kiwi_snd.FORMAT)
+            kiwi_snd.set_output_rate(kiwi_snd.KIWI_RATE)
+        except Exception:
+            pass
+        audio_output = audio_mixer(kiwi_snd.AUDIO_RATE, kiwi_snd.CHANNELS, int(kiwi_snd.KIWI_SAMPLES_PER_FRAME*kiwi_snd.CHUNKS*kiwi_snd.SAMPLE_RATIO),
+                                   std_dev_id, kiwi_snd.FORMAT)
+    print("Audio output at %d Hz" % kiwi_snd.AUDIO_RATE)
+
     rx_t = threading.Thread(target=kiwi_snd.run, daemon=True)
     rx_t.start()
 
     print("Filling audio buffer...")
-    while kiwi_snd.audio_buffer.qsize() < kiwi_snd.FULL_BUFF_LEN and not kiwi_snd.terminate:
-        pass
+    ring = kiwi_snd.audio_ring
+    ring.start_fill = min(int(kiwi_snd.PREFILL_S * kiwi_snd.AUDIO_RATE), ring.target)
+    if not ring.wait_fill(ring.start_fill, kiwi_snd.PREFILL_TIMEOUT_S):
+        if not ring.closed:
+            print("no audio from the Kiwi in %d s" % kiwi_snd.PREFILL_TIMEOUT_S)
+        kiwi_snd.terminate = True
 
     if kiwi_snd.terminate:
         print("kiwi sound not started!")
         del kiwi_snd
         return (None, None)
 
-    std_dev_id = _get_std_input_dev()
-    kiwi_audio_stream = sd.OutputStream(blocksize = int(kiwi_snd.KIWI_SAMPLES_PER_FRAME*kiwi_snd.CHUNKS*kiwi_snd.SAMPLE_RATIO),
-                        device=std_dev_id, dtype=kiwi_snd.FORMAT, latency="low", samplerate=kiwi_snd.AUDIO_RATE, channels=kiwi_snd.CHANNELS, callback = kiwi_snd.play_buffer)
+    kiwi_audio_stream = mixer_input(audio_output, kiwi_snd)
     kiwi_audio_stream.start()
 
-    return True, kiwi_audio_stream
\ No newline at end of file
+    return True, kiwi_audio_stream
@@ -0,0 +1,986 @@
+#!/usr/bin/env python3
+# bench_supersdr.py - offline microbenchmarks for the SuperSDR backend hot paths
+#
+# No KiwiSDR is needed: the waterfall object is built without connecting and
+# fed synthetic W/F frames through a fake websocket stream.
+
+import array
+import os
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+from optparse import OptionParser
+
+import numpy as np
+from scipy.signal import resample_poly
+
+import backend
+from kiwi.client import stepSizeTable, indexAdjustTable, adpcmNextIndex, adpcmDifference, ImaAdpcmDecoder
+
+DISPLAY_WIDTH = 1024
+WF_HEIGHT = 400
+
+
+class fake_disp():
+    DISPLAY_WIDTH = DISPLAY_WIDTH
+    WF_HEIGHT = WF_HEIGHT
+
+
+def make_wf_messages(n_msgs, bins, seed=0):
+    rng = np.random.default_rng(seed)
+    header = b"W/F" + bytes(13)
+    msgs = []
+    for _ in range(n_msgs):
+        noise = rng.normal(150, 8, bins)
+        noise[rng.integers(0, bins, 20)] += 40 # a few carriers
+        msgs.append(header + np.clip(noise, 0, 255).astype(np.uint8).tobytes())
+    return msgs
+
+
+def adpcm_encode(samples):
+    # plain IMA-ADPCM encoder, low nibble first, the inverse of ImaAdpcmDecoder
+    index, prev = 0, 0
+    codes = []
+    for x in samples:
+        step = stepSizeTable[index]
+        diff = int(x) - prev
+        code = 8 if diff < 0 else 0
+        diff = abs(diff)
+        delta = step >> 3
+        if diff >= step:
+            code |= 4
+            diff -= step
+            delta += step
+        if diff >= step >> 1:
+            code |= 2
+            diff -= step >> 1
+            delta += step >> 1
+        if diff >= step >> 2:
+            code |= 1
+            delta += step >> 2
+        prev = max(-32768, min(32767, prev - delta if code & 8 else prev + delta))
+        index = max(0, min(len(stepSizeTable) - 1, index + indexAdjustTable[code]))
+        codes.append(code)
+    if len(codes) % 2:
+        codes.append(0)
+    return bytes(codes[i] | (codes[i+1] << 4) for i in range(0, len(codes), 2))
+
+
+def make_compressed_wf_messages(msgs):
+    # same frames as the Kiwi sends them with wf_comp=1: bins plus a 10 sample pad
+    comp = []
+    for msg in msgs:
+        bins = np.frombuffer(msg, dtype=np.uint8, offset=16)
+        comp.append(msg[:16] + adpcm_encode(np.concatenate((bins, np.repeat(bins[-1:], 10)))))
+    return comp
+
+
+class alloc_meter():
+    # transient traced bytes between two consecutive frames
+    def __init__(self, warmup):
+        self.warmup = warmup
+        self.frames = 0
+        self.samples = []
+
+    def tick(self):
+        if self.frames == self.warmup:
+            tracemalloc.start()
+        elif self.frames > self.warmup:
+            current, peak = tracemalloc.get_traced_memory()
+            self.samples.append(peak - self.base)
+        if self.frames >= self.warmup:
+            tracemalloc.reset_peak()
+            self.base = tracemalloc.get_traced_memory()[0]
+        self.frames += 1
+
+    def stop(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        return np.array(self.samples if self.samples else [0])
+
+
+class fake_wf_stream():
+    def __init__(self, wf, msgs, n_frames, meter=None):
+        self.wf = wf
+        self.msgs = msgs
+        self.n_frames = n_frames
+        self.meter = meter
+        self.sent = 0
+
+    def receive_message(self):
+        if self.meter:
+            self.meter.tick()
+        if self.sent >= self.n_frames:
+            self.wf.terminate = True
+            return None
+        msg = self.msgs[self.sent % len(self.msgs)]
+        self.sent += 1
+        return msg
+
+    def send_message(self, msg):
+        pass
+
+
+def offline_waterfall(bins=1024, zoom=8):
+    # everything kiwi_waterfall.__init__ sets up, minus the network
+    wf = backend.kiwi_waterfall.__new__(backend.kiwi_waterfall)
+    wf.WF_BINS = bins
+    wf.zoom = zoom
+    wf.averaging_n = 1
+    wf.scope_averaging_n = None
+    wf.old_averaging_n = 1
+    wf.wf_auto_scaling = True
+    wf.dynamic_range = wf.MIN_DYN_RANGE
+    wf.terminate = False
+    wf.compression = False
+    wf.wf_decoder = ImaAdpcmDecoder()
+    wf.transport = backend.transport_meter()
+    wf.wf_header = struct.Struct('<II')
+    wf.view_cache = backend.spectrum_view_cache()
+    wf.view_key = (zoom, 0)
+    wf.counter = 0
+    wf.view_lines = 0
+    wf.view_requested = False
+    wf.view_wait = None
+    wf.stale_frames = 0
+    wf.scope_spectrum = None
+    wf.governor = backend.wf_rate_governor(wf.MAX_FPS)
+    wf.decim_count = 0
+    wf.run_index = 0
+    wf.level_tracker = backend.wf_level_tracker(wf.CLIP_LOWP/100., wf.CLIP_HIGHP/100., wf.AUTOSCALE_TAU_S)
+    wf.wf_history = backend.wf_ring_buffer(WF_HEIGHT, bins, np.float32)
+    wf.wf_pyramid = backend.wf_pyramid(wf.wf_history, wf.WF_PYRAMID_LEVELS, wf.WF_PYRAMID_POOLING)
+    wf.frame_bus = backend.frame_bus(bins)
+    wf.start_f_khz = 7000.
+    wf._init_buffers()
+    wf.averager = backend.spectrum_averager(bins, wf.AVERAGING_MODE)
+    wf.averager.set_depth("wf", 1)
+    wf.averager.set_depth("scope", 1)
+    return wf
+
+
+def offline_sound(rate_out=48000, buffer_len=50):
+    # everything kiwi_sound.__init__ sets up, minus the network
+    snd = backend.kiwi_sound.__new__(backend.kiwi_sound)
+    snd.FULL_BUFF_LEN = buffer_len
+    snd.latency_s = buffer_len*snd.KIWI_SAMPLES_PER_FRAME*snd.CHUNKS/snd.KIWI_RATE
+    snd.adaptive_latency = True
+    snd.delta_t = 0.
+    snd.terminate = False
+    snd.created_t = time.monotonic()
+    snd.volume, snd.mute, snd.audio_balance = 100, False, 0.
+    snd.keepalive_count = 0
+    snd.rssi = -127
+    snd.compression = False
+    snd.decoder = ImaAdpcmDecoder()
+    snd.transport = backend.transport_meter()
+    snd.snd_header = struct.Struct('<BI')
+    snd.snd_smeter = struct.Struct('>H')
+    snd.snd_f32 = np.zeros(snd.KIWI_SAMPLES_PER_FRAME, dtype=np.float32)
+    snd.recorders = []
+    snd.audio_rec = backend.audio_recording(snd)
+    snd.iq_mode, snd.iq_channels, snd.channelizer = False, [], None
+    snd.set_output_rate(rate_out)
+    return snd
+
+
+def make_snd_messages(n_msgs, frame=512, seed=0):
+    rng = np.random.default_rng(seed)
+    msgs = []
+    for i in range(n_msgs):
+        pcm = (3000 * np.sin(np.arange(i*frame, (i+1)*frame) * 0.07) + rng.normal(0, 30, frame)).astype('>i2')
+        msgs.append(b"SND" + struct.pack('<BI', 0, i) + struct.pack('>H', 1000) + pcm.tobytes())
+    return msgs
+
+
+def legacy_snd_packet(snd, msg, frames):
+    # kiwi_sound.run body before the preallocated playback ring
+    if backend.bytearray2str(msg[0:3]) != "SND":
+        return
+    flags, seq, = struct.unpack('<BI', memoryview(msg[3:8]))
+    smeter, = struct.unpack('>H', memoryview(msg[8:10]))
+    data = msg[10:]
+    snd.rssi = 0.1*smeter - 127
+    samples = np.ndarray(len(data) // 2, dtype='>h', buffer=data).astype(np.float32)
+    snd.transport.add(len(msg), 10 + 2*len(samples))
+    if snd.resampler:
+        samples = snd.resampler.process(samples)
+    frames.append(samples)
+    chunk = np.concatenate(frames)
+    frames.clear()
+    chunk_stereo = np.column_stack((chunk, chunk))
+    try:
+        snd.legacy_queue.put(chunk_stereo.astype(np.int16).tobytes(), block=False)
+    except backend.queue.Full:
+        snd.legacy_queue.get_nowait()
+        snd.legacy_queue.put(chunk_stereo.astype(np.int16).tobytes(), block=False)
+
+
+def run_legacy_snd(msgs, n_packets, rate_out, meter=None):
+    snd = offline_sound(rate_out)
+    snd.legacy_queue = backend.queue.Queue(maxsize=snd.FULL_BUFF_LEN)
+    frames = []
+    for i in range(n_packets):
+        if meter:
+            meter.tick()
+        legacy_snd_packet(snd, msgs[i % len(msgs)], frames)
+
+
+def run_preallocated_snd(msgs, n_packets, rate_out, meter=None):
+    snd = offline_sound(rate_out)
+    snd.stream = fake_wf_stream(snd, msgs, n_packets, meter)
+    snd.run()
+
+
+def bench_snd_decode(n_packets, rate_out=48000, warmup=50):
+    msgs = make_snd_messages(64)
+    print("SND decode, 512 samples/packet -> %d Hz stereo int16" % rate_out)
+    print("%-14s %12s %14s %14s" % ("path", "us/packet", "alloc B/pkt", "max B/pkt"))
+    for name, run in (("legacy", run_legacy_snd), ("preallocated", run_preallocated_snd)):
+        # timing and allocation tracing in separate passes, tracemalloc is slow
+        t0 = time.perf_counter()
+        run(msgs, n_packets, rate_out)
+        t = (time.perf_counter() - t0) / n_packets
+        meter = alloc_meter(warmup)
+        run(msgs, n_packets, rate_out, meter)
+        alloc = meter.stop()
+        print("%-14s %12.1f %14.0f %14.0f" % (name, t*1e6, alloc.mean(), alloc.max()))
+
+
+def legacy_play_buffer(audio_buffer, outdata):
+    # sounddevice callback before audio_ring, the tail of longer chunks is
+    # lost; returns (samples lost, silent frames)
+    try:
+        audio_data = np.frombuffer(audio_buffer.get_nowait(), dtype=np.int16).reshape(-1, 2)
+        if len(audio_data) <= len(outdata):
+            outdata[:len(audio_data)] = audio_data
+            outdata[len(audio_data):] = 0
+            return 0, len(outdata) - len(audio_data)
+        else:
+            outdata[:] = audio_data[:len(outdata)]
+            return len(audio_data) - len(outdata), 0
+    except backend.queue.Empty:
+        outdata[:] = 0
+        return 0, len(outdata)
+
+
+def bench_audio_ring(n_blocks, rate_out=48000, blocksize=1024):
+    # Kiwi packets arriving in real time against a device asking for
+    # blocksize frames: callback cost, allocations, lost and silent samples
+    chunk = int(512 * rate_out / 12000)
+    print("SND playback handover, %d sample chunks, %d frame device blocks" % (chunk, blocksize))
+    print("%-14s %12s %14s %10s %10s" % ("handover", "us/callback", "alloc B/call", "lost %", "silent %"))
+    audio = (3000 * np.sin(np.arange(chunk) * 0.01)).astype(np.float32)
+    stereo = np.column_stack((audio, audio)).astype(np.int16).tobytes()
+    outdata = np.zeros((blocksize, 2), dtype=np.int16)
+    played = n_blocks * blocksize
+
+    q = backend.queue.Queue(maxsize=50)
+    written = lost = silent = t_cb = 0.
+    meter = alloc_meter(50)
+    for i in range(n_blocks):
+        while written < (i + 1) * blocksize:
+            q.put(stereo)
+            written += chunk
+        meter.tick()
+        t0 = time.perf_counter()
+        l, z = legacy_play_buffer(q, outdata)
+        t_cb += time.perf_counter() - t0
+        lost, silent = lost + l, silent + z
+    alloc = meter.stop()
+    print("%-14s %12.1f %14.0f %10.1f %10.1f" % ("queue", t_cb/n_blocks*1e6, alloc.mean(),
+          100*lost/written, 100*silent/played))
+
+    ring = backend.audio_ring(10*chunk, 2, np.int16, 40*chunk)
+    written = silent = t_cb = 0.
+    meter = alloc_meter(50)
+    for i in range(n_blocks):
+        while written < (i + 1) * blocksize:
+            written += ring.write(audio)
+        meter.tick()
+        t0 = time.perf_counter()
+        silent += blocksize - ring.read(outdata)
+        t_cb += time.perf_counter() - t0
+    alloc = meter.stop()
+    # the prefill to the target latency is the only silence
+    print("%-14s %12.1f %14.0f %10.1f %10.1f   (%d underruns, %d overruns)" % ("audio_ring", t_cb/n_blocks*1e6,
+          alloc.mean(), 100*ring.skipped/written, 100*silent/played, ring.underruns, ring.overruns))
+
+
+def legacy_stream_callback(snd, outdata):
+    # the per receiver stream callback the mixer replaced, the mono ring
+    # broadcast to every channel
+    n = snd.audio_ring.read(outdata)
+    if n:
+        now = time.monotonic()
+        snd.latency.played(snd.audio_ring.read_pos - n, n, now, now)
+
+
+def bench_mixer(n_blocks, rate_out=48000, max_rx=4):
+    # per block device cost of N receivers: N streams, each with its own
+    # callback, against one audio_mixer callback mixing N rings with pan
+    blocksize = int(512 * rate_out / 12000)
+    print("SND output for N receivers, %d frame blocks at %d Hz" % (blocksize, rate_out))
+    print("%-4s %18s %18s %14s" % ("RX", "streams us/block", "mixer us/block", "alloc B/block"))
+    audio = (3000 * np.sin(np.arange(blocksize) * 0.01)).astype(np.float32)
+    for n in range(1, max_rx + 1):
+        snds = [offline_sound(rate_out, 10) for _ in range(n)]
+        for i, snd in enumerate(snds):
+            snd.audio_balance = (-1., 1., 0., 0.5)[i % 4]
+        outdata = np.zeros((blocksize, 2), dtype=np.int16)
+        t_streams = 0.
+        for _ in range(n_blocks):
+            for snd in snds:
+                snd.queue_samples(audio)
+            t0 = time.perf_counter()
+            for snd in snds:
+                legacy_stream_callback(snd, outdata)
+            t_streams += time.perf_counter() - t0
+
+        mixer = backend.audio_mixer(rate_out, 2, blocksize)
+        mixer.reserve(n)
+        mixer.sources = snds
+        t_mix = 0.
+        for _ in range(n_blocks):
+            for snd in snds:
+                snd.queue_samples(audio)
+            t0 = time.perf_counter()
+            mixer.callback(outdata, blocksize, None, None)
+            t_mix += time.perf_counter() - t0
+        meter = alloc_meter(20)
+        for _ in range(100):
+            for snd in snds:
+                snd.queue_samples(audio)
+            meter.tick()
+            mixer.callback(outdata, blocksize, None, None)
+        alloc = meter.stop()
+        print("%-4d %18.1f %18.1f %14.0f" % (n, t_streams/n_blocks*1e6, t_mix/n_blocks*1e6, alloc.mean()))
+
+
+def bench_channelizer(n_frames, max_channels=8, frame=512):
+    # per IQ frame cost of demodulating N channels locally, one Kiwi IQ
+    # stream against N separate Kiwi audio streams (N slots, N sockets)
+    rng = np.random.default_rng(0)
+    iq = (3000 * rng.standard_normal(2 * frame)).astype('>i2')
+    modes = ("USB", "LSB", "CW", "AM")
+    print("IQ channelizer, %d IQ samples per frame" % frame)
+    print("%-4s %16s %18s %14s" % ("CH", "us/frame", "us/frame/channel", "alloc B/frame"))
+    for n in (1, 2, 4, max_channels):
+        chan = backend.iq_channelizer(12000)
+        rows = []
+        for i in range(n):
+            mode = modes[i % len(modes)]
+            lc, hc = backend.default_passband(mode)
+            lc, hc = max(lc, -1500), min(hc, 1500)
+            rows.append((-4000 + 8000 * i / max(n - 1, 1) * 0.8, mode, lc, hc))
+        chan.set_channels(rows)
+        chan.process(iq)
+        t0 = time.perf_counter()
+        for _ in range(n_frames):
+            chan.process(iq)
+        t = (time.perf_counter() - t0) / n_frames
+        meter = alloc_meter(20)
+        for _ in range(100):
+            meter.tick()
+            chan.process(iq)
+        alloc = meter.stop()
+        print("%-4d %16.1f %18.1f %14.0f" % (n, t*1e6, t/n*1e6, alloc.mean()))
+
+
+def link_arrivals(n_packets, frame_s, link, seed=0):
+    # in order (TCP) arrival times of packets sent every frame_s
+    rng = np.random.default_rng(seed)
+    send = np.arange(n_packets) * frame_s
+    if link == "lan":
+        delay = 0.001 + rng.exponential(0.0005, n_packets)
+    else:
+        delay = 0.03 + rng.lognormal(np.log(0.01), 0.8, n_packets)
+        stalls = rng.random(n_packets) < 0.002 # retransmissions
+        delay[stalls] += rng.uniform(0.1, 0.4, stalls.sum())
+    return np.maximum.accumulate(send + delay)
+
+
+def bench_jitter(minutes, link, rate_out=48000, kiwi_ppm=150, card_ppm=-80):
+    # a Kiwi whose clock is kiwi_ppm fast (as KIWI_RATE_TRUE reports) against a
+    # sound card card_ppm off, over a LAN or a jittery internet path
+    frame = 512
+    true_rate = 12000 * (1 + kiwi_ppm*1e-6)
+    n_packets = int(minutes * 60 * true_rate / frame)
+    arrivals = link_arrivals(n_packets, frame / true_rate, link)
+    pcm = (3000 * np.sin(np.arange(frame) * 0.07)).astype(np.float32)
+    print("%s link, %.0f min, Kiwi clock %+d ppm, sound card %+d ppm" % (link, minutes, kiwi_ppm, card_ppm))
+    print("%-14s %10s %10s %10s %12s %12s %10s %14s" % ("playout", "underruns", "overruns", "skipped ms",
+                                                       "latency ms", "target ms", "mean ppm", "p50/p95 ms"))
+    for name in ("fixed ring", "jitter_buffer"):
+        snd = offline_sound(rate_out, 10)
+        snd.delta_t = true_rate - 12000
+        snd.set_output_rate(rate_out)
+        block = int(frame * snd.SAMPLE_RATIO)
+        outdata = np.zeros((block, 2), dtype=np.int16)
+        block_s = block / (rate_out * (1 + card_ppm*1e-6))
+        next_cb = arrivals[0]
+        latency, ratios = [], []
+        for seq, now in enumerate(arrivals):
+            while next_cb < now:
+                played = snd.audio_ring.read(outdata)
+                if played:
+                    # simulated clock: read and DAC time are the callback time
+                    snd.latency.played(snd.audio_ring.read_pos - played, played, next_cb, next_cb)
+                if snd.audio_ring.primed:
+                    latency.append(snd.audio_ring.fill())
+                next_cb += block_s
+            samples = snd.resampler.process(pcm.copy())
+            if name == "jitter_buffer":
+                ratio = snd.jitter.arrival(now, frame / true_rate)
+                ratios.append(ratio)
+                samples = snd.drift_resampler.process(samples, ratio)
+            snd.latency.stamp(seq, now, snd.audio_ring.write_pos)
+            snd.queue_samples(samples)
+        ring = snd.audio_ring
+        late = np.array(latency[len(latency)//2:]) / rate_out
+        # mean playout ratio, the clock offsets are -(kiwi_ppm - card_ppm)
+        ratio = "%.0f" % (1e6*(np.mean(ratios) - 1)) if ratios else "-"
+        # packet arrival to its first sample played, from the audio_latency histogram
+        speaker = "%s/%s" % (snd.latency.percentile(snd.latency.speaker, 50), snd.latency.percentile(snd.latency.speaker, 95))
+        print("%-14s %10d %10d %10.0f %12.0f %12.0f %10s %14s" % (name, ring.underruns, ring.overruns,
+              1000*ring.skipped/rate_out, 1000*late.mean(), 1000*ring.target/rate_out, ratio, speaker))
+
+
+def legacy_frame(wf_data, msg, zoom):
+    # receive_spectrum + spectrum_db2col + np.roll as they were before the
+    # preallocated pipeline, kept here as the reference for the benchmark
+    msg = msg[16:]
+    spectrum = np.ndarray(len(msg), dtype='B', buffer=msg).astype(np.float32)
+    wf = -(255 - spectrum)
+    wf_db = wf - 13 + (3*zoom)
+    wf_db[0] = wf_db[1]
+    low_clip_db = np.percentile(wf_db, 40.)
+    high_clip_db = np.percentile(wf_db, 100.)
+    dynamic_range = max(high_clip_db - low_clip_db, 40.)
+    wf_color = (wf_db - low_clip_db) / dynamic_range
+    wf_color = np.clip(wf_color, 0.0, 1.0)
+    wf_color *= 254
+    wf_color = np.clip(wf_color, 0, 255)
+    wf_data[1:, :] = wf_data[0:-1, :]
+    wf_data[0, :] = wf_color
+
+
+def run_legacy(msgs, n_frames, bins, meter=None):
+    wf_data = np.zeros((WF_HEIGHT, bins))
+    t0 = time.perf_counter()
+    for i in range(n_frames + 1):
+        if meter:
+            meter.tick()
+        if i < n_frames:
+            legacy_frame(wf_data, msgs[i % len(msgs)], 8)
+    return (time.perf_counter() - t0) / n_frames
+
+
+def run_preallocated(msgs, n_frames, bins, meter=None):
+    wf = offline_waterfall(bins)
+    wf.wf_stream = fake_wf_stream(wf, msgs, n_frames, meter)
+    t0 = time.perf_counter()
+    wf.run()
+    return (time.perf_counter() - t0) / n_frames
+
+
+def bench_wf_pipeline(n_frames, bins, warmup=50):
+    msgs = make_wf_messages(64, bins)
+
+    print("W/F receive+scale, %d bins, %d frames (first %d not measured)" % (bins, n_frames, warmup))
+    print("%-14s %14s %14s %12s" % ("path", "mean B/frame", "max B/frame", "us/frame"))
+    for name, run in (("legacy", run_legacy), ("preallocated", run_preallocated)):
+        # timing and allocation tracing are separate runs, tracemalloc is slow
+        t_frame = run(msgs, n_frames, bins)
+        meter = alloc_meter(warmup)
+        run(msgs, n_frames, bins, meter)
+        allocs = meter.stop()
+        print("%-14s %14.0f %14d %12.1f" % (name, allocs.mean(), allocs.max(), t_frame*1e6))
+
+def bench_wf_transport(n_frames, bins, fps=23, audio_rate=12000):
+    msgs = make_wf_messages(16, bins)
+    comp_msgs = make_compressed_wf_messages(msgs)
+
+    print("W/F transport, %d bins at %d fps, audio at %d Hz" % (bins, fps, audio_rate))
+    print("%-14s %12s %12s %12s %12s" % ("W/F stream", "B/frame", "kB/s", "us/frame", "mean err"))
+    lines = {}
+    wf_bytes = {}
+    for name, compression, frames in (("wf_comp=0", False, msgs), ("wf_comp=1", True, comp_msgs)):
+        wf = offline_waterfall(bins)
+        wf.compression = compression
+        wf.wf_auto_scaling = False
+        wf.wf_stream = fake_wf_stream(wf, frames, n_frames)
+        t0 = time.perf_counter()
+        wf.run()
+        t_frame = (time.perf_counter() - t0) / n_frames
+        wf_bytes[name] = wf.transport.rx_bytes / n_frames
+        lines[name] = wf.spectrum_raw.astype(int)
+        # ADPCM is lossy, error in raw dB steps against the uncompressed line
+        err = np.abs(lines[name] - lines["wf_comp=0"]).mean()
+        print("%-14s %12.0f %12.1f %12.1f %12.2f" % (name, wf_bytes[name], wf_bytes[name]*fps/1000, t_frame*1e6, err))
+
+    # SND: 512 samples per frame, 10 byte header, int16 or 4 bit ADPCM
+    snd_fps = audio_rate / 512.
+    audio = (3000 * np.sin(np.arange(512) * 0.07)).astype(np.int16)
+    snd_raw = 10 + 2*len(audio)
+    snd_comp = 10 + len(adpcm_encode(audio))
+    decoder = ImaAdpcmDecoder()
+    payload = adpcm_encode(audio)
+    t0 = time.perf_counter()
+    for _ in range(200):
+        # same payload every time, from the state it was encoded from
+        decoder.reset()
+        decoder.decode_block(payload)
+    t_snd = (time.perf_counter() - t0) / 200
+    print("%-14s %12d %12.1f" % ("compression=0", snd_raw, snd_raw*snd_fps/1000))
+    print("%-14s %12d %12.1f %12.1f" % ("compression=1", snd_comp, snd_comp*snd_fps/1000, t_snd*1e6))
+
+    wf_saved = (wf_bytes["wf_comp=0"] - wf_bytes["wf_comp=1"]) * fps
+    snd_saved = (snd_raw - snd_comp) * snd_fps
+    print("saved: W/F %.1f kB/s, SND %.1f kB/s per receiver" % (wf_saved/1000, snd_saved/1000))
+
+
+def legacy_adpcm_decode(decoder, data):
+    # ImaAdpcmDecoder.decode before the block decoder: one table lookup pair
+    # per nibble in Python, the bit exact reference
+    next_index, difference = adpcmNextIndex, adpcmDifference
+    index, prev = decoder.index, decoder.prev
+    samples = array.array('h', bytes(4 * len(data)))
+    i = 0
+    for b in data:
+        for code in (b & 0x0F, b >> 4):
+            k = (index << 4) | code
+            prev += difference[k]
+            if prev > 32767:
+                prev = 32767
+            elif prev < -32768:
+                prev = -32768
+            index = next_index[k]
+            samples[i] = prev
+            i += 1
+    decoder.index, decoder.prev = index, prev
+    return samples
+
+
+def bench_adpcm(seconds=20, frame=512, rate=12000):
+    # SND sized blocks of speech-like audio, and W/F sized ones with the
+    # decoder reset per frame; both decoders start from the same state
+    t = np.arange(int(seconds * rate))
+    rng = np.random.default_rng(0)
+    audio = 3000 * np.sin(2*np.pi*700*t/rate) * (1 + np.sin(2*np.pi*0.5*t/rate)) + rng.normal(0, 300, len(t))
+    # a few full scale bursts so the int16 clamp is exercised too
+    audio[::rate] = 32767
+    payload = adpcm_encode(np.clip(audio, -32768, 32767).astype(np.int16))
+    blocks = [payload[i:i + frame // 2] for i in range(0, len(payload), frame // 2)]
+    wf_blocks = make_compressed_wf_messages(make_wf_messages(64, 1024))
+
+    print("IMA-ADPCM decode, %d blocks of %d samples, %d W/F lines" % (len(blocks), frame, len(wf_blocks)))
+    print("%-14s %14s %14s %12s" % ("decoder", "SND Msamples/s", "W/F Msamples/s", "bit exact"))
+    outputs = {}
+    for name in ("legacy", "decode_block"):
+        decoder = ImaAdpcmDecoder()
+        decode = (lambda data: legacy_adpcm_decode(decoder, data)) if name == "legacy" else decoder.decode_block
+        out = []
+        t0 = time.perf_counter()
+        for block in blocks:
+            out.append(np.frombuffer(decode(block), dtype=np.int16).copy())
+        t_snd = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for msg in wf_blocks:
+            decoder.reset()
+            out.append(np.frombuffer(decode(memoryview(msg)[16:]), dtype=np.int16).copy())
+        t_wf = time.perf_counter() - t0
+        outputs[name] = np.concatenate(out)
+        n_wf = sum(2 * (len(msg) - 16) for msg in wf_blocks)
+        exact = "-" if name == "legacy" else str(np.array_equal(outputs[name], outputs["legacy"]))
+        print("%-14s %14.2f %14.2f %12s" % (name, 2*len(payload)/t_snd/1e6, n_wf/t_wf/1e6, exact))
+
+
+def bench_resampler(seconds, rate_in=12000, rate_out=48000, frame=512):
+    n_frames = int(seconds * rate_in / frame)
+    t = np.arange(n_frames * frame)
+    x = (8000 * np.sin(2*np.pi*700*t/rate_in)).astype(np.float32)
+    frames = x.reshape(n_frames, frame)
+    g = np.gcd(rate_in, rate_out)
+    up, down = rate_out // g, rate_in // g
+    # whole signal in one go: the reference without any frame edges
+    ref = resample_poly(x.astype(np.float64), up, down)
+
+    print("SND resampling %d -> %d Hz, %d sample frames, %.0f s of audio" % (rate_in, rate_out, frame, seconds))
+    print("%-22s %14s %16s" % ("resampler", "ms CPU / s", "max err vs whole"))
+
+    t0 = time.perf_counter()
+    out = np.concatenate([resample_poly(f, rate_out, rate_in) for f in frames])
+    cpu = (time.perf_counter() - t0) / seconds
+    print("%-22s %14.2f %16.1f" % ("resample_poly/frame", cpu*1e3, np.abs(out - ref).max()))
+
+    resampler = backend.polyphase_resampler(rate_in, rate_out)
+    t0 = time.perf_counter()
+    out = np.concatenate([resampler.process(f).copy() for f in frames])
+    cpu = (time.perf_counter() - t0) / seconds
+    # causal filter: compare after its delay (integer for 12k -> 48k)
+    d = int(round(resampler.delay()))
+    err = np.abs(out[d:] - ref[:len(out)-d])[frame:-frame].max()
+    print("%-22s %14.2f %16.4f" % ("polyphase_resampler", cpu*1e3, err))
+
+
+def bench_bin_resampler(n_lines, bins, widths=(700, 1366, 1920)):
+    # the np.interp the GUI did per line and per spectrum, against the cached
+    # bin_resampler layouts; "carrier" is what is left of a one bin 255
+    # carrier over a 40 floor (255 = intact)
+    print("W/F bins -> pixels, %d bins" % bins)
+    print("%-7s %-9s %10s %10s" % ("width", "method", "us/line", "carrier"))
+    lines = [np.frombuffer(msg, dtype=np.uint8, offset=16) for msg in make_wf_messages(16, bins)]
+    carrier = np.full(bins, 40, dtype=np.uint8)
+    carrier[bins // 3 + 1] = 255
+    for width in widths:
+        t0 = time.perf_counter()
+        for i in range(n_lines):
+            line = lines[i % len(lines)]
+            np.interp(np.linspace(0, len(line) - 1, width), np.arange(len(line)), line).astype(np.uint8)
+        t = (time.perf_counter() - t0) / n_lines
+        kept = np.interp(np.linspace(0, bins - 1, width), np.arange(bins), carrier).astype(np.uint8).max()
+        print("%-7d %-9s %10.1f %10d" % (width, "interp", t*1e6, kept))
+        for mode in backend.bin_resampler.MODES:
+            resampler = backend.bin_resampler(mode)
+            t0 = time.perf_counter()
+            for i in range(n_lines):
+                resampler.resample(lines[i % len(lines)], width)
+            t = (time.perf_counter() - t0) / n_lines
+            print("%-7d %-9s %10.1f %10d" % (width, mode, t*1e6, resampler.resample(carrier, width).max()))
+
+
+def offscreen_gui():
+    # supersdr_qt on the offscreen platform, None without PyQt5; its option
+    # parser runs on import, so it gets an empty command line
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    argv = sys.argv
+    try:
+        from PyQt5.QtWidgets import QApplication
+        sys.argv = argv[:1]
+        import supersdr_qt
+    except ImportError:
+        return None
+    finally:
+        sys.argv = argv
+    offscreen_gui.app = QApplication.instance() or QApplication(argv[:1])
+    return supersdr_qt
+
+
+def legacy_waterfall_line(gui, image, line, colormap):
+    # WaterfallWidget.update_waterfall_data before the LUT ring: the whole
+    # image shifted down by one, then setPixelColor per pixel
+    width, height = image.width(), image.height()
+    temp_image = gui.QImage(width, height, gui.QImage.Format_RGB32)
+    painter = gui.QPainter(temp_image)
+    painter.setRenderHint(gui.QPainter.SmoothPixmapTransform)
+    painter.drawImage(0, 1, image, 0, 0, width, height - 1)
+    painter.end()
+    line_len = len(line)
+    for x in range(width):
+        data_idx = min(int(x * line_len / width), line_len - 1)
+        temp_image.setPixelColor(x, 0, colormap[int(np.clip(line[data_idx], 0, 254))])
+    return temp_image
+
+
+def bench_waterfall_widget(n_lines, bins, sizes=((1024, 400), (1920, 800))):
+    gui = offscreen_gui()
+    if gui is None:
+        print("WaterfallWidget: PyQt5 not installed, skipped")
+        return
+    lines = make_wf_messages(64, bins)
+    lines = [np.frombuffer(msg, dtype=np.uint8, offset=16) for msg in lines]
+    colormap = gui.generate_cutesdr_colormap()
+    print("WaterfallWidget line + paint, %d bin lines" % bins)
+    print("%-11s %14s %14s %14s %12s" % ("size", "legacy us/line", "ring us/line", "paint us", "identical"))
+    for width, height in sizes:
+        n = min(n_lines, 4 * height)
+        image = gui.QImage(width, height, gui.QImage.Format_RGB32)
+        image.fill(gui.QBLACK)
+        t0 = time.perf_counter()
+        for i in range(n):
+            image = legacy_waterfall_line(gui, image, lines[i % len(lines)], colormap)
+        t_legacy = (time.perf_counter() - t0) / n
+
+        widget = gui.WaterfallWidget(None, colormap=colormap)
+        widget.resize(width, height)
+        widget.grab() # delivers the resize
+        t0 = time.perf_counter()
+        for i in range(n):
+            widget.update_waterfall_data(lines[i % len(lines)])
+        t_ring = (time.perf_counter() - t0) / n
+        t0 = time.perf_counter()
+        shot = widget.grab().toImage()
+        t_paint = time.perf_counter() - t0
+        print("%-11s %14.0f %14.0f %14.0f %12s" % ("%dx%d" % (width, height), t_legacy*1e6, t_ring*1e6,
+                                                   t_paint*1e6, shot.convertToFormat(image.format()) == image))
+
+
+def legacy_spectrum_paint(gui, image, data, filled, col):
+    # SpectrumWidget.paintEvent trace before the numpy polygon: a drawLine
+    # (or lineTo) per bin
+    width, height = image.width(), image.height()
+    painter = gui.QPainter(image)
+    painter.setRenderHint(gui.QPainter.Antialiasing)
+    painter.fillRect(image.rect(), gui.QD_GREY)
+    data_len = len(data)
+    if filled:
+        path = gui.QPainterPath()
+        path.moveTo(0, height)
+        for i in range(data_len):
+            path.lineTo(int(i * width / data_len), height - 1 - int(data[i] / 255.0 * height))
+        path.lineTo(width, height)
+        path.closeSubpath()
+        painter.fillPath(path, col)
+    else:
+        painter.setPen(gui.QPen(col, 1))
+        for i in range(data_len - 1):
+            painter.drawLine(int(i * width / data_len), height - 1 - int(data[i] / 255.0 * height),
+                             int((i + 1) * width / data_len), height - 1 - int(data[i+1] / 255.0 * height))
+    painter.end()
+
+
+def bench_spectrum_widget(n_frames, bins, height=200):
+    gui = offscreen_gui()
+    if gui is None:
+        print("SpectrumWidget: PyQt5 not installed, skipped")
+        return
+    lines = [np.frombuffer(msg, dtype=np.uint8, offset=16) for msg in make_wf_messages(16, bins)]
+    print("SpectrumWidget paint, %d bins, %d px high" % (bins, height))
+    print("%-8s %-7s %12s %12s %14s" % ("width", "filled", "legacy ms", "polygon ms", "peak kept"))
+    for width in (bins // 2, bins, 2 * bins):
+        for filled in (False, True):
+            image = gui.QImage(width, height, gui.QImage.Format_RGB32)
+            t0 = time.perf_counter()
+            for i in range(n_frames):
+                legacy_spectrum_paint(gui, image, lines[i % len(lines)], filled, gui.QYELLOW)
+            t_legacy = (time.perf_counter() - t0) / n_frames
+
+            widget = gui.SpectrumWidget(None)
+            widget.resize(width, height)
+            t0 = time.perf_counter()
+            for i in range(n_frames):
+                widget.spectrum_data = lines[i % len(lines)]
+                widget.filled = filled
+                widget.render(image)
+            t_poly = (time.perf_counter() - t0) / n_frames
+
+            # a one bin carrier: its pixel column has to reach the top
+            peak = np.full(bins, 40, dtype=np.uint8)
+            peak[bins // 3 + 1] = 255
+            widget.spectrum_data = peak
+            widget.render(image)
+            x = (bins // 3 + 1) * width // bins
+            kept = image.pixelColor(x, 2) != gui.QD_GREY
+            print("%-8d %-7s %12.2f %12.2f %14s" % (width, filled, t_legacy*1e3, t_poly*1e3, kept))
+
+
+def legacy_gui_render(sub, waterfall, spectrum, resampler):
+    # MainWindow._update_waterfall_real before the RenderWorker: every line
+    # and the spectrum rasterised by the GUI timer
+    frames = sub.drain()
+    for line in frames["line"]:
+        waterfall.update_waterfall_data(resampler.resample(line, waterfall.width()))
+    if len(frames) > 0:
+        spectrum_data = frames["spectrum"][-1].astype(np.uint8)
+        spectrum.update_spectrum_data(resampler.resample(spectrum_data, spectrum.width()).copy())
+
+
+def bench_render_worker(seconds=3, bins=1024, fps=60, sizes=((1024, 400), (1920, 800)), probe_ms=10):
+    # GUI thread CPU time and how late a GUI timer fires, as a stand in for
+    # key and mouse handling, while W/F frames arrive at fps and are drawn in
+    # the GUI thread or in the RenderWorker. With a single core the worker
+    # competes with the GUI for it and the lateness hardly changes
+    gui = offscreen_gui()
+    if gui is None:
+        print("RenderWorker: PyQt5 not installed, skipped")
+        return
+    app = offscreen_gui.app
+    colormap = gui.generate_cutesdr_colormap()
+    lines = [np.frombuffer(msg, dtype=np.uint8, offset=16).astype(np.float32) for msg in make_wf_messages(64, bins)]
+    print("GUI thread load, %d bin lines at %d fps, %d ms probe timer" % (bins, fps, probe_ms))
+    print("%-11s %-7s %9s %8s %8s %8s %10s" % ("size", "render", "GUI cpu %", "p50 ms", "p99 ms", "max ms",
+                                                "images/s"))
+    for width, height in sizes:
+        for mode in ("gui", "worker"):
+            wf = offline_waterfall(bins)
+            wf.wf_min_db, wf.wf_max_db = -120, -60
+            sub = wf.frame_bus.subscribe("gui", max_pending=height)
+            waterfall = gui.WaterfallWidget(None, colormap=colormap)
+            waterfall.resize(width, height)
+            spectrum = gui.SpectrumWidget(None)
+            spectrum.resize(width, 200)
+            waterfall.show()
+            spectrum.show()
+            app.processEvents()
+            shown = [0]
+            if mode == "worker":
+                worker = gui.RenderWorker(sub, wf, colormap)
+                worker.wf_size = (width, height)
+                worker.spectrum_size = (width, 200)
+                worker.waterfall_ready.connect(waterfall.show_frame)
+                worker.waterfall_ready.connect(lambda frame: shown.__setitem__(0, shown[0] + 1))
+                worker.start()
+                tick = lambda: None
+            else:
+                resampler = backend.bin_resampler()
+                def tick():
+                    legacy_gui_render(sub, waterfall, spectrum, resampler)
+                    shown[0] += 1
+            timer = gui.QTimer()
+            timer.timeout.connect(tick)
+            timer.start(50)
+
+            lateness = []
+            last = [time.perf_counter()]
+            def probe():
+                now = time.perf_counter()
+                lateness.append(now - last[0] - probe_ms / 1000.)
+                last[0] = now
+            probe_timer = gui.QTimer()
+            probe_timer.setTimerType(gui.Qt.PreciseTimer)
+            probe_timer.timeout.connect(probe)
+            probe_timer.start(probe_ms)
+
+            terminate = []
+            def produce():
+                i = 0
+                while not terminate:
+                    wf.frame_bus.publish(lines[i % len(lines)], lines[i % len(lines)], 7000., 8, 1)
+                    i += 1
+                    time.sleep(1. / fps)
+            producer = threading.Thread(target=produce, daemon=True)
+            producer.start()
+            t0 = time.perf_counter()
+            cpu0 = time.thread_time()
+            while time.perf_counter() - t0 < seconds:
+                app.processEvents()
+                time.sleep(0.001)
+            cpu = (time.thread_time() - cpu0) / seconds
+            terminate.append(True)
+            producer.join()
+            timer.stop()
+            probe_timer.stop()
+            if mode == "worker":
+                worker.close()
+            waterfall.close()
+            spectrum.close()
+            lateness = np.maximum(np.array(lateness[1:]), 0) * 1e3
+            print("%-11s %-7s %9.1f %8.1f %8.1f %8.1f %10.1f" % ("%dx%d" % (width, height), mode, cpu*100,
+                                                                np.percentile(lateness, 50),
+                                                                np.percentile(lateness, 99),
+                                                                lateness.max(), shown[0] / seconds))
+
+
+def legacy_dx_labels(gui, fonts, spots, width, wf_y=100):
+    # update_overlays DX labels before the LabelLayout: a QFontMetrics per
+    # label and a row offset that only looks at the previous label
+    elements = {}
+    y_offset = 0
+    old_fbin = -100
+    for spot_id, (call, f_bin) in enumerate(spots):
+        text_width = gui.QFontMetrics(fonts.get("smallfont", gui.QFont("Arial", 10))).width(call)
+        if 0 < f_bin < width:
+            if f_bin - old_fbin <= text_width / 2 + 5:
+                y_offset += 14
+            else:
+                y_offset = 0
+            old_fbin = f_bin
+            elements["dx_%d" % spot_id] = {"text": call, "pos": (int(f_bin - text_width / 2),
+                                                                 int(wf_y + 20 + (y_offset % int(gui.WF_HEIGHT / 2))))}
+    return elements
+
+
+def label_collisions(elements, sizes, height=14):
+    # pairs of overlapping label boxes
+    ids = list(elements)
+    x = np.array([elements[label_id]["pos"][0] for label_id in ids])
+    y = np.array([elements[label_id]["pos"][1] for label_id in ids])
+    w = np.array([sizes[label_id] for label_id in ids])
+    overlap = ((x[:, None] < (x + w)[None, :]) & (x[None, :] < (x + w)[:, None]) &
+               (np.abs(y[:, None] - y[None, :]) < height))
+    return (overlap.sum() - len(ids)) // 2
+
+
+def bench_overlay_layout(n_ticks=200, counts=(50, 500, 5000), width=1024, seed=0):
+    # DX spot labels laid out every 50 ms overlay tick: the old per tick
+    # loop against a LabelLayout placing them once, then only comparing keys
+    gui = offscreen_gui()
+    if gui is None:
+        print("LabelLayout: PyQt5 not installed, skipped")
+        return
+    fonts = {"smallfont": gui.QFont("Arial", 10, gui.QFont.Bold)}
+    rng = np.random.default_rng(seed)
+    print("Overlay DX labels, %d px wide" % width)
+    print("%-7s %12s %12s %12s %10s %10s %12s" % ("spots", "legacy ms", "layout ms", "cached us", "legacy", "packed",
+                                                  "collisions"))
+    for count in counts:
+        spots = sorted(((rng.choice(["DL1ABC", "K1XY", "JA1ZZZ/P", "VK2Q"]), int(x))
+                        for x in rng.uniform(1, width - 1, count)), key=lambda spot: spot[1])
+        t0 = time.perf_counter()
+        for _ in range(n_ticks // 10):
+            elements = legacy_dx_labels(gui, fonts, spots, width)
+        t_legacy = (time.perf_counter() - t0) / (n_ticks // 10)
+        sizes = {label_id: gui.QFontMetrics(fonts["smallfont"]).width(element["text"]) for label_id, element in elements.items()}
+        legacy_collisions = label_collisions(elements, sizes)
+
+        layout = gui.LabelLayout(fonts)
+        labels = [("dx_%d" % i, x, call) for i, (call, x) in enumerate(spots)]
+        t0 = time.perf_counter()
+        placed = layout.place(labels, "smallfont", int(gui.WF_HEIGHT / 2) // 14)
+        t_layout = time.perf_counter() - t0
+        packed = {label_id: {"pos": (left, 120 + 14 * row)} for label_id, text, left, row, size in placed}
+        sizes = {label_id: size[0] for label_id, text, left, row, size in placed}
+
+        key = (7000., 1., width, spots, len(spots))
+        layout.key = key
+        t0 = time.perf_counter()
+        for _ in range(n_ticks):
+            if (7000., 1., width, spots, len(spots)) != layout.key:
+                layout.place(labels, "smallfont")
+        t_cached = (time.perf_counter() - t0) / n_ticks
+        print("%-7d %12.2f %12.2f %12.2f %10d %10d %12s" % (count, t_legacy*1e3, t_layout*1e3, t_cached*1e6,
+                                                           len(elements), len(packed),
+                                                           "%d -> %d" % (legacy_collisions,
+                                                                         label_collisions(packed, sizes))))
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-n", "--frames", type=int, dest="frames", default=2000,
+                      help="number of W/F frames to push")
+    parser.add_option("-b", "--bins", type=int, dest="bins", default=1024,
+                      help="W/F bins per frame")
+    (options, args) = parser.parse_args()
+
+    bench_wf_pipeline(options.frames, options.bins)
+    print()
+    bench_wf_transport(options.frames // 4, options.bins)
+    print()
+    bench_bin_resampler(options.frames, options.bins)
+    print()
+    bench_waterfall_widget(options.frames, options.bins)
+    print()
+    bench_spectrum_widget(options.frames // 20, options.bins)
+    print()
+    bench_render_worker(bins=options.bins)
+    print()
+    bench_overlay_layout()
+    print()
+    bench_resampler(20)
+    print()
+    bench_snd_decode(options.frames)
+    print()
+    bench_adpcm()
+    print()
+    bench_audio_ring(options.frames)
+    print()
+    bench_mixer(options.frames // 4)
+    print()
+    bench_channelizer(options.frames // 4)
+    print()
+    bench_jitter(10, "lan")
+    print()
+    bench_jitter(10, "internet")
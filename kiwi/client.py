@@ -55,11 +55,102 @@ def clamp(x, xmin, xmax):
         return xmax
     return x
 
+# (index, code) -> next index and signed difference, so decoding a nibble is
+# two table lookups instead of the branches in _decode_sample
+def _build_adpcm_tables():
+    next_index, difference = [], []
+    for index in range(len(stepSizeTable)):
+        step = stepSizeTable[index]
+        for code in range(16):
+            next_index.append(clamp(index + indexAdjustTable[code], 0, len(stepSizeTable) - 1))
+            diff = step >> 3
+            if code & 1:
+                diff += step >> 2
+            if code & 2:
+                diff += step >> 1
+            if code & 4:
+                diff += step
+            difference.append(-diff if code & 8 else diff)
+    return next_index, difference
+
+adpcmNextIndex, adpcmDifference = _build_adpcm_tables()
+
+adpcmIndexAdjust = np.array(indexAdjustTable, dtype=np.int32)
+adpcmDifferenceTable = np.array(adpcmDifference, dtype=np.int32)
+
+def _clamped_walk(start, steps, lo, hi, out, scratch, flags):
+    # out[n] = clamp(out[n-1] + steps[n], lo, hi) with out[-1] = start, without
+    # a per sample loop: while only one bound is hit the walk is the cumulative
+    # sum reflected off that bound (x = S - min(0, min(S[:n+1]) - lo), and the
+    # same with max for hi), a new segment starts whenever it reaches the other
+    # bound. Hitting both in one block is rare for ADPCM, so it is a few passes;
+    # when the segments get short (audio clipping on both rails) the rest is
+    # walked one sample at a time.
+    n = len(steps)
+    t, x, upper = 0, start, False
+    segments = 0
+    while t < n:
+        if segments > 4 and segments * 32 > t:
+            walk = steps[t:n].tolist()
+            for i, step in enumerate(walk):
+                x += step
+                if x > hi:
+                    x = hi
+                elif x < lo:
+                    x = lo
+                walk[i] = x
+            out[t:n] = walk
+            break
+        segments += 1
+        s, m, f = out[t:n], scratch[t:n], flags[t:n]
+        np.cumsum(steps[t:n], out=s)
+        s += x
+        if upper:
+            np.maximum.accumulate(s, out=m)
+            m -= hi
+            np.maximum(m, 0, out=m)
+            s -= m
+            np.less(s, lo, out=f)
+        else:
+            np.minimum.accumulate(s, out=m)
+            m -= lo
+            np.minimum(m, 0, out=m)
+            s -= m
+            np.greater(s, hi, out=f)
+        hit = int(f.argmax())
+        if not f[hit]:
+            break
+        # the reflected walk is exact up to here, where the other bound clamps it
+        x = lo if upper else hi
+        s[hit] = x
+        t += hit + 1
+        upper = not upper
+    return out
+
 class ImaAdpcmDecoder(object):
+    # Block decoder: the nibbles are unpacked with numpy and both recurrences
+    # (step index, clamped to the step table, and sample, clamped to int16)
+    # are run as clamped cumulative sums (_clamped_walk) over preallocated
+    # buffers, the per (index, code) differences come from adpcmDifferenceTable.
+    # Bit exact with _decode_sample, index/prev carry over between calls and
+    # reset() restarts them (W/F frames are coded independently).
     def __init__(self):
+        self.reset()
+        self._alloc(0)
+
+    def reset(self):
         self.index = 0
         self.prev = 0
 
+    def _alloc(self, n):
+        self._size = n
+        self._codes = np.zeros(n, dtype=np.uint8)
+        self._steps = np.zeros(n, dtype=np.int32)
+        self._walk = np.zeros(n + 1, dtype=np.int32)
+        self._scratch = np.zeros(n, dtype=np.int32)
+        self._flags = np.zeros(n, dtype=bool)
+        self._out = np.zeros(n, dtype=np.int16)
+
     def _decode_sample(self, code):
         step = stepSizeTable[self.index]
         self.index = clamp(self.index + indexAdjustTable[code], 0, len(stepSizeTable) - 1)
@@ -76,15 +167,41 @@ class ImaAdpcmDecoder(object):
         self.prev = sample
         return sample
 
+    def decode_block(self, data, out=None):
+        # int16 samples, 2 per byte low nibble first, into out or into the
+        # decoder's own buffer (valid until the next call)
+        if isinstance(data, str):
+            data = bytearray(map(ord, data))
+        raw = np.frombuffer(data, dtype=np.uint8)
+        n = 2 * len(raw)
+        if n > self._size:
+            self._alloc(n)
+        if out is None:
+            out = self._out[:n]
+        if n == 0:
+            return out
+        codes, steps, scratch, flags = self._codes[:n], self._steps[:n], self._scratch[:n], self._flags[:n]
+        np.bitwise_and(raw, 0x0F, out=codes[0::2])
+        np.right_shift(raw, 4, out=codes[1::2])
+
+        # step index before each code: walk[0] is the carried index
+        walk = self._walk[:n + 1]
+        walk[0] = self.index
+        np.take(adpcmIndexAdjust, codes, out=steps, mode='clip')
+        _clamped_walk(self.index, steps, 0, len(stepSizeTable) - 1, walk[1:], scratch, flags)
+        self.index = int(walk[n])
+
+        walk = walk[:n]
+        walk <<= 4
+        walk |= codes
+        np.take(adpcmDifferenceTable, walk, out=steps, mode='clip')
+        _clamped_walk(self.prev, steps, -32768, 32767, scratch, walk, flags)
+        self.prev = int(scratch[n - 1])
+        np.copyto(out, scratch, casting='unsafe')
+        return out
+
     def decode(self, data):
-        fcn = ord if isinstance(data, str) else lambda x : x
-        samples = array.array('h')
-        for b in map(fcn, data):
-            sample0 = self._decode_sample(b & 0x0F)
-            sample1 = self._decode_sample(b >> 4)
-            samples.append(sample0)
-            samples.append(sample1)
-        return samples
+        return array.array('h', self.decode_block(data).tobytes())
 
 #
 # KiwiSDR WebSocket client
@@ -474,7 +591,7 @@ class KiwiSDRStream(KiwiSDRStreamBase):
         if self._options.raw is True:
             return self._process_waterfall_samples_raw(data, seq)
         if self._compression:
-            self._decoder.__init__()   # reset decoder each sample
+            self._decoder.reset()   # reset decoder each sample
             samples = self._decoder.decode(data)
             samples = samples[:len(samples)-10]   # remove decompression tail
         else:
@@ -2,12 +2,14 @@
 import sys
 import os
 from PyQt5.QtWidgets import QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, QGridLayout, QWidget, QLabel, QStackedLayout, QFrame, QPushButton, QGroupBox, QSlider, QTabWidget, QButtonGroup, QLineEdit, QCheckBox, QComboBox
-from PyQt5.QtCore import Qt, QSize, QTimer, QRect, QDateTime, QPoint, pyqtSignal
-from PyQt5.QtGui import QFont, QColor, QPainter, QPen, QPainterPath, QImage, QFontDatabase, QBrush, QFontMetrics
+from PyQt5.QtCore import Qt, QObject, QSize, QTimer, QRect, QDateTime, QPoint, pyqtSignal
+from PyQt5.QtGui import QFont, QColor, QPainter, QPen, QPainterPath, QImage, QFontDatabase, QBrush, QFontMetrics, QPolygonF
 
 import numpy as np
+import heapq
 import math
 import threading
+import time
 from settings_manager import SettingsManager
 from collections import deque
 from typing import Any, Dict
@@ -15,6 +17,7 @@ from typing import Any, Dict
 # Import pure backend (NO pygame)
 import backend
 import utils_supersdr
+from wf_archive import wf_archive
 
 kiwi_waterfall = backend.kiwi_waterfall
 kiwi_sound = backend.kiwi_sound
@@ -58,6 +61,24 @@ parser.add_option("--rigctld-host", type=str,
                   help="rigctld host (default: localhost)", dest="rigctld_host", default="localhost")
 parser.add_option("--rigctld-port", type=int,
                   help="rigctld port (default: 4532)", dest="rigctld_port", default=4532)
+parser.add_option("--wf-archive", type=str,
+                  help="waterfall history file to record into and scroll back", dest="wf_archive", default=None)
+parser.add_option("--compress", action="store_true",
+                  help="request IMA-ADPCM compressed waterfall and audio (slow links)", dest="compression", default=False)
+parser.add_option("--wf-archive-size", type=int,
+                  help="waterfall history file size in MB (default: 1024)", dest="wf_archive_size", default=1024)
+parser.add_option("--audio-latency", type=int,
+                  help="audio playback latency target in ms (default: 10 Kiwi frames, ~430)", dest="audio_latency", default=None)
+parser.add_option("--audio-prefill", type=int,
+                  help="start playing once this many ms of audio are buffered (default: 100)", dest="audio_prefill", default=None)
+parser.add_option("--rec-rotate-mb", type=int,
+                  help="start a new audio recording file every N MB", dest="rec_rotate_mb", default=None)
+parser.add_option("--rec-rotate-min", type=int,
+                  help="start a new audio recording file every N minutes", dest="rec_rotate_min", default=None)
+parser.add_option("--iq-channels", type=str,
+                  help="open the RX in IQ mode and demodulate more channels locally, e.g. 7074USB,7030CW", dest="iq_channels", default=None)
+parser.add_option("--bin-resample", type="choice", choices=backend.bin_resampler.MODES,
+                  help="how W/F bins are fitted to the screen width: max (default, keeps narrow carriers), mean or nearest", dest="bin_resample", default="max")
 
 options = vars(parser.parse_args()[0])
 
@@ -114,6 +135,100 @@ def generate_cutesdr_colormap():
         colormap.append(QColor(r, g, b))
     return colormap
 
+class SpectrumRenderer():
+    """Spectrum trace and dB grid, painted on the widget or on a QImage in
+    the render thread."""
+    def __init__(self):
+        self.D_GREEN = QD_GREEN
+        self.trace_layout = None
+
+    def _trace_layout(self, data_len, width, height, filled):
+        """Cached per size: bin -> x, and with more bins than pixels the first
+        and last bin of each pixel column, whose bins are reduced to 4 points."""
+        key = (data_len, width, height, filled)
+        if self.trace_layout is not None and self.trace_layout[0] == key:
+            return self.trace_layout
+        xs = np.arange(data_len) * width // data_len
+        starts = ends = None
+        if data_len > width:
+            starts = np.flatnonzero(np.diff(xs, prepend=-1))
+            ends = np.append(starts[1:], data_len) - 1
+            xs = np.repeat(xs[starts], 4)
+            if filled:
+                # a zero width spike fills nothing, the column max spans its pixel
+                xs[2::4] += 1
+                xs[3::4] += 1
+        n = len(xs)
+        # filled: closed down to the bottom corners, as the old path
+        polygon = QPolygonF(n + 2 if filled else n)
+        ptr = polygon.data()
+        ptr.setsize(len(polygon) * 16)
+        points = np.frombuffer(ptr, dtype=np.float64).reshape(len(polygon), 2)
+        trace = points[1:-1] if filled else points
+        trace[:, 0] = xs
+        if filled:
+            points[0] = (0, height)
+            points[-1] = (width, height)
+        y = np.zeros(data_len, dtype=np.float64)
+        self.trace_layout = (key, starts, ends, polygon, trace, y)
+        return self.trace_layout
+
+    def _trace(self, data, width, height, filled):
+        """QPolygonF of the spectrum from numpy, one point per bin, or per
+        pixel column its first, lowest, highest and last bin so peaks survive."""
+        key, starts, ends, polygon, trace, y = self._trace_layout(len(data), width, height, filled)
+        # same rounding as height - 1 - int(v / 255.0 * height)
+        np.divide(data, 255.0, out=y)
+        y *= height
+        np.trunc(y, out=y)
+        np.subtract(height - 1, y, out=y)
+        if starts is None:
+            trace[:, 1] = y
+        else:
+            # screen y grows downwards: the highest bin is the minimum
+            trace[0::4, 1] = y[starts]
+            if filled:
+                trace[1::4, 1] = np.minimum.reduceat(y, starts)
+                trace[2::4, 1] = trace[1::4, 1]
+            else:
+                trace[1::4, 1] = np.maximum.reduceat(y, starts)
+                trace[2::4, 1] = np.minimum.reduceat(y, starts)
+            trace[3::4, 1] = y[ends]
+        return polygon
+
+    def paint(self, painter, data, width, height, wf_auto_scaling=True, wf_min_db=-120, wf_max_db=-60,
+              filled=False, col=QYELLOW):
+        """Background, trace and, with manual scaling, the 10 dB lines."""
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.fillRect(0, 0, width, height, QD_GREY)
+
+        if len(data) == 0:
+            return
+
+        trace = self._trace(data, width, height, filled)
+        if filled:
+            painter.setPen(Qt.NoPen)
+            painter.setBrush(QBrush(col))
+            painter.drawPolygon(trace)
+        else:
+            painter.setPen(QPen(col, 1))
+            painter.drawPolyline(trace)
+        
+        if not wf_auto_scaling:
+            wf_dyn_range = wf_max_db - wf_min_db
+            if wf_dyn_range > 0:
+                min_wf_10 = int(wf_min_db / 10) * 10
+                max_wf_10 = int(wf_max_db / 10) * 10
+                
+                pen = QPen(self.D_GREEN, 1, Qt.DotLine)
+                painter.setPen(pen)
+
+                for db_val in range(min_wf_10, max_wf_10 + 1, 10):
+                    if wf_min_db <= db_val <= wf_max_db:
+                        y_div = height - 1 - int((db_val - wf_min_db) / wf_dyn_range * height)
+                        if 0 <= y_div < height:
+                            painter.drawLine(0, y_div, width, y_div)
+
 class SpectrumWidget(QWidget):
     def __init__(self, parent=None, colormap=None, spectrum_height=SPECTRUM_HEIGHT, display_width=DISPLAY_WIDTH):
         super().__init__(parent)
@@ -128,7 +243,9 @@ class SpectrumWidget(QWidget):
         # Don't store fixed dimensions - use dynamic width()/height()
         self.filled = False
         self.col = QYELLOW
-        self.D_GREEN = QD_GREEN
+        self.renderer = SpectrumRenderer()
+        # finished image from the RenderWorker, painted instead of spectrum_data
+        self.frame = None
         
     def update_spectrum_data(self, spectrum_data, wf_auto_scaling=True, wf_min_db=-120, wf_max_db=-60, filled=False, col=QYELLOW):
         self.spectrum_data = spectrum_data
@@ -137,9 +254,21 @@ class SpectrumWidget(QWidget):
         self.wf_max_db = wf_max_db
         self.filled = filled
         self.col = col
+        self.frame = None
+        self.update()
+
+    def show_frame(self, frame):
+        """Slot for RenderWorker.spectrum_ready, the previous image goes back to it."""
+        self.frame = frame
+        frame.swap.taken(frame.index)
         self.update()
 
     def paintEvent(self, event):
+        if self.frame is not None:
+            painter = QPainter(self)
+            painter.drawImage(0, 0, self.frame.image)
+            return
+
         if self.spectrum_data is None:
             return
 
@@ -151,53 +280,78 @@ class SpectrumWidget(QWidget):
             return
 
         painter = QPainter(self)
-        painter.setRenderHint(QPainter.Antialiasing)
-
-        painter.fillRect(self.rect(), QD_GREY)
-
-        data_len = len(self.spectrum_data)
-        if data_len == 0:
-            return
-
-        if self.filled:
-            path = QPainterPath()
-            path.moveTo(0, height)
-            for i in range(data_len):
-                # Map data index to screen x coordinate
-                x = int(i * width / data_len)
-                v_scaled = self.spectrum_data[i]
-                y = height - 1 - int(v_scaled / 255.0 * height)
-                path.lineTo(x, y)
-            path.lineTo(width, height)
-            path.closeSubpath()
-            
-            painter.fillPath(path, self.col)
-        else:
-            pen = QPen(self.col, 1)
-            painter.setPen(pen)
-            
-            # Draw line connecting spectrum points
-            for i in range(data_len - 1):
-                x1 = int(i * width / data_len)
-                x2 = int((i + 1) * width / data_len)
-                y1 = height - 1 - int(self.spectrum_data[i] / 255.0 * height)
-                y2 = height - 1 - int(self.spectrum_data[i+1] / 255.0 * height)
-                painter.drawLine(x1, y1, x2, y2)
-        
-        if not self.wf_auto_scaling:
-            wf_dyn_range = self.wf_max_db - self.wf_min_db
-            if wf_dyn_range > 0:
-                min_wf_10 = int(self.wf_min_db / 10) * 10
-                max_wf_10 = int(self.wf_max_db / 10) * 10
-                
-                pen = QPen(self.D_GREEN, 1, Qt.DotLine)
-                painter.setPen(pen)
-
-                for db_val in range(min_wf_10, max_wf_10 + 1, 10):
-                    if self.wf_min_db <= db_val <= self.wf_max_db:
-                        y_div = height - 1 - int((db_val - self.wf_min_db) / wf_dyn_range * height)
-                        if 0 <= y_div < height:
-                            painter.drawLine(0, y_div, width, y_div)
+        self.renderer.paint(painter, self.spectrum_data, width, height, self.wf_auto_scaling,
+                            self.wf_min_db, self.wf_max_db, self.filled, self.col)
+
+class WaterfallRaster():
+    """Live waterfall image as a ring of rows: the newest line is row head,
+    older ones follow it downwards and wrap to the top. Only numpy and a
+    QImage, so it can be filled outside the GUI thread."""
+    def __init__(self, colormap, width, height):
+        # colormap as QImage.Format_RGB32 pixel values, a row is one np.take
+        self.lut = np.array([c.rgb() for c in colormap], dtype=np.uint32) if colormap else None
+        self.line_cols = None # (line length, width, data index per screen column)
+        self.new_image(width, height)
+
+    def new_image(self, width, height, pixels=None):
+        if pixels is None:
+            pixels = np.full((height, width), QBLACK.rgb(), dtype=np.uint32)
+        # the QImage does not own the pixels, keep them alive with it
+        self.pixels = pixels
+        self.image = QImage(pixels.data, width, height, width * 4, QImage.Format_RGB32)
+        self.head = 0
+
+    def unrolled(self, out=None):
+        """The pixels with the newest line at the top."""
+        if out is None:
+            return np.roll(self.pixels, -self.head, axis=0)
+        rows = len(self.pixels) - self.head
+        out[:rows] = self.pixels[self.head:]
+        out[rows:] = self.pixels[:self.head]
+        return out
+
+    def resize(self, width, height):
+        """New size, the old image scaled to it."""
+        pixels = self.unrolled()
+        old = QImage(pixels.data, pixels.shape[1], pixels.shape[0], pixels.shape[1] * 4, QImage.Format_RGB32)
+        # Scale the old image to fit new dimensions using smooth interpolation
+        scaled_old = old.scaled(width, height, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        scaled_old = scaled_old.convertToFormat(QImage.Format_RGB32)
+        # copied into the new ring with numpy: painting on the QImage would
+        # detach it from the pixels the lines are written to
+        bits = scaled_old.constBits()
+        bits.setsize(scaled_old.byteCount())
+        rows = np.frombuffer(bits, dtype=np.uint32).reshape(height, scaled_old.bytesPerLine() // 4)
+        self.new_image(width, height, rows[:, :width].copy())
+
+    def add_line(self, line):
+        height, width = self.pixels.shape
+        line_len = len(line)
+        if self.lut is None or line_len == 0:
+            return False
+        if self.line_cols is None or self.line_cols[:2] != (line_len, width):
+            # screen x -> data index, nearest, as int(x * line_len / width)
+            cols = np.minimum(np.arange(width) * line_len // width, line_len - 1)
+            self.line_cols = (line_len, width, cols, np.zeros(width, dtype=np.intp))
+        cols, color_idx = self.line_cols[2:]
+
+        # the new line goes on top: one row up in the ring instead of
+        # moving the whole image down
+        self.head = (self.head - 1) % height
+        values = np.take(line, cols)
+        np.clip(values, 0, len(self.lut) - 1, out=values)
+        np.copyto(color_idx, values, casting='unsafe')
+        np.take(self.lut, color_idx, out=self.pixels[self.head])
+        return True
+
+    def draw(self, painter):
+        # the ring from its head row down, then the rows above the head
+        image = self.image
+        head = self.head
+        width, height = image.width(), image.height()
+        painter.drawImage(QPoint(0, 0), image, QRect(0, head, width, height - head))
+        if head:
+            painter.drawImage(QPoint(0, height - head), image, QRect(0, 0, width, head))
 
 class WaterfallWidget(QWidget):
     def __init__(self, parent=None, colormap=None, wf_height=WF_HEIGHT, display_width=DISPLAY_WIDTH):
@@ -207,10 +361,17 @@ class WaterfallWidget(QWidget):
         # self.setMinimumHeight(wf_height)
         # self.setMaximumHeight(wf_height)
         self.colormap = colormap
-        
+        # bins -> pixels for archived pages, shared with the live lines
+        self.resampler = backend.bin_resampler()
+
         # Start with initial dimensions
-        self.waterfall_image = QImage(display_width, wf_height, QImage.Format_RGB32)
-        self.waterfall_image.fill(QBLACK)
+        self.raster = WaterfallRaster(colormap, display_width, wf_height)
+        # finished image from the RenderWorker, painted instead of the raster
+        self.frame = None
+
+        # archived page shown instead of the live waterfall while scrolling back
+        self.history_image = None
+        self.history_pixels = None
 
     def resizeEvent(self, event):
         """Handle widget resize by recreating waterfall image"""
@@ -219,23 +380,9 @@ class WaterfallWidget(QWidget):
         new_width = self.width()
         new_height = self.height()
         
-        if new_width > 0 and new_height > 0:
-            # Create new image with new size
-            new_image = QImage(new_width, new_height, QImage.Format_RGB32)
-            new_image.fill(QBLACK)
-            
-            # Scale and copy old image if it exists
-            if not self.waterfall_image.isNull():
-                painter = QPainter(new_image)
-                painter.setRenderHint(QPainter.SmoothPixmapTransform)
-                # Scale old image to fit new dimensions using smooth interpolation
-                scaled_old = self.waterfall_image.scaled(new_width, new_height, 
-                                                         Qt.IgnoreAspectRatio, 
-                                                         Qt.SmoothTransformation)
-                painter.drawImage(0, 0, scaled_old)
-                painter.end()
-            
-            self.waterfall_image = new_image
+        # with a RenderWorker its own raster follows the size
+        if new_width > 0 and new_height > 0 and self.frame is None:
+            self.raster.resize(new_width, new_height)
 
     def update_waterfall_data(self, new_wf_line):
         if new_wf_line is None:
@@ -248,45 +395,207 @@ class WaterfallWidget(QWidget):
             return
         
         # Ensure image matches current widget size
-        if (self.waterfall_image.isNull() or 
-            self.waterfall_image.width() != width or 
-            self.waterfall_image.height() != height):
-            self.waterfall_image = QImage(width, height, QImage.Format_RGB32)
-            self.waterfall_image.fill(QBLACK)
+        if self.raster.pixels.shape != (height, width):
+            self.raster.new_image(width, height)
             return  # Skip this frame after resize
-        
-        if self.colormap is None:
+
+        if self.raster.add_line(new_wf_line):
+            self.update()
+
+    def show_frame(self, frame):
+        """Slot for RenderWorker.waterfall_ready, the previous image goes back to it."""
+        self.frame = frame
+        frame.swap.taken(frame.index)
+        self.update()
+
+    def show_history(self, lines):
+        """Show archived lines (newest first), or go back to live with None"""
+        if lines is None or self.colormap is None:
+            self.history_image = None
+            self.history_pixels = None
+            self.update()
+            return
+        width = self.width()
+        height = self.height()
+        if width <= 0 or height <= 0:
             return
 
-        # Shift image down by 1 pixel
-        temp_image = QImage(width, height, QImage.Format_RGB32)
-        painter = QPainter(temp_image)
-        painter.setRenderHint(QPainter.SmoothPixmapTransform)
-        # Copy old image shifted down by 1 pixel
-        painter.drawImage(0, 1, self.waterfall_image, 0, 0, width, height - 1)
-        painter.end()
-        self.waterfall_image = temp_image
-
-        # Draw new line at top, scaling it to current width
-        line_len = len(new_wf_line)
-        for x in range(width):
-            # Map screen x coordinate to data index
-            data_idx = int(x * line_len / width) if line_len > 0 else 0
-            data_idx = min(data_idx, line_len - 1)
-            
-            value = new_wf_line[data_idx]
-            color_index = int(np.clip(value, 0, 254))
-            color = self.colormap[color_index]
-            self.waterfall_image.setPixelColor(x, 0, color)
-        
+        pixels = np.full((height, width), QBLACK.rgb(), dtype=np.uint32)
+        n = min(len(lines), height)
+        if n > 0:
+            lut = self.raster.lut
+            color_idx = np.clip(self.resampler.resample(lines[:n], width), 0, len(lut) - 1).astype(np.intp)
+            np.take(lut, color_idx, out=pixels[:n])
+        # the QImage does not own the pixels, keep them alive with it
+        self.history_pixels = pixels
+        self.history_image = QImage(pixels.data, width, height, width * 4, QImage.Format_RGB32)
         self.update()
 
     def paintEvent(self, event):
         painter = QPainter(self)
         painter.setRenderHint(QPainter.SmoothPixmapTransform)
         painter.setRenderHint(QPainter.Antialiasing)
-        if not self.waterfall_image.isNull():
-            painter.drawImage(0, 0, self.waterfall_image)
+        if self.history_image is not None:
+            painter.drawImage(0, 0, self.history_image)
+        elif self.frame is not None:
+            painter.drawImage(0, 0, self.frame.image)
+        elif not self.raster.image.isNull():
+            self.raster.draw(painter)
+
+class RenderFrame():
+    """A finished image handed to the GUI, index is its buffer in swap."""
+    def __init__(self, swap, index, image, pixels=None):
+        self.swap = swap
+        self.index = index
+        self.image = image
+        # the QImage does not own numpy pixels, keep them alive with it
+        self.pixels = pixels
+
+class ImageSwap():
+    """Double buffer between the render thread and the GUI: the worker paints
+    the back buffer while the GUI shows the front one, and only hands a new
+    image over once the GUI has taken the last."""
+    def __init__(self):
+        self.buffers = [None, None]
+        self.front = 1
+        self.pending = False
+        self.sent_t = 0.
+        self.take_s = 0. # smoothed time from publish() until the GUI takes an image
+
+    def back(self):
+        """Index of the buffer the worker may paint, None while one is pending."""
+        return None if self.pending else 1 - self.front
+
+    def publish(self):
+        self.sent_t = time.monotonic()
+        self.pending = True
+
+    def taken(self, index):
+        self.take_s += 0.1 * (time.monotonic() - self.sent_t - self.take_s)
+        # front first: the worker only looks at it once pending is cleared
+        self.front = index
+        self.pending = False
+
+    def delay_s(self):
+        """How long the GUI takes an image, at least as long as the pending one waits."""
+        if self.pending:
+            return max(self.take_s, time.monotonic() - self.sent_t)
+        return self.take_s
+
+class RenderWorker(QObject):
+    """Colour maps and paints the live waterfall and spectrum from a frame_bus
+    subscription in its own thread, the GUI thread only blits the images."""
+    waterfall_ready = pyqtSignal(object)
+    spectrum_ready = pyqtSignal(object)
+    MAX_FPS = 30
+    IDLE_S = 0.5
+
+    def __init__(self, frames, kiwi_wf, colormap, resample_mode="max"):
+        super().__init__()
+        self.frames = frames
+        self.kiwi_wf = kiwi_wf
+        # bin_resampler reuses its buffers, not shared with the GUI thread
+        self.resampler = backend.bin_resampler(resample_mode)
+        self.raster = WaterfallRaster(colormap, DISPLAY_WIDTH, WF_HEIGHT)
+        self.spectrum = SpectrumRenderer()
+        self.spectrum_data = None
+        self.spectrum_filled = False
+        self.spectrum_col = QYELLOW
+        # widget sizes, (width, height) set by the GUI thread
+        self.wf_size = (DISPLAY_WIDTH, WF_HEIGHT)
+        self.spectrum_size = (DISPLAY_WIDTH, SPECTRUM_HEIGHT)
+        self.wf_swap = ImageSwap()
+        self.spectrum_swap = ImageSwap()
+        # lines drawn into the raster but not handed over yet
+        self.wf_dirty = False
+        self.spectrum_dirty = False
+        self.last_render = 0.
+        self.render_s = 0. # smoothed render() time
+        self.terminate = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        self.terminate = True
+        self.frames.ready.set()
+        self.thread.join(timeout=2)
+
+    def run(self):
+        while not self.terminate:
+            # an image still pending is retried at the frame rate
+            dirty = self.wf_dirty or self.spectrum_dirty
+            self.frames.wait(1. / self.MAX_FPS if dirty else self.IDLE_S)
+            # lines arriving meanwhile are drawn together with the next image
+            wait = self.last_render + 1. / self.MAX_FPS - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self.last_render = time.monotonic()
+            self.render(self.frames.drain())
+            self.render_s += 0.1 * (time.monotonic() - self.last_render - self.render_s)
+
+    def paint_rate(self):
+        """Waterfall images per second the worker and the GUI get on screen:
+        rendering one plus the GUI taking it, at most MAX_FPS."""
+        return 1. / max(1. / self.MAX_FPS, self.render_s + self.wf_swap.delay_s())
+
+    def render(self, frames):
+        width, height = self.wf_size
+        if width > 0 and height > 0:
+            if self.raster.pixels.shape != (height, width):
+                self.raster.resize(width, height)
+                self.wf_dirty = True
+            for line in frames["line"]:
+                if len(line) != width:
+                    line = self.resampler.resample(line, width)
+                self.wf_dirty |= self.raster.add_line(line)
+            if self.wf_dirty:
+                self.hand_over_waterfall()
+
+        if len(frames) > 0:
+            self.spectrum_data = frames["spectrum"][-1].astype(np.uint8)
+            self.spectrum_dirty = True
+        if self.spectrum_dirty and self.spectrum_data is not None:
+            self.hand_over_spectrum()
+
+    def hand_over_waterfall(self):
+        swap = self.wf_swap
+        index = swap.back()
+        if index is None:
+            return
+        height, width = self.raster.pixels.shape
+        buffer = swap.buffers[index]
+        if buffer is None or buffer.pixels.shape != (height, width):
+            pixels = np.empty((height, width), dtype=np.uint32)
+            image = QImage(pixels.data, width, height, width * 4, QImage.Format_RGB32)
+            buffer = swap.buffers[index] = RenderFrame(swap, index, image, pixels)
+        self.raster.unrolled(out=buffer.pixels)
+        swap.publish()
+        self.wf_dirty = False
+        self.waterfall_ready.emit(buffer)
+
+    def hand_over_spectrum(self):
+        swap = self.spectrum_swap
+        index = swap.back()
+        width, height = self.spectrum_size
+        if index is None or width <= 0 or height <= 0:
+            return
+        buffer = swap.buffers[index]
+        if buffer is None or buffer.image.size() != QSize(width, height):
+            image = QImage(width, height, QImage.Format_RGB32)
+            buffer = swap.buffers[index] = RenderFrame(swap, index, image)
+        data = self.spectrum_data
+        if len(data) != width:
+            data = self.resampler.resample(data, width)
+        wf = self.kiwi_wf
+        painter = QPainter(buffer.image)
+        self.spectrum.paint(painter, data, width, height, wf.wf_auto_scaling, int(wf.wf_min_db),
+                            int(wf.wf_max_db), self.spectrum_filled, self.spectrum_col)
+        painter.end()
+        swap.publish()
+        self.spectrum_dirty = False
+        self.spectrum_ready.emit(buffer)
 
 class TextOverlayWidget(QWidget):
     def __init__(self, parent=None, fonts=None):
@@ -298,7 +607,10 @@ class TextOverlayWidget(QWidget):
         self.text_elements = {}
 
     def update_text_elements(self, new_elements):
-        self.text_elements.update(new_elements)
+        """Replace the shown labels with new_elements, labels not in it are gone."""
+        if new_elements is self.text_elements:
+            return
+        self.text_elements = new_elements
         self.update()
 
     def paintEvent(self, event):
@@ -321,8 +633,13 @@ class TextOverlayWidget(QWidget):
 
             painter.setPen(color)
 
-            font_metrics = painter.fontMetrics()
-            text_rect = font_metrics.boundingRect(QRect(0, 0, 1, 1), Qt.AlignLeft, text) 
+            size = element.get('size')
+            if size is None:
+                font_metrics = painter.fontMetrics()
+                text_rect = font_metrics.boundingRect(QRect(0, 0, 1, 1), Qt.AlignLeft, text)
+            else:
+                # measured by the LabelLayout
+                text_rect = QRect(0, 0, size[0], size[1])
 
             if bgcolor:
                 bg_rect = QRect(pos[0], pos[1], text_rect.width(), text_rect.height())
@@ -334,6 +651,77 @@ class TextOverlayWidget(QWidget):
             painter.drawText(QRect(int(-text_rect.width()/2), int(-text_rect.height()/2), text_rect.width(), text_rect.height()), Qt.AlignCenter, text)
             painter.restore()
 
+class LabelLayout():
+    """Frequency labels of the overlays: text is measured once per (font,
+    string), colliding labels are packed into rows, and the laid out labels
+    are kept until the key of what they depend on changes."""
+    GAP = 5 # min pixels between labels on a row
+    MAX_SIZES = 4096
+
+    def __init__(self, fonts):
+        self.fonts = fonts
+        self.metrics = {}
+        self.sizes = {}
+        self.schedules = {} # EIBI "hhmm-hhmm" -> (start, end) in hours, None if malformed
+        self.key = None
+        self.text_elements = {}
+        self.memory_labels = []
+
+    def text_size(self, font_name, text):
+        """(width, height) of text as TextOverlayWidget paints it."""
+        size = self.sizes.get((font_name, text))
+        if size is None:
+            metrics = self.metrics.get(font_name)
+            if metrics is None:
+                metrics = self.metrics[font_name] = QFontMetrics(self.fonts.get(font_name) or QFont("Arial", 10))
+            rect = metrics.boundingRect(QRect(0, 0, 1, 1), Qt.AlignLeft, text)
+            if len(self.sizes) >= self.MAX_SIZES:
+                self.sizes.clear()
+            size = self.sizes[(font_name, text)] = (rect.width(), rect.height())
+        return size
+
+    def schedule(self, times):
+        """On air hours of an EIBI record, parsed once per string."""
+        if times not in self.schedules:
+            try:
+                self.schedules[times] = (int(times[:2]) + int(times[2:4]) / 60,
+                                         int(times[5:7]) + int(times[7:9]) / 60)
+            except ValueError:
+                self.schedules[times] = None
+        return self.schedules[times]
+
+    def rows(self, spans, max_rows=None):
+        """Row of each (left, right) span so spans on a row do not collide,
+        the lowest free row first, -1 once max_rows are taken. Spans sorted
+        by left edge, busy rows in a heap by right edge and free rows in a
+        heap by number: O(n log n)."""
+        rows = [-1] * len(spans)
+        busy, free = [], []
+        n_rows = 0
+        for i in sorted(range(len(spans)), key=lambda i: spans[i][0]):
+            left, right = spans[i]
+            while busy and busy[0][0] + self.GAP < left:
+                heapq.heappush(free, heapq.heappop(busy)[1])
+            if free:
+                row = heapq.heappop(free)
+            elif max_rows is None or n_rows < max_rows:
+                row = n_rows
+                n_rows += 1
+            else:
+                continue
+            rows[i] = row
+            heapq.heappush(busy, (right, row))
+        return rows
+
+    def place(self, labels, font_name, max_rows=None):
+        """labels: (id, x center, text). Returns (id, text, left x, row, size)
+        of those that fit."""
+        sizes = [self.text_size(font_name, text) for _, _, text in labels]
+        spans = [(x - size[0] / 2, x + size[0] / 2) for (_, x, _), size in zip(labels, sizes)]
+        rows = self.rows(spans, max_rows)
+        return [(label[0], label[2], int(span[0]), row, size)
+                for label, span, row, size in zip(labels, spans, rows, sizes) if row >= 0]
+
 def dbm_to_s_unit(dbm):
     """Convert dBm to standard S-unit notation
     
@@ -467,6 +855,59 @@ class SMeterWidget(QWidget):
                       int(smeter_center_x + self.s_meter_radius + self.s_meter_border + self.s_meter_border),
                       int(smeter_center_y + self.s_meter_radius + self.s_meter_border + self.s_meter_border))
 
+class LatencyWidget(QWidget):
+    """Overlay with the live audio latency histograms of a kiwi_sound."""
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setAttribute(Qt.WA_TranslucentBackground)
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.latency = None
+        self.box_width = 320
+        self.box_height = 150
+
+    def update_latency(self, latency):
+        self.latency = latency
+        self.update()
+
+    def paintEvent(self, event):
+        latency = self.latency
+        if latency is None:
+            return
+        painter = QPainter(self)
+        x0 = self.width() - self.box_width - 10
+        y0 = 10
+        painter.fillRect(x0, y0, self.box_width, self.box_height, QColor(0, 0, 0, 180))
+        painter.setFont(QFont("Arial", 8))
+
+        rows = ((latency.speaker, QYELLOW, "NET>SPK"), (latency.residence, QORANGE, "QUEUE"))
+        plot_h = (self.box_height - 20) // len(rows)
+        for i, (hist, color, label) in enumerate(rows):
+            top = y0 + 5 + i * plot_h
+            bottom = top + plot_h - 15
+            # only the bins that ever got a count, with some room around them
+            used = np.flatnonzero(hist)
+            if len(used):
+                lo = max(int(used[0]) - 2, 0)
+                hi = min(int(used[-1]) + 3, len(hist))
+                view = hist[lo:hi]
+                bar_w = (self.box_width - 10) / len(view)
+                scale = (bottom - top - 12) / max(int(view.max()), 1)
+                painter.setPen(Qt.NoPen)
+                painter.setBrush(QBrush(color))
+                for j, count in enumerate(view):
+                    if count:
+                        h = max(int(count * scale), 1)
+                        painter.drawRect(int(x0 + 5 + j * bar_w), bottom - h, max(int(bar_w), 1), h)
+                p50 = latency.percentile(hist, 50)
+                p95 = latency.percentile(hist, 95)
+                text = f"{label} p50 {p50}ms p95 {p95}ms ({lo*latency.BIN_MS}-{hi*latency.BIN_MS}ms)"
+            else:
+                text = f"{label}: no audio played yet"
+            painter.setPen(QPen(QWHITE, 1))
+            painter.drawText(x0 + 5, top + 10, text)
+        painter.drawText(x0 + 5, y0 + self.box_height - 5,
+                         f"LOST {latency.lost} SKIPPED {latency.skipped}  SHIFT+E hide, CTRL+E export")
+
 class TuneOverlayWidget(QWidget):
     tune_clicked = pyqtSignal(float)
     wf_dragged = pyqtSignal(float)
@@ -997,6 +1438,24 @@ class SuperSDRMainWindow(QMainWindow):
         self.callsign = callsign
         self.rigctld_host = options['rigctld_host']
         self.rigctld_port = options['rigctld_port']
+        self.compression = bool(options.get('compression'))
+        self.wf_archive_path = options.get('wf_archive')
+        self.wf_archive_size = options.get('wf_archive_size') or 1024
+        self.audio_latency_ms = options.get('audio_latency')
+        self.audio_prefill_ms = options.get('audio_prefill')
+        self.rec_rotate_mb = options.get('rec_rotate_mb')
+        self.rec_rotate_min = options.get('rec_rotate_min')
+        # W/F bins -> screen pixels for the waterfall and the spectrum
+        self.bin_resampler = backend.bin_resampler(options.get('bin_resample') or "max")
+        self.iq_channels = options.get('iq_channels')
+        self.wf_archive = None
+        self.wf_frames = None # frame_bus subscription of the live waterfall
+        self.render_worker = None # RenderWorker painting wf_frames
+        self.wf_ticks = 0 # waterfall timer ticks since wf_ticks_t0, for the paint rate
+        self.wf_ticks_t0 = QDateTime.currentMSecsSinceEpoch()
+        self.history_end = None # None: live waterfall, else archive line index
+        self.wf_time_level = 0 # waterfall pyramid level shown live, 0: every line
+        self.wf_time_level_total = -1
         
         # Initialize Settings Manager
         self.settings_manager = SettingsManager(self)
@@ -1062,6 +1521,7 @@ class SuperSDRMainWindow(QMainWindow):
         base_layout.addWidget(self.tune_bar, 0)  # stretch = 0
 
         self.waterfall_widget = WaterfallWidget(self, colormap=self.shared_colormap)
+        self.waterfall_widget.resampler = self.bin_resampler
         # Remove fixed height to allow resizing
         # self.waterfall_widget.setFixedHeight(WF_HEIGHT)
         self.waterfall_widget.setStyleSheet("background-color: #222;")
@@ -1070,6 +1530,7 @@ class SuperSDRMainWindow(QMainWindow):
         self.stacked_layout.addWidget(base_layer_widget)
 
         self.text_overlay_widget = TextOverlayWidget(top_interaction_widget, fonts=self.fonts)
+        self.label_layout = LabelLayout(self.fonts)
         # Remove fixed geometry to allow resizing
         # self.text_overlay_widget.setGeometry(0, 0, DISPLAY_WIDTH, interaction_height)
         self.stacked_layout.addWidget(self.text_overlay_widget)
@@ -1083,6 +1544,10 @@ class SuperSDRMainWindow(QMainWindow):
         self.s_meter_widget.setVisible(True)
         self.stacked_layout.addWidget(self.s_meter_widget)
 
+        self.latency_widget = LatencyWidget(top_interaction_widget)
+        self.latency_widget.setVisible(False)
+        self.stacked_layout.addWidget(self.latency_widget)
+
         self.tune_overlay_widget.raise_()
 
         main_vbox.addWidget(top_interaction_widget)
@@ -1187,15 +1652,42 @@ class SuperSDRMainWindow(QMainWindow):
             self.disp_mock = type('obj', (object,), {'DISPLAY_WIDTH': DISPLAY_WIDTH, 'WF_HEIGHT': WF_HEIGHT, 'SPECTRUM_HEIGHT': SPECTRUM_HEIGHT, 'TOPBAR_HEIGHT': TOPBAR_HEIGHT, 'TUNEBAR_HEIGHT': TUNEBAR_HEIGHT, 'BOTTOMBAR_HEIGHT': BOTTOMBAR_HEIGHT, 'SPECTRUM_FILLED': False})()
 
             print(f"Connecting to KiwiSDR at {self.kiwi_host}:{self.kiwi_port}")
-            self.kiwi_wf = kiwi_waterfall(self.kiwi_host, self.kiwi_port, kiwi_password, self.kiwi_wf_zoom, self.current_freq, self.eibi, self.disp_mock)
+            self.kiwi_wf = kiwi_waterfall(self.kiwi_host, self.kiwi_port, kiwi_password, self.kiwi_wf_zoom, self.current_freq, self.eibi, self.disp_mock, compression_=self.compression)
+            if self.wf_archive_path:
+                try:
+                    archive_sub = self.kiwi_wf.frame_bus.subscribe("archive")
+                    self.wf_archive = wf_archive(self.wf_archive_path, archive_sub, self.kiwi_wf.WF_BINS, self.wf_archive_size)
+                    # the archive stores every line, even with the window minimised
+                    self.kiwi_wf.governor.demand("archive", self.kiwi_wf.MAX_FPS)
+                    print(f"Recording waterfall history to {self.wf_archive_path}")
+                except Exception as e:
+                    print(f"Failed to open waterfall archive: {e}")
+                    self.wf_archive = None
+            # the GUI paints every line, but never more than a screen behind
+            self.wf_frames = self.kiwi_wf.frame_bus.subscribe("gui", max_pending=WF_HEIGHT)
+            # colour mapping and painting off the GUI thread, which only blits
+            self.render_worker = RenderWorker(self.wf_frames, self.kiwi_wf, self.shared_colormap,
+                                              self.bin_resampler.mode)
+            self.render_worker.waterfall_ready.connect(self.waterfall_widget.show_frame)
+            self.render_worker.spectrum_ready.connect(self.spectrum_widget.show_frame)
+            self._update_render_sizes()
+            self.render_worker.start()
             self.kiwi_wf_thread = threading.Thread(target=self.kiwi_wf.run, daemon=True)
             self.kiwi_wf_thread.start()
             print("KiwiSDR waterfall thread started - NO pygame!")
 
-            self.kiwi_snd = kiwi_sound(self.current_freq, "USB", 30, 3000, kiwi_password, self.kiwi_wf, 10)
+            self.kiwi_snd = kiwi_sound(self.current_freq, "USB", 30, 3000, kiwi_password, self.kiwi_wf, 10,
+                                       latency_s_=self.audio_latency_ms/1000. if self.audio_latency_ms else None,
+                                       iq_=bool(self.iq_channels))
             print("KiwiSDR audio initialized - NO pygame!")
+            self.kiwi_snd.audio_rec.ROTATE_MB = self.rec_rotate_mb
+            self.kiwi_snd.audio_rec.ROTATE_S = 60*self.rec_rotate_min if self.rec_rotate_min else None
+            if self.audio_prefill_ms:
+                self.kiwi_snd.PREFILL_S = self.audio_prefill_ms/1000.
             backend.start_audio_stream(self.kiwi_snd)
             print("Audio stream started.")
+            if self.iq_channels:
+                self._add_iq_channels(self.iq_channels)
 
             self.kiwi_memory = memory()
             self.beacon_project = beacons()
@@ -1240,6 +1732,9 @@ class SuperSDRMainWindow(QMainWindow):
             if hasattr(self, 'kiwi_wf_thread') and self.kiwi_wf is not None:
                 if hasattr(self.kiwi_wf, 'terminate'):
                     self.kiwi_wf.terminate = True
+            if self.render_worker:
+                self.render_worker.close()
+                self.render_worker = None
 
             self.kiwi_wf = None
             self.kiwi_snd = None
@@ -1248,35 +1743,93 @@ class SuperSDRMainWindow(QMainWindow):
         new_line_data = np.random.randint(0, 255, size=DISPLAY_WIDTH)
         self.waterfall_widget.update_waterfall_data(new_line_data)
 
+    def _report_wf_demand(self):
+        """Tell the W/F rate governor how many lines per second we can show"""
+        self.wf_ticks += 1
+        now = QDateTime.currentMSecsSinceEpoch()
+        if now - self.wf_ticks_t0 < 1000:
+            return
+        if self.render_worker:
+            # what the render worker and the widget actually get on screen
+            paint_rate = self.render_worker.paint_rate()
+        else:
+            paint_rate = self.wf_ticks * 1000. / (now - self.wf_ticks_t0)
+        self.wf_ticks, self.wf_ticks_t0 = 0, now
+        shown = self.isVisible() and not self.isMinimized() and self.waterfall_widget.isVisible()
+        self.kiwi_wf.governor.demand("gui", paint_rate if shown else 0., ttl_s=5)
+
+    def _update_render_sizes(self):
+        """Let the render worker follow the widget sizes."""
+        worker = self.render_worker
+        worker.wf_size = (self.waterfall_widget.width(), self.waterfall_widget.height())
+        worker.spectrum_size = (self.spectrum_widget.width(), self.spectrum_widget.height())
+
     def _update_waterfall_real(self):
-        if self.kiwi_wf and hasattr(self.kiwi_wf, 'wf_data'):
-            if self.kiwi_wf.wf_data is not None and len(self.kiwi_wf.wf_data) > 0:
-                latest_line = self.kiwi_wf.wf_data[0]
-                if len(latest_line) != DISPLAY_WIDTH:
-                    latest_line = np.interp(
-                        np.linspace(0, len(latest_line) - 1, DISPLAY_WIDTH),
-                        np.arange(len(latest_line)),
-                        latest_line,
-                    ).astype(np.uint8)
-                self.waterfall_widget.update_waterfall_data(latest_line)
-
-            if hasattr(self.kiwi_wf, 'spectrum') and self.kiwi_wf.spectrum is not None:
-                    spectrum_data = self.kiwi_wf.spectrum.astype(np.uint8)
-                    if len(spectrum_data) > 0:
-                        if len(spectrum_data) != DISPLAY_WIDTH:
-                            spectrum_data = np.interp(
-                                np.linspace(0, len(spectrum_data) - 1, DISPLAY_WIDTH),
-                                np.arange(len(spectrum_data)),
-                                spectrum_data,
-                            ).astype(np.uint8)
-                        self.spectrum_widget.update_spectrum_data(
-                            spectrum_data,
-                            wf_auto_scaling=self.kiwi_wf.wf_auto_scaling,
-                            wf_min_db=int(self.kiwi_wf.wf_min_db),
-                            wf_max_db=int(self.kiwi_wf.wf_max_db),
-                            filled=False,
-                            col=QYELLOW,
-                        )
+        if self.kiwi_wf and self.wf_frames:
+            self._report_wf_demand()
+            # the live lines and spectrum are painted by the render worker
+            if self.render_worker:
+                self._update_render_sizes()
+
+            if self.wf_time_level > 0 and self.history_end is None:
+                # time decimated view, redrawn only when its level gets a line
+                level = self.kiwi_wf.wf_pyramid.levels[self.wf_time_level]
+                if level.total != self.wf_time_level_total:
+                    self.wf_time_level_total = level.total
+                    page = np.concatenate(level.slices(self.waterfall_widget.height()))
+                    self.waterfall_widget.show_history(page)
+
+    def _toggle_recording(self):
+        """Start/stop streaming the receiver audio to a WAV file, with the
+        first IQ channel as sub receiver on the right channel."""
+        audio_rec = self.kiwi_snd.audio_rec
+        if audio_rec.recording_flag:
+            audio_rec.stop()
+        else:
+            sub_snd = self.kiwi_snd.iq_channels[0] if self.kiwi_snd.iq_channels else None
+            audio_rec.start(sub_snd)
+        self.recording_active = audio_rec.recording_flag
+
+    def _export_latency(self):
+        """Save the audio latency histograms as CSV next to the recordings."""
+        stamp = QDateTime.currentDateTimeUtc().toString('yyyyMMdd_hhmmss')
+        try:
+            path = self.kiwi_snd.latency.export(f"supersdr_latency_{stamp}Z.csv")
+            print(f"Audio latency histograms saved to {path}")
+        except OSError as e:
+            print(f"Failed to export audio latency: {e}")
+
+    def _scroll_history(self, lines=0, seconds=0):
+        """Move the archive view by lines or seconds, no arguments returns to live"""
+        archive = self.wf_archive
+        total = archive.total
+        if not lines and not seconds or total == 0:
+            self.history_end = None
+            self.wf_time_level_total = -1
+            self.waterfall_widget.show_history(None)
+            return
+        end = total if self.history_end is None else self.history_end
+        if seconds:
+            end = archive.seek(archive.utc_at(max(end - 1, archive.first())) + seconds)
+        end += lines
+        if end >= total:
+            # scrolled past the newest line
+            self.history_end = None
+            self.wf_time_level_total = -1
+            self.waterfall_widget.show_history(None)
+            return
+        self.history_end = max(end, archive.first() + 1)
+        page = archive.page(self.history_end, self.waterfall_widget.height())
+        self.waterfall_widget.show_history(page["line"])
+
+    def closeEvent(self, event):
+        if self.render_worker:
+            self.render_worker.close()
+        if self.wf_archive:
+            self.wf_archive.close()
+        if self.kiwi_snd and self.kiwi_snd.audio_rec.recording_flag:
+            self.kiwi_snd.audio_rec.stop()
+        super().closeEvent(event)
 
     def _bind_control_deck(self):
         if not hasattr(self, "control_deck"):
@@ -1349,6 +1902,23 @@ class SuperSDRMainWindow(QMainWindow):
             except Exception as e:
                 print(f"Error syncing mode to CAT radio: {e}")
 
+    def _add_iq_channels(self, spec):
+        """Demodulate the comma separated FREQMODE channels from the IQ stream."""
+        for item in spec.split(","):
+            item = item.strip().upper()
+            freq_str = item.rstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+            mode = item[len(freq_str):] or "USB"
+            try:
+                freq = float(freq_str)
+            except ValueError:
+                print(f"Bad IQ channel: {item}")
+                continue
+            lc, hc = backend.default_passband(mode)
+            try:
+                self.kiwi_snd.add_channel(freq, mode, lc, hc)
+            except ValueError as e:
+                print(f"Bad IQ channel {item}: {e}")
+
     def _apply_bandwidth(self, width):
         if not self.kiwi_snd:
             return
@@ -1541,6 +2111,9 @@ class SuperSDRMainWindow(QMainWindow):
         tune_bar_text = f"WF: {current_freq:.1f}kHz"
         self.tune_bar.setText(tune_bar_text)
 
+        if self.kiwi_snd:
+            # a failed recording stops by itself
+            self.recording_active = self.kiwi_snd.audio_rec.recording_flag
         status_bar_text = f"Kiwi: {self.kiwi_host}:{self.kiwi_port} | " \
                           f"Buf: {self.audio_buffer_len} | " \
                           f"DRX: {'ON' if self.dual_rx_active else 'OFF'} | " \
@@ -1551,6 +2124,36 @@ class SuperSDRMainWindow(QMainWindow):
                           f"CENTER: {'ON' if self.wf_snd_link_flag else 'OFF'} | " \
                           f"SYNC: {'ON' if self.cat_snd_link_flag else 'OFF'} | " \
                           f"AUTO: {'ON' if self.auto_mode else 'OFF'}"
+        if self.kiwi_wf and self.kiwi_snd:
+            rx_rate = self.kiwi_wf.transport.rx_rate + self.kiwi_snd.transport.rx_rate
+            status_bar_text += f" | NET: {rx_rate/1000:.1f}kB/s"
+            if self.compression:
+                saved_rate = self.kiwi_wf.transport.saved_rate() + self.kiwi_snd.transport.saved_rate()
+                status_bar_text += f" (ADPCM saves {saved_rate/1000:.1f}kB/s)"
+        if self.kiwi_snd:
+            ring = self.kiwi_snd.audio_ring
+            status_bar_text += f" | AUDIO: {1000*ring.fill()/self.kiwi_snd.AUDIO_RATE:.0f}/{1000*ring.target/self.kiwi_snd.AUDIO_RATE:.0f}ms" \
+                               f" JIT {1000*self.kiwi_snd.jitter.jitter_s:.0f}ms UND {ring.underruns} OVR {ring.overruns}"
+            ttfa = self.kiwi_snd.time_to_first_audio()
+            if ttfa is not None:
+                status_bar_text += f" TTFA {ttfa:.2f}s"
+            latency = self.kiwi_snd.latency
+            p50 = latency.percentile(latency.speaker, 50)
+            if p50 is not None:
+                status_bar_text += f" LAT {p50}/{latency.percentile(latency.speaker, 95)}ms"
+            if self.latency_widget.isVisible():
+                self.latency_widget.update_latency(latency)
+        if self.kiwi_wf:
+            governor = self.kiwi_wf.governor
+            status_bar_text += f" | WF: {governor.rx_fps:.0f}fps SPD{governor.speed}"
+        if self.wf_frames and self.wf_frames.dropped:
+            status_bar_text += f" | WF DROP: {self.wf_frames.dropped}"
+        if self.wf_time_level > 0:
+            status_bar_text += f" | WF TIME: {self.kiwi_wf.wf_pyramid.decimation(self.wf_time_level)}x"
+        if self.history_end is not None and self.wf_archive:
+            row = self.wf_archive.rows[(self.history_end - 1) % self.wf_archive.capacity]
+            hist_utc = QDateTime.fromSecsSinceEpoch(int(row["utc"]), Qt.UTC).toString('yyyy-MM-dd hh:mm:ss')
+            status_bar_text += f" | HIST: {hist_utc}Z {float(row['start_khz']):.1f}kHz Z{int(row['zoom'])} (HOME: live)"
         self.statusBar().showMessage(status_bar_text)
 
         if hasattr(self, 'control_deck'):
@@ -1625,37 +2228,55 @@ class SuperSDRMainWindow(QMainWindow):
             'memory_labels': []
         }
 
-        memory_labels_to_add: list[dict[str, Any]] = []
-        if self.show_mem_flag and self.kiwi_wf and hasattr(self, 'kiwi_memory'):
-            kiwi_memory = getattr(self, 'kiwi_memory')
-            y_offset = 0
-            old_fbin = -100
-            sorted_freq_list = sorted([(i, m[0]) for i, m in enumerate(kiwi_memory.mem_list)], key=lambda x: x[1])
-
-            for i, f_khz in sorted_freq_list:
-                f_bin = int((f_khz - start_f_khz) * bins2pixel_ratio)
-                x_pos = float(f_bin)
+        # labels are laid out again only when the view or their data change
+        layout = self.label_layout
+        key = self._overlay_key(wf, start_f_khz, bins2pixel_ratio, rx_freq, radio_mode)
+        if key != layout.key:
+            layout.key = key
+            self._layout_labels(wf, start_f_khz, bins2pixel_ratio, rx_freq, radio_mode)
 
-                font = self.fonts.get("smallfont", QFont("Arial", 10))
-                font_metrics = QFontMetrics(font)
-                text_width = font_metrics.width(str(i))
+        tune_overlay_data['memory_labels'] = layout.memory_labels
+        self.tune_overlay_widget.update_overlay_data(tune_overlay_data)
+        self.text_overlay_widget.update_text_elements(layout.text_elements)
+
+    def _overlay_key(self, wf, start_f_khz, bins2pixel_ratio, rx_freq, radio_mode):
+        """What the overlay labels depend on; lists that are replaced or grow
+        compare by identity and length."""
+        def version(items):
+            return (items, len(items)) if items is not None else None
+        mem_list = self.kiwi_memory.mem_list if self.show_mem_flag and hasattr(self, 'kiwi_memory') else None
+        spots = getattr(self.dxclust, 'visible_stations', None) if self.show_dxcluster_flag else None
+        eibi = getattr(self, 'eibi', None) if self.show_eibi_flag else None
+        now = QDateTime.currentDateTimeUtc().time()
+        return (start_f_khz, bins2pixel_ratio, self.waterfall_widget.width(), self.WF_Y, self.TUNEBAR_Y,
+                self.SPECTRUM_Y, rx_freq, radio_mode, wf.zoom if wf else None, wf.freq if wf else None,
+                version(mem_list), version(spots),
+                (version(eibi.visible_stations), version(eibi.station_dict), now.hour(), now.minute()) if eibi else None)
+
+    def _layout_labels(self, wf, start_f_khz, bins2pixel_ratio, rx_freq, radio_mode):
+        """Memory markers and the DX cluster, EIBI and beacon labels, each
+        kind packed into rows; the new text elements replace the old ones."""
+        layout = self.label_layout
+        widget_width = self.waterfall_widget.width()
+        # DX and EIBI rows fill the upper half of the waterfall at most
+        label_height = int(WF_HEIGHT / 2)
 
-                widget_width = self.waterfall_widget.width()
+        memory_labels_to_add: list[dict[str, Any]] = []
+        if self.show_mem_flag and self.kiwi_wf and hasattr(self, 'kiwi_memory'):
+            labels = []
+            for i, m in enumerate(self.kiwi_memory.mem_list):
+                x_pos = float(int((m[0] - start_f_khz) * bins2pixel_ratio))
+                text_width = layout.text_size("smallfont", str(i))[0]
                 if x_pos > text_width / 2 and x_pos < widget_width - 10:
-                    if f_bin - old_fbin <= text_width / 2 + 5:
-                        y_offset -= 16
-                    else:
-                        y_offset = 0
-                    old_fbin = f_bin
-
-                    memory_labels_to_add.append({
-                        'x_pos': x_pos,
-                        'y_pos': float(self.TUNEBAR_Y - 20),
-                        'y_offset': float(y_offset)
-                    })
-
-        tune_overlay_data['memory_labels'] = memory_labels_to_add
-        self.tune_overlay_widget.update_overlay_data(tune_overlay_data)
+                    labels.append((x_pos, x_pos, str(i)))
+            # rows go up from the tune bar
+            for x_pos, text, left, row, size in layout.place(labels, "smallfont"):
+                memory_labels_to_add.append({
+                    'x_pos': x_pos,
+                    'y_pos': float(self.TUNEBAR_Y - 20),
+                    'y_offset': float(-16 * row)
+                })
+        layout.memory_labels = memory_labels_to_add
 
         dynamic_text_elements: dict[str, Any] = {
             "freq_label": {"text": f"{rx_freq:.3f} kHz", "pos": (50, 50), "font_name": "hugefont", "color": QYELLOW},
@@ -1663,73 +2284,53 @@ class SuperSDRMainWindow(QMainWindow):
         }
 
         if self.show_dxcluster_flag and self.dxclust and hasattr(self.dxclust, 'visible_stations') and wf and wf.zoom > 3:
-            visible_stations = getattr(self.dxclust, 'visible_stations', [])
-            y_offset = 0
-            old_fbin = -100
-            for spot_id in visible_stations:
-                try:
-                    f_khz_float = float(self.dxclust.spot_dict[spot_id][1])
-                    f_bin = int((f_khz_float - start_f_khz) * bins2pixel_ratio)
-                    call = self.dxclust.spot_dict[spot_id][0]
-                    font = self.fonts.get("smallfont", QFont("Arial", 10))
-                    text_width = QFontMetrics(font).width(call)
-                    widget_width = self.waterfall_widget.width()
-                    if 0 < f_bin < widget_width:
-                        if f_bin - old_fbin <= text_width / 2 + 5:
-                            y_offset += 14
-                        else:
-                            y_offset = 0
-                        old_fbin = f_bin
-
-                        dynamic_text_elements[f"dx_{spot_id}"] = {
-                            "text": call,
-                            "pos": (int(f_bin - text_width / 2), int(self.WF_Y + 20 + (y_offset % int(WF_HEIGHT / 2)))),
-                            "font_name": "smallfont", "color": QWHITE, "bgcolor": QColor(20, 20, 20), "rotation": 0
-                        }
-                except: pass
+            labels = []
+            for spot_id in list(self.dxclust.visible_stations):
+                spot = self.dxclust.spot_dict.get(spot_id)
+                if spot is None:
+                    continue
+                f_bin = int((float(spot[1]) - start_f_khz) * bins2pixel_ratio)
+                if 0 < f_bin < widget_width:
+                    labels.append((spot_id, f_bin, spot[0]))
+            for spot_id, call, left, row, size in layout.place(labels, "smallfont", label_height // 14):
+                dynamic_text_elements[f"dx_{spot_id}"] = {
+                    "text": call, "pos": (left, int(self.WF_Y + 20 + 14 * row)), "size": size,
+                    "font_name": "smallfont", "color": QWHITE, "bgcolor": QColor(20, 20, 20), "rotation": 0
+                }
 
         if self.show_eibi_flag and hasattr(self, 'eibi') and wf and wf.zoom > 6:
-            from datetime import datetime
-            now_time = datetime.utcnow().hour + datetime.utcnow().minute / 60
-            y_offset = 0
-            old_fbin = -100
-            for f_str in sorted(set(self.eibi.visible_stations), key=float):
+            now = QDateTime.currentDateTimeUtc().time()
+            now_time = now.hour() + now.minute() / 60
+            labels = []
+            for f_str in set(self.eibi.visible_stations):
                 if f_str not in self.eibi.station_dict: continue
+                f_bin = int((float(f_str) - start_f_khz) * bins2pixel_ratio)
+                if not 0 < f_bin < widget_width: continue
                 for record in self.eibi.station_dict[f_str]:
-                    try:
-                        h1, m1 = int(record[0][:2]), int(record[0][2:4])
-                        h2, m2 = int(record[0][5:7]), int(record[0][7:9])
-                        if not (h1 + m1/60 <= now_time <= h2 + m2/60): continue
-                        f_bin = int((float(f_str) - start_f_khz) * bins2pixel_ratio)
-                        name = record[3]
-                        text_width = QFontMetrics(self.fonts.get("smallfont", QFont("Arial", 10))).width(name)
-                        widget_width = self.waterfall_widget.width()
-                        if 0 < f_bin < widget_width:
-                            if f_bin - old_fbin <= text_width / 2 + 5: y_offset += 16
-                            else: y_offset = 0
-                            old_fbin = f_bin
-                            dynamic_text_elements[f"eibi_{f_str}_{name}"] = {
-                                "text": name, "pos": (int(f_bin - text_width / 2), int(self.WF_Y + 20 + y_offset)),
-                                "font_name": "smallfont", "color": QWHITE, "bgcolor": QColor(20, 20, 20), "rotation": 0
-                            }
-                    except: pass
+                    hours = layout.schedule(record[0])
+                    if hours is None or not (hours[0] <= now_time <= hours[1]): continue
+                    labels.append((f"eibi_{f_str}_{record[3]}", f_bin, record[3]))
+            for label_id, name, left, row, size in layout.place(labels, "smallfont", label_height // 16):
+                dynamic_text_elements[label_id] = {
+                    "text": name, "pos": (left, int(self.WF_Y + 20 + 16 * row)), "size": size,
+                    "font_name": "smallfont", "color": QWHITE, "bgcolor": QColor(20, 20, 20), "rotation": 0
+                }
 
         if hasattr(self, 'beacon_project') and self.beacon_project and wf and wf.zoom > 8:
-            y_offset, old_fbin = 0, -100
             for b in self.beacon_project.freq_dict:
                 if math.fabs(wf.freq - self.beacon_project.freq_dict[b]) < 100:
                     f_khz = float(self.beacon_project.freq_dict[b])
                     f_bin = int((f_khz - start_f_khz) * bins2pixel_ratio)
                     name = self.beacon_project.beacons_dict[b]
-                    text_width = QFontMetrics(self.fonts.get("midfont", QFont("Arial", 12))).width(name)
-                    widget_width = self.waterfall_widget.width()
+                    size = layout.text_size("midfont", name)
                     if 0 < f_bin < widget_width:
                         dynamic_text_elements[f"beacon_{b}"] = {
-                            "text": name, "pos": (int(f_bin - text_width / 2), int((self.SPECTRUM_Y + self.TUNEBAR_Y) / 2)),
-                            "font_name": "midfont", "color": QGREEN, "bgcolor": QColor(20, 20, 20), "rotation": 0
+                            "text": name, "pos": (int(f_bin - size[0] / 2), int((self.SPECTRUM_Y + self.TUNEBAR_Y) / 2)),
+                            "size": size, "font_name": "midfont", "color": QGREEN, "bgcolor": QColor(20, 20, 20),
+                            "rotation": 0
                         }
 
-        self.text_overlay_widget.update_text_elements(dynamic_text_elements)
+        layout.text_elements = dynamic_text_elements
 
 
 
@@ -1894,6 +2495,24 @@ class SuperSDRMainWindow(QMainWindow):
                 if self.kiwi_wf.zoom > 0:
                     self.kiwi_wf.set_freq_zoom(self.kiwi_snd.freq + (CW_PITCH if self.kiwi_snd.radio_mode == "CW" else 0.), self.kiwi_wf.zoom - 1)
 
+            elif key in (Qt.Key_PageUp, Qt.Key_PageDown) and mods & (Qt.ShiftModifier | Qt.ControlModifier) and self.wf_archive:
+                direction = -1 if key == Qt.Key_PageUp else 1
+                if mods & Qt.ControlModifier:
+                    self._scroll_history(seconds=direction * 600)
+                else:
+                    self._scroll_history(lines=direction * (self.waterfall_widget.height() // 2))
+
+            elif key in (Qt.Key_BracketLeft, Qt.Key_BracketRight):
+                max_level = len(self.kiwi_wf.wf_pyramid.levels) - 1
+                step = 1 if key == Qt.Key_BracketRight else -1
+                self.wf_time_level = max(0, min(max_level, self.wf_time_level + step))
+                self.wf_time_level_total = -1
+                if self.wf_time_level == 0 and self.history_end is None:
+                    self.waterfall_widget.show_history(None)
+
+            elif key == Qt.Key_Home and self.history_end is not None:
+                self._scroll_history()
+
             elif key == Qt.Key_PageUp:
                 manual_wf_freq = self.kiwi_wf.freq + self.kiwi_wf.span_khz / 4
                 self.kiwi_wf.set_freq_zoom(manual_wf_freq, self.kiwi_wf.zoom)
@@ -1960,6 +2579,14 @@ class SuperSDRMainWindow(QMainWindow):
             elif key == Qt.Key_D:
                 self.show_dxcluster_flag = not self.show_dxcluster_flag
 
+            elif key == Qt.Key_E:
+                if mods & Qt.ShiftModifier:
+                    self.latency_widget.setVisible(not self.latency_widget.isVisible())
+                elif mods & Qt.ControlModifier:
+                    self._export_latency()
+                else:
+                    self._toggle_recording()
+
             elif key == Qt.Key_I:
                 self.show_eibi_flag = not self.show_eibi_flag
 
@@ -2007,6 +2634,24 @@ def main():
                       help="rigctld host (default: localhost)", dest="rigctld_host", default="localhost")
     parser.add_option("--rigctld-port", type=int,
                       help="rigctld port (default: 4532)", dest="rigctld_port", default=4532)
+    parser.add_option("--wf-archive", type=str,
+                      help="waterfall history file to record into and scroll back", dest="wf_archive", default=None)
+    parser.add_option("--compress", action="store_true",
+                      help="request IMA-ADPCM compressed waterfall and audio (slow links)", dest="compression", default=False)
+    parser.add_option("--wf-archive-size", type=int,
+                      help="waterfall history file size in MB (default: 1024)", dest="wf_archive_size", default=1024)
+    parser.add_option("--audio-latency", type=int,
+                      help="audio playback latency target in ms (default: 10 Kiwi frames, ~430)", dest="audio_latency", default=None)
+    parser.add_option("--audio-prefill", type=int,
+                      help="start playing once this many ms of audio are buffered (default: 100)", dest="audio_prefill", default=None)
+    parser.add_option("--rec-rotate-mb", type=int,
+                      help="start a new audio recording file every N MB", dest="rec_rotate_mb", default=None)
+    parser.add_option("--rec-rotate-min", type=int,
+                      help="start a new audio recording file every N minutes", dest="rec_rotate_min", default=None)
+    parser.add_option("--iq-channels", type=str,
+                      help="open the RX in IQ mode and demodulate more channels locally, e.g. 7074USB,7030CW", dest="iq_channels", default=None)
+    parser.add_option("--bin-resample", type="choice", choices=backend.bin_resampler.MODES,
+                      help="how W/F bins are fitted to the screen width: max (default, keeps narrow carriers), mean or nearest", dest="bin_resample", default="max")
 
     (parsed_options, args) = parser.parse_args()
     
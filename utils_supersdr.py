@@ -6,6 +6,7 @@ from collections import deque, defaultdict
 import pickle
 import threading, queue
 import socket
+import os
 import time
 from datetime import datetime, timedelta
 import sys
@@ -64,35 +65,171 @@ class flags():
     tk_log_search_flag = False
     tk_kiwi_flag = False
 
+class wav_writer():
+    # WAV file written while recording by a background thread. Each channel
+    # has a fixed size int16 FIFO (one receiver feeds each channel, from its own
+    # thread), the thread drains them about once a second into one large write
+    # and patches the RIFF and data sizes right after, so the file on disk is
+    # always a valid WAV even if the program dies. With rotate_mb / rotate_s a
+    # new file is started once the current one is that big or that long, and
+    # always before the u32 RIFF sizes overflow (~6 h of 48 kHz stereo). If
+    # writing fails the file is closed, `error` is set and on_error is called.
+    HEADER = struct.Struct('<4sI4s4sIHHIIHH4sI')
+    MAX_DATA_BYTES = 0xFFFFFFFF - 36
+    FLUSH_S = 1.
+    FIFO_S = 10.
+    LAG_S = 2. # a channel this far behind the others is stopped, pad it
+
+    def __init__(self, prefix, rate, channels=1, rotate_mb=None, rotate_s=None):
+        self.prefix = prefix
+        self.rate = int(rate)
+        self.channels = channels
+        self.rotate_s = rotate_s
+        size = int(self.FIFO_S * self.rate)
+        self.fifo = np.zeros((channels, size), dtype=np.int16)
+        self.write_pos = [0] * channels # stored by the producers only
+        self.read_pos = [0] * channels # stored by the writer thread only
+        self.block = np.zeros((size, channels), dtype=np.int16)
+        # rotated before a drained block can push the data size past u32
+        max_bytes = self.MAX_DATA_BYTES - self.block.nbytes
+        self.rotate_bytes = min(int(rotate_mb * 2**20), max_bytes) if rotate_mb else max_bytes
+        self.dropped = 0
+        self.error = None
+        self.on_error = None
+        self.filenames = []
+        self.file = None
+        self._open()
+        self.terminate = False
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @property
+    def filename(self):
+        return self.filenames[-1]
+
+    def write(self, samples, channel=0):
+        # int16 samples of one channel, dropped if the writer fell FIFO_S behind
+        size = self.fifo.shape[1]
+        pos = self.write_pos[channel]
+        n = min(len(samples), size - (pos - self.read_pos[channel]))
+        self.dropped += len(samples) - n
+        start = pos % size
+        first = min(n, size - start)
+        self.fifo[channel, start:start + first] = samples[:first]
+        self.fifo[channel, :n - first] = samples[first:n]
+        self.write_pos[channel] = pos + n
+
+    def run(self):
+        try:
+            while not self.terminate:
+                self.wake.wait(self.FLUSH_S)
+                self.drain()
+            self.drain(final=True)
+        except Exception as e:
+            print("recording to %s failed: %s" % (self.filename, e))
+            self.error = e
+            if self.on_error:
+                self.on_error()
+        finally:
+            self._close()
+
+    def close(self):
+        self.terminate = True
+        self.wake.set()
+        self.thread.join(timeout=5)
+
+    def drain(self, final=False):
+        size = self.fifo.shape[1]
+        avail = [w - r for w, r in zip(self.write_pos, self.read_pos)]
+        n = min(avail)
+        if final or max(avail) - n > self.LAG_S * self.rate:
+            n = max(avail)
+        if not n:
+            return
+        block = self.block[:n]
+        for ch in range(self.channels):
+            m = min(n, avail[ch])
+            start = self.read_pos[ch] % size
+            first = min(m, size - start)
+            block[:first, ch] = self.fifo[ch, start:start + first]
+            block[first:m, ch] = self.fifo[ch, :m - first]
+            block[m:, ch] = 0
+            self.read_pos[ch] += m
+        self._write(block)
+
+    def _open(self):
+        stamp = datetime.utcnow().isoformat().split(".")[0].replace(":", "_")
+        filename = "%s_%sUTC.wav" % (self.prefix, stamp)
+        part = 1
+        while os.path.exists(filename):
+            part += 1
+            filename = "%s_%sUTC_%d.wav" % (self.prefix, stamp, part)
+        self.filenames.append(filename)
+        self.file = open(filename, "wb", buffering=2**20)
+        self.data_bytes = 0
+        self.opened = time.time()
+        self._write_header()
+        print("recording to %s" % filename)
+
+    def _write_header(self):
+        block_align = 2 * self.channels
+        self.file.write(self.HEADER.pack(b"RIFF", 36 + self.data_bytes, b"WAVE", b"fmt ", 16, 1, self.channels,
+                                         self.rate, self.rate * block_align, block_align, 16, b"data", self.data_bytes))
+
+    def _write(self, block):
+        if self.data_bytes + block.nbytes > self.rotate_bytes or \
+                self.rotate_s and time.time() - self.opened >= self.rotate_s:
+            self._close()
+            self._open()
+        self.file.write(memoryview(block).cast("B"))
+        self.data_bytes += block.nbytes
+        self.file.seek(0)
+        self._write_header()
+        self.file.seek(0, os.SEEK_END)
+        self.file.flush()
+
+    def _close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
 class audio_recording():
-    CHANNELS = 1
+    # ROTATE_MB / ROTATE_S: start a new file at that size or length, if set
+    ROTATE_MB = None
+    ROTATE_S = None
+
     def __init__(self, kiwi_snd):
         self.filename = ""
-        self.audio_buffer = []
         self.kiwi_snd = kiwi_snd
-        self.frames = []
+        self.writer = None
+        self.sources = []
         self.recording_flag = False
 
-    def start(self):
-        self.filename = "supersdr_%sUTC.wav"%datetime.utcnow().isoformat().split(".")[0].replace(":", "_")
+    def start(self, sub_snd=None):
+        # with a sub receiver, main goes to the left channel and sub to the right
+        self.sources = [self.kiwi_snd] + ([sub_snd] if sub_snd else [])
         print("start recording")
-        self.audio_buffer = []
+        self.writer = wav_writer("supersdr", self.kiwi_snd.AUDIO_RATE, len(self.sources), self.ROTATE_MB, self.ROTATE_S)
+        self.filename = self.writer.filename
+        self.writer.on_error = self.detach
+        for ch, snd in enumerate(self.sources):
+            snd.recorders = snd.recorders + [(self.writer, ch)]
         self.recording_flag = True
 
+    def detach(self):
+        # the receivers stop feeding the writer, also called by a failed writer
+        self.recording_flag = False
+        for snd in self.sources:
+            snd.recorders = [rec for rec in snd.recorders if rec[0] is not self.writer]
+
     def stop(self):
         print("stop recording")
-        self.recording_flag = False
-        self.save()
-
-    def save(self):
-        self.wave = wave.open(self.filename, 'wb')
-        self.wave.setnchannels(self.CHANNELS)
-        self.wave.setsampwidth(2) # two bytes per sample (int16)
-        self.wave.setframerate(self.kiwi_snd.AUDIO_RATE)
-        # process audio data here
-        self.wave.writeframes(b''.join(self.audio_buffer))
-        self.wave.close()
-        self.recording = False
+        self.detach()
+        self.writer.close()
+        self.filename = self.writer.filename
+        if self.writer.dropped:
+            print("recording dropped %d samples" % self.writer.dropped)
 
 from time import sleep
 
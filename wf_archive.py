@@ -0,0 +1,141 @@
+# wf_archive.py - persistent memory mapped waterfall history
+#
+# The file is a fixed size ring of uint8 waterfall lines, each tagged with its
+# UTC timestamp, WF start frequency, zoom and averaging. It is mapped with
+# np.memmap, so reading back any time range only touches the pages it needs and
+# hours of history can be scrolled at constant memory. Lines are only ever
+# appended (the oldest ones are overwritten once the ring is full) by a writer
+# thread that drains a backend.frame_bus subscription, so the waterfall thread
+# never waits for the disk.
+
+import os
+import threading
+import time
+
+import numpy as np
+
+MAGIC = b"SSDRWFA1"
+HEADER_BYTES = 4096
+HEADER_DTYPE = np.dtype([("magic", "S8"), ("bins", "<u4"), ("capacity", "<u8"),
+                         ("total", "<u8")])
+
+
+def row_dtype(bins):
+    return np.dtype([("utc", "<f8"), ("start_khz", "<f8"), ("zoom", "u1"),
+                     ("averaging", "<u2"), ("line", "u1", (bins,))])
+
+
+class wf_archive():
+    FLUSH_S = 2.
+
+    def __init__(self, path, source, bins=1024, size_mb=1024):
+        self.path = path
+        self.bins = bins
+        self.dtype = row_dtype(bins)
+        capacity = max(int(size_mb * 2**20) // self.dtype.itemsize, 1)
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self.header = np.memmap(path, dtype=HEADER_DTYPE, mode="r+", shape=(1,))
+            if self.header["magic"][0] != MAGIC or self.header["bins"][0] != bins:
+                raise ValueError("%s is not a %d bins waterfall archive" % (path, bins))
+            # keep the size it was created with, resizing would scramble the ring
+            capacity = int(self.header["capacity"][0])
+        else:
+            self.header = np.memmap(path, dtype=HEADER_DTYPE, mode="w+", shape=(1,))
+            self.header["magic"] = MAGIC
+            self.header["bins"] = bins
+            self.header["capacity"] = capacity
+            self.header["total"] = 0
+            self.header.flush()
+        self.capacity = capacity
+        self.rows = np.memmap(path, dtype=self.dtype, mode="r+", offset=HEADER_BYTES,
+                              shape=(capacity,))
+
+        # frame_subscriber the lines come from, its dropped counter tells how
+        # many lines the writer could not keep up with
+        self.source = source
+        self.terminate = False
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    @property
+    def total(self):
+        # lines ever stored, line i lives in slot i % capacity
+        return int(self.header["total"][0])
+
+    def first(self):
+        return max(self.total - self.capacity, 0)
+
+    @property
+    def dropped(self):
+        return self.source.dropped
+
+    def run(self):
+        last_flush = time.monotonic()
+        while not self.terminate:
+            self.source.wait(self.FLUSH_S)
+            self.store(self.source.drain())
+            if time.monotonic() - last_flush >= self.FLUSH_S:
+                self.flush()
+                last_flush = time.monotonic()
+        self.store(self.source.drain())
+        self.flush()
+
+    def store(self, frames):
+        total = self.total
+        for frame in frames:
+            if frame["cached"]:
+                continue
+            row = self.rows[total % self.capacity]
+            row["utc"] = frame["utc"]
+            row["start_khz"] = frame["start_khz"]
+            row["zoom"] = frame["zoom"]
+            row["averaging"] = frame["averaging"]
+            np.copyto(row["line"], frame["line"], casting="unsafe")
+            total += 1
+            # readers never see a line before it is complete
+            self.header["total"] = total
+
+    def flush(self):
+        self.rows.flush()
+        self.header.flush()
+
+    def close(self):
+        self.terminate = True
+        self.source.ready.set()
+        self.writer.join(timeout=5)
+
+    def utc_at(self, idx):
+        return float(self.rows["utc"][idx % self.capacity])
+
+    def seek(self, utc):
+        # index of the first stored line at or after utc, by bisection on the
+        # time ordered ring, so only ~log2(capacity) lines are paged in
+        lo, hi = self.first(), self.total
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.utc_at(mid) < utc:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def read(self, start, stop, step=1):
+        # copy of lines [start, stop) in time order, clamped to what is stored
+        start = max(start, self.first())
+        stop = min(stop, self.total)
+        if stop <= start:
+            return np.zeros(0, dtype=self.dtype)
+        idx = np.arange(start, stop, step) % self.capacity
+        return self.rows[idx]
+
+    def read_time(self, utc_start, utc_stop, max_lines=None):
+        start, stop = self.seek(utc_start), self.seek(utc_stop)
+        step = 1
+        if max_lines and stop - start > max_lines:
+            step = -(-(stop - start) // max_lines)
+        return self.read(start, stop, step)
+
+    def page(self, end, n):
+        # the n lines ending at index end (excluded), newest first, for display
+        return self.read(end - n, end)[::-1]